@@ -7,18 +7,21 @@ All the things can override via Environment variables are keep in this one file.
     the name of the constant. This is how we avoid logging passwords.
 """
 from os import environ
-from collections import namedtuple, OrderedDict
 
 
-DEFINED = OrderedDict([
-            ('ES_USERNAME', environ.get('ES_USERNAME', 'someUser')),
-            ('ES_PASSWORD', environ.get('ES_PASSWORD', 'IloveKats!')),
-            ('ES_URL', environ.get('ES_URL', 'https://elasticsearch.org')),
-            ('ES_PORT', int(environ.get('ES_PORT', 9200))),
-            ('ES_SSL_VERIFY', bool(environ.get('ES_SSL_VERIFY', False))),
-          ])
+def _as_bool(value):
+    """Environment variables are always strings, and ``bool('False')`` is True
 
-Constants = namedtuple('Constants', list(DEFINED.keys()))
+    :Returns: Boolean
 
-# The '*' expands the list, just liked passing a function *args
-const = Constants(*list(DEFINED.values()))
+    :param value: The value of the environment variable
+    :type value: String
+    """
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+ES_USERNAME = environ.get('ES_USERNAME', 'someUser')
+ES_PASSWORD = environ.get('ES_PASSWORD', 'IloveKats!')
+ES_URL = environ.get('ES_URL', 'https://elasticsearch.org')
+ES_PORT = int(environ.get('ES_PORT', 9200))
+ES_SSL_VERIFY = _as_bool(environ.get('ES_SSL_VERIFY', 'false'))
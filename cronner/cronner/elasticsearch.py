@@ -1,15 +1,58 @@
 # -*- coding: UTF-8 -*-
 """Functions to perform routine tasks for ElasticSearch"""
+import re
 import time
+import heapq
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
+import ujson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 requests.packages.urllib3.disable_warnings()
 
 from cronner.std_logger import get_logger
-from cronner.constants import const
+from cronner.constants import ES_URL, ES_PORT, ES_SSL_VERIFY, ES_USERNAME, ES_PASSWORD
 
 logger = get_logger('elasticsearch')
 
+# These never change while we're running, so only build them once
+_CREDS = (ES_USERNAME, ES_PASSWORD)
+_BASE = '{}:{}'.format(ES_URL, ES_PORT)
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# ElasticSearch accepts a comma separated list of indices in the URL, but
+# the URL cannot grow forever; chunking keeps us well under the length limit.
+MAX_INDICES_PER_CALL = 50
+# New indices are only created once a day, so there's no point in asking
+# ElasticSearch for the list of indices every time we need it.
+INDICES_TTL = 300 # seconds
+_indices_cache = {'ts': 0.0, 'value': None}
+# How old the cached set of indices can be, and still let prune_indices skip
+# talking to ElasticSearch when there's obviously nothing to prune.
+PRUNE_SKIP_TTL = 3600 # seconds
+# The daily log indices; anything else (like .kibana) is never pruned
+_DAILY_INDEX = re.compile(r'logs-\d{4}\.\d{2}\.\d{2}')
+# How many mapping updates to have in-flight at once
+FIELD_DATA_WORKERS = 8
+
+# A single Session keeps the TCP/TLS connection to ElasticSearch alive between
+# calls, instead of paying for a new handshake on every index we touch.
+_session = requests.Session()
+_session.auth = _CREDS
+_session.verify = ES_SSL_VERIFY
+# Transient errors get retried (with exponential backoff) by the connection
+# pool, instead of leaving an index un-updated until the next scheduled run.
+# Once the retries run out, the last response is returned (not raised as a
+# RetryError) so the callers log it like any other failed call.
+_RETRY = Retry(total=3,
+               backoff_factor=0.3,
+               status_forcelist=(502, 503, 504),
+               allowed_methods=frozenset(['GET', 'PUT', 'DELETE']),
+               raise_on_status=False)
+_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=_RETRY))
+
 
 def prune_indices(max_log_records=30):
     """Delete the oldest indices on the Elastic Search server.
@@ -24,36 +67,39 @@ def prune_indices(max_log_records=30):
     :param max_log_records: The maximum number of indices to keep
     :type max_log_records: Integer
     """
+    cached = _indices_cache['value']
+    if cached is not None and len(cached) <= max_log_records:
+        cache_age = time.monotonic() - _indices_cache['ts']
+        if cache_age < PRUNE_SKIP_TTL:
+            logger.debug('Only {} indices as of {} seconds ago, skipping prune'.format(len(cached), int(cache_age)))
+            return
     # A new index is created daily
-    indices = _get_indices()
+    indices = [x for x in _get_indices() if _DAILY_INDEX.fullmatch(x)]
     to_prune = len(indices) - max_log_records
     logger.info('Total Indices: {}, Pruning: {}'.format(len(indices), to_prune))
     if to_prune > 0:
         logger.info('Pruning {} days worth of logs from elastic search'.format(to_prune))
-        timestamp_pattern = 'logs-%Y.%m.%d'
-        indices_map = {}
-        # create a mapping of the epoch timestamp to the index name
-        for index in indices:
-            as_epoch = int(time.mktime(time.strptime(index, timestamp_pattern)))
-            indices_map[as_epoch] = index
-        # now, lets get a sorted list of the indexes; having them as an EPOCH
-        # timestamp make sorting very simple
-        indices_to_prune = []
-        indices_keys = sorted(list(indices_map.keys()))
-        for _ in range(to_prune):
-            # as we pop off the oldest, add the index name to the list of
-            # things we have to delete
-            indices_to_prune.append(indices_map[indices_keys.pop(0)])
-        # now create all the URLs to delete the oldest index
-        for index_name in indices_to_prune:
-            url = '{}:{}/{}'.format(const.ES_URL, const.ES_PORT, index_name)
+        # Index names are zero-padded 'logs-%Y.%m.%d', so sorting the names
+        # as strings also sorts them by date; no need to parse every name into
+        # a timestamp just to find the oldest ones. Normally we only prune
+        # 1 index a day, so a heap beats sorting the whole set.
+        indices_to_prune = heapq.nsmallest(to_prune, indices)
+        # delete many indices per call, instead of 1 round-trip per index
+        for chunk in _chunked(indices_to_prune, MAX_INDICES_PER_CALL):
+            index_names = ','.join(chunk)
+            url = '{}/{}'.format(_BASE, index_names)
             resp = _call_es(url, method='delete')
             if not resp.ok:
-                msg = 'Failed to delete index {}, Status: {}, Msg: {}'.format(index_name, resp.status_code, resp.content)
+                msg = 'Failed to delete index {}, Status: {}, Msg: {}'.format(index_names, resp.status_code, resp.content)
                 logger.error(msg)
+            elif not resp.json().get('acknowledged', False):
+                logger.error('Delete of index {} was not acknowledged'.format(index_names))
+            else:
+                # the cached set of indices is now stale
+                _indices_cache['value'] = None
 
 
-def add_field_data():
+def add_field_data(per_index_fallback=True):
     """Tell ElasticSearch to index the ``transaction_id`` attribute of the web logs
 
     This allows us to use the ``transaction_id`` as a 'drop down' in Grafana
@@ -61,40 +107,94 @@ def add_field_data():
 
     :Returns: None
 
-    :param indices: The name of the indices that exist on the Elastic Search server
-    :type indices: Set
+    :param per_index_fallback: If updating many indices at once fails, retry
+                               each of those indices one by one.
+    :type per_index_fallback: Boolean
     """
-    indices = _get_indices()
+    indices = sorted(_get_indices())
     payload = {"properties": {"transaction_id": {"type": "text", "fielddata": True}}}
-    for index in indices:
-        url = '{}:{}/{}/_mapping/web'.format(const.ES_URL, const.ES_PORT, index)
+    failed = []
+    # the mapping is the same for every index, so update many indices per call
+    for chunk in _chunked(indices, MAX_INDICES_PER_CALL):
+        index_names = ','.join(chunk)
+        url = '{}/{}/_mapping/web'.format(_BASE, index_names)
         resp = _call_es(url, method='put', json=payload)
+        if not resp.ok:
+            msg = 'Failed to update index {}, Status: {}, Msg: {}'.format(index_names, resp.status_code, resp.content.decode())
+            logger.error(msg)
+            failed.extend(chunk)
+    if failed and per_index_fallback:
+        _update_each_index(failed, payload)
+
+
+def _update_each_index(indices, payload):
+    """Update the ``web`` mapping of every index, one index per API call
+
+    :Returns: None
+
+    :param indices: The names of the indices to update
+    :type indices: List
+
+    :param payload: The new mapping properties
+    :type payload: Dictionary
+    """
+    urls = ['{}/{}/_mapping/web'.format(_BASE, index) for index in indices]
+    # The updates don't depend on each other, so overlap the network round-trips
+    with ThreadPoolExecutor(max_workers=FIELD_DATA_WORKERS) as executor:
+        responses = list(executor.map(partial(_call_es, method='put', json=payload), urls))
+    for index, resp in zip(indices, responses):
         if not resp.ok:
             msg = 'Failed to update index {}, Status: {}, Msg: {}'.format(index, resp.status_code, resp.content.decode())
             logger.error(msg)
 
 
-def _get_indices():
+def _get_indices(ttl=INDICES_TTL):
     """Obtain the set of indices that exist on the Elastic Search server
 
+    The answer is cached, so calling this function several times within ``ttl``
+    seconds only queries ElasticSearch once.
+
     :Returns: Set (of strings)
+
+    :param ttl: How many seconds a previous answer is good for
+    :type ttl: Integer
     """
-    url = '{}:{}/_cat/indices'.format(const.ES_URL, const.ES_PORT)
+    cached = _indices_cache['value']
+    if cached is not None and time.monotonic() - _indices_cache['ts'] < ttl:
+        return cached
+    # only ask for the index name column; the rest is just wasted bytes
+    url = '{}/_cat/indices?format=json&h=index'.format(_BASE)
     resp = _call_es(url)
-    indices = set([])
-    # example of a row
-    # yellow open logs-2019.04.28 Ei_u-uXRTvyT3QJOYfWEpg 5 1 119376 0 53.6mb 53.6mb
-    data = resp.content.decode().split('\n')
-    for row in data:
-        if row:
-            index_name = row.split(' ')[2]
-            indices.add(index_name)
+    # example of the response
+    # [{"index":"logs-2019.04.28"},{"index":"logs-2019.05.04"}]
+    # ujson can parse the raw bytes, so skip decoding the body into a str first
+    indices = set([row['index'] for row in ujson.loads(resp.content)])
+    _indices_cache['ts'] = time.monotonic()
+    _indices_cache['value'] = indices
     return indices
 
 
+def _chunked(items, size):
+    """Split a list into smaller lists that have at most ``size`` elements
+
+    :Returns: Generator
+
+    :param items: The things to split up
+    :type items: List
+
+    :param size: The max number of elements per chunk
+    :type size: Integer
+    """
+    for idx in range(0, len(items), size):
+        yield items[idx:idx + size]
+
+
 def _call_es(url, method='get', json=None):
     """Abstracts the SSL verification and Basic Auth aspect of talking to ElasitcSearch
 
+    All calls share the same ``requests.Session``, so the connection to the
+    ElasticSearch server is reused.
+
     :Returns: requests.Response
 
     :param url: The URL to call
@@ -106,7 +206,10 @@ def _call_es(url, method='get', json=None):
     :param json: The JSON payload to send with the requests
     :type json: PyObject
     """
-    creds = (const.ES_USERNAME, const.ES_PASSWORD)
-    caller = getattr(requests, method)
-    resp = caller(url, verify=const.ES_SSL_VERIFY, auth=creds, json=json)
+    caller = getattr(_session, method)
+    if json is None:
+        resp = caller(url)
+    else:
+        # ujson is a lot faster than the stdlib json that requests would use
+        resp = caller(url, data=ujson.dumps(json).encode(), headers=_JSON_HEADERS)
     return resp
@@ -6,12 +6,19 @@ from setproctitle import setproctitle
 
 from cronner.scheduler import schedule
 
+MIN_SLEEP = 1 # seconds
+MAX_SLEEP = 60 # seconds; upper bound so a clock change can't stall us for long
+
 
 def main():
     """Entry point logic for running cron-like tasks"""
     while True:
         schedule.run_pending()
-        time.sleep(1)
+        # Sleep until the next job is due, instead of waking up every second
+        idle = schedule.idle_seconds()
+        if idle is None:
+            idle = MAX_SLEEP
+        time.sleep(max(MIN_SLEEP, min(idle, MAX_SLEEP)))
 
 
 if __name__ == '__main__':
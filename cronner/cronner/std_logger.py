@@ -3,11 +3,15 @@
 This simple module allows us to have a consistent logging format across services
 """
 import logging
+from functools import lru_cache
 
 
+@lru_cache(maxsize=32)
 def get_logger(name, loglevel='INFO'):
     """A factory for making a logger that contains the processes name.
 
+    Calling this function again with the same params returns the same object.
+
     :Returns: logging.LoggerAdapter
 
     :param name: The name of the process
@@ -26,5 +30,4 @@ def get_logger(name, loglevel='INFO'):
         ch.setLevel(loglevel.upper())
         ch.setFormatter(formatter)
         logger.addHandler(ch)
-        logger = logging.LoggerAdapter(logger, extra)
-    return logger
+    return logging.LoggerAdapter(logger, extra)
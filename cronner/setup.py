@@ -19,5 +19,5 @@ setup(name="cronner",
       ],
       description="A cron-like system for performing routine tasks",
       long_description=open('README.rst').read(),
-      install_requires=['setproctitle', 'schedule', 'requests']
+      install_requires=['setproctitle', 'schedule', 'requests', 'ujson']
       )
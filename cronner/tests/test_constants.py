@@ -0,0 +1,28 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the ``constants.py`` module"""
+import unittest
+
+from cronner import constants
+
+
+class TestAsBool(unittest.TestCase):
+    """A suite of test cases for the ``_as_bool`` function"""
+    def test_false_string(self):
+        """``_as_bool`` treats the string 'False' as False"""
+        self.assertFalse(constants._as_bool('False'))
+
+    def test_true_string(self):
+        """``_as_bool`` treats the string 'true' as True"""
+        self.assertTrue(constants._as_bool('true'))
+
+    def test_one(self):
+        """``_as_bool`` treats the string '1' as True"""
+        self.assertTrue(constants._as_bool('1'))
+
+    def test_default(self):
+        """``ES_SSL_VERIFY`` is a boolean"""
+        self.assertTrue(isinstance(constants.ES_SSL_VERIFY, bool))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,13 @@
 # -*- coding: UTF-8 -*-
 """A suite of unit tests for the ``elasticsearch`` module"""
 import unittest
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
 from unittest.mock import patch, MagicMock
 
+import requests
+from requests.adapters import HTTPAdapter
+
 from cronner import elasticsearch as es
 
 @patch('cronner.elasticsearch.logger')
@@ -10,6 +15,10 @@ from cronner import elasticsearch as es
 @patch('cronner.elasticsearch._call_es')
 class TestPruneIndexes(unittest.TestCase):
     """A suite of test cases for the ``prune_indices`` function"""
+    def setUp(self):
+        """Runs before every test case"""
+        es._indices_cache['value'] = None
+
     def test_no_prune(self, fake_call_es, fake_get_indices, fake_logger):
         """``prune_indices`` only deletes an index when there are too many"""
         fake_get_indices.return_value = {'logs-2016.05.12', 'logs-2016.01.01'}
@@ -21,6 +30,25 @@ class TestPruneIndexes(unittest.TestCase):
 
         self.assertEqual(deleted, expected)
 
+    def test_no_prune_cached(self, fake_call_es, fake_get_indices, fake_logger):
+        """``prune_indices`` doesn't query ElasticSearch if the recently cached indices are under the max"""
+        es._indices_cache['value'] = {'logs-2016.05.12', 'logs-2016.01.01'}
+        es._indices_cache['ts'] = es.time.monotonic()
+
+        es.prune_indices(max_log_records=100)
+
+        self.assertFalse(fake_get_indices.called)
+
+    def test_prune_stale_cache(self, fake_call_es, fake_get_indices, fake_logger):
+        """``prune_indices`` queries ElasticSearch if the cached indices are too old"""
+        fake_get_indices.return_value = {'logs-2016.05.12', 'logs-2016.01.01'}
+        es._indices_cache['value'] = {'logs-2016.05.12', 'logs-2016.01.01'}
+        es._indices_cache['ts'] = es.time.monotonic() - es.PRUNE_SKIP_TTL - 1
+
+        es.prune_indices(max_log_records=100)
+
+        self.assertTrue(fake_get_indices.called)
+
     def test_prune_oldes(self, fake_call_es, fake_get_indices, fake_logger):
         """``prune_indices`` deletes the oldest index"""
         fake_get_indices.return_value = {'logs-2016.05.12', 'logs-2016.01.01'}
@@ -29,10 +57,93 @@ class TestPruneIndexes(unittest.TestCase):
 
         the_args, _ = fake_call_es.call_args
         delete_url = the_args[0]
-        expected = 'https://vlab-data.emc.com:9200/logs-2016.01.01'
+        expected = '{}:{}/logs-2016.01.01'.format(es.ES_URL, es.ES_PORT)
+
+        self.assertEqual(delete_url, expected)
+
+    def test_prune_many(self, fake_call_es, fake_get_indices, fake_logger):
+        """``prune_indices`` deletes several indices with a single call"""
+        fake_get_indices.return_value = {'logs-2016.05.12', 'logs-2016.01.01', 'logs-2016.02.01'}
+
+        es.prune_indices(max_log_records=1)
+
+        the_args, _ = fake_call_es.call_args
+        delete_url = the_args[0]
+        expected = '{}:{}/logs-2016.01.01,logs-2016.02.01'.format(es.ES_URL, es.ES_PORT)
+
+        self.assertEqual(fake_call_es.call_count, 1)
+        self.assertEqual(delete_url, expected)
+
+    def test_prune_across_years(self, fake_call_es, fake_get_indices, fake_logger):
+        """``prune_indices`` knows that December is older than the following January"""
+        fake_get_indices.return_value = {'logs-2017.01.02', 'logs-2016.12.31', 'logs-2017.01.01'}
+
+        es.prune_indices(max_log_records=2)
+
+        the_args, _ = fake_call_es.call_args
+        delete_url = the_args[0]
+        expected = '{}:{}/logs-2016.12.31'.format(es.ES_URL, es.ES_PORT)
+
+        self.assertEqual(delete_url, expected)
+
+    def test_prune_only_logs(self, fake_call_es, fake_get_indices, fake_logger):
+        """``prune_indices`` ignores indices that are not daily log indices"""
+        fake_get_indices.return_value = {'.kibana', 'logs-2016.05.12', 'logs-2016.01.01'}
+
+        es.prune_indices(max_log_records=1)
+
+        the_args, _ = fake_call_es.call_args
+        delete_url = the_args[0]
+        expected = '{}:{}/logs-2016.01.01'.format(es.ES_URL, es.ES_PORT)
 
         self.assertEqual(delete_url, expected)
 
+    def test_prune_only_logs_counted(self, fake_call_es, fake_get_indices, fake_logger):
+        """``prune_indices`` doesn't count non-log indices toward the max"""
+        fake_get_indices.return_value = {'.kibana', 'logs-2016.05.12', 'logs-2016.01.01'}
+
+        es.prune_indices(max_log_records=2)
+
+        self.assertFalse(fake_call_es.called)
+
+    @patch.object(es, 'MAX_INDICES_PER_CALL', 2)
+    def test_prune_chunks(self, fake_call_es, fake_get_indices, fake_logger):
+        """``prune_indices`` splits up the indices to delete so the URL doesn't get too long"""
+        fake_get_indices.return_value = {'logs-2016.05.12', 'logs-2016.01.01',
+                                         'logs-2016.02.01', 'logs-2016.03.01'}
+
+        es.prune_indices(max_log_records=1)
+
+        calls = fake_call_es.call_count
+        expected = 2
+
+        self.assertEqual(calls, expected)
+
+    def test_prune_not_acknowledged(self, fake_call_es, fake_get_indices, fake_logger):
+        """``prune_indices`` logs when ElasticSearch does not acknowledge the delete"""
+        fake_get_indices.return_value = {'logs-2016.05.12', 'logs-2016.01.01'}
+        fake_resp = MagicMock()
+        fake_resp.ok = True
+        fake_resp.json.return_value = {'acknowledged': False}
+        fake_call_es.return_value = fake_resp
+
+        es.prune_indices(max_log_records=1)
+
+        self.assertEqual(fake_logger.error.call_count, 1)
+
+    def test_prune_clears_cache(self, fake_call_es, fake_get_indices, fake_logger):
+        """``prune_indices`` invalidates the cached set of indices after deleting some"""
+        fake_get_indices.return_value = {'logs-2016.05.12', 'logs-2016.01.01'}
+        fake_resp = MagicMock()
+        fake_resp.ok = True
+        fake_resp.json.return_value = {'acknowledged': True}
+        fake_call_es.return_value = fake_resp
+        es._indices_cache['value'] = {'logs-2016.05.12', 'logs-2016.01.01'}
+
+        es.prune_indices(max_log_records=1)
+
+        self.assertTrue(es._indices_cache['value'] is None)
+
     def test_prune_error(self, fake_call_es, fake_get_indices, fake_logger):
         """``prune_indices`` logs failures to delete an index"""
         fake_get_indices.return_value = {'logs-2016.05.12', 'logs-2016.01.01'}
@@ -47,6 +158,8 @@ class TestPruneIndexes(unittest.TestCase):
         errors_logged = fake_logger.error.call_count
         expected_errors = 1
 
+        self.assertEqual(errors_logged, expected_errors)
+
     def test_prune_error_msg(self, fake_call_es, fake_get_indices, fake_logger):
         """``prune_indices`` the log message to delete an index contains the index name"""
         fake_get_indices.return_value = {'logs-2016.05.12', 'logs-2016.01.01'}
@@ -70,41 +183,87 @@ class TestPruneIndexes(unittest.TestCase):
 class TestAddFieldData(unittest.TestCase):
     """A suite of test cases for the ``add_field_data`` function"""
     def test_add_field_data(self, fake_call_es, fake_get_indices):
-        """``add_field_data`` updates all indices"""
+        """``add_field_data`` updates all indices with a single call"""
         fake_get_indices.return_value = {'logs-2016.05.12', 'logs-2016.01.01'}
 
         es.add_field_data()
         indexes_updated = fake_call_es.call_count
-        expected = 2
+        expected = 1
 
-        self.assertTrue(indexes_updated, expected)
+        self.assertEqual(indexes_updated, expected)
+
+    def test_add_field_data_url(self, fake_call_es, fake_get_indices):
+        """``add_field_data`` sends the mapping update to every index"""
+        fake_get_indices.return_value = {'logs-2016.05.12', 'logs-2016.01.01'}
+
+        es.add_field_data()
+        the_args, _ = fake_call_es.call_args
+        url = the_args[0]
+        expected = '{}:{}/logs-2016.01.01,logs-2016.05.12/_mapping/web'.format(es.ES_URL, es.ES_PORT)
+
+        self.assertEqual(url, expected)
 
     @patch.object(es, 'logger')
     def test_add_field_data_error(self, fake_logger, fake_call_es, fake_get_indices):
         """``add_field_data`` logs failures to update an index"""
         fake_get_indices.return_value = {'logs-2016.05.12', 'logs-2016.01.01'}
-        fake_resp1 = MagicMock()
-        fake_resp2 = MagicMock()
-        fake_resp2.ok = False
-        fake_resp2.status_code = 418
-        fake_resp2.content = b"I'm a teapot"
-        fake_call_es.side_effect = [fake_resp1, fake_resp2]
+        fake_resp = MagicMock()
+        fake_resp.ok = False
+        fake_resp.status_code = 418
+        fake_resp.content = b"I'm a teapot"
+        fake_call_es.return_value = fake_resp
+
+        es.add_field_data(per_index_fallback=False)
+        errors_logged = fake_logger.error.call_count
+        expected = 1
+
+        self.assertEqual(errors_logged, expected)
+
+    @patch.object(es, 'logger')
+    def test_add_field_data_fallback(self, fake_logger, fake_call_es, fake_get_indices):
+        """``add_field_data`` retries each index on its own if the multi-index update fails"""
+        fake_get_indices.return_value = {'logs-2016.05.12', 'logs-2016.01.01'}
+        fake_resp = MagicMock()
+        fake_resp.ok = False
+        fake_resp.status_code = 418
+        fake_resp.content = b"I'm a teapot"
+        fake_call_es.side_effect = [fake_resp, MagicMock(), MagicMock()]
+
+        es.add_field_data()
+        urls = set([x[0][0] for x in fake_call_es.call_args_list[1:]])
+        expected = set(['{}:{}/logs-2016.05.12/_mapping/web'.format(es.ES_URL, es.ES_PORT),
+                        '{}:{}/logs-2016.01.01/_mapping/web'.format(es.ES_URL, es.ES_PORT)])
+
+        self.assertEqual(urls, expected)
+
+    @patch.object(es, 'logger')
+    def test_add_field_data_fallback_error(self, fake_logger, fake_call_es, fake_get_indices):
+        """``add_field_data`` logs failures to update a specific index"""
+        fake_get_indices.return_value = {'logs-2016.05.12', 'logs-2016.01.01'}
+        fake_resp = MagicMock()
+        fake_resp.ok = False
+        fake_resp.status_code = 418
+        fake_resp.content = b"I'm a teapot"
+        fake_call_es.side_effect = [fake_resp, MagicMock(), fake_resp]
 
         es.add_field_data()
         errors_logged = fake_logger.error.call_count
-        expected = 1
+        expected = 2
 
-        self.assertTrue(errors_logged, expected)
+        self.assertEqual(errors_logged, expected)
 
 
 @patch('cronner.elasticsearch._call_es')
 class TestGetIndices(unittest.TestCase):
     """A suite of test cases for the ``_get_indices`` function"""
+    def setUp(self):
+        """Runs before every test case"""
+        es._indices_cache['value'] = None
 
     def test_get_indices(self, fake_call_es):
         """``_get_indices`` Returns the expected set of data"""
         resp = MagicMock()
-        resp.content = b'yellow open logs-2019.04.28 Ei_u-uXRTvyT3QJOYfWEpg 5 1 119376 0 53.6mb 53.6mb\nyellow open logs-2019.05.04 Jytkex9wQkiscV3MzwVUVw 5 1 222043 0 102.4mb 102.4mb\nyellow open logs-2019.05.16 _v_r9Ui4SKCpUn0riLpj5g 5 1 315299 0 146.2mb 146.2mb'
+        resp.content = b'[{"index":"logs-2019.04.28"},{"index":"logs-2019.05.04"},{"index":"logs-2019.05.16"}]'
         fake_call_es.return_value = resp
 
         indices = es._get_indices()
@@ -112,19 +271,161 @@ class TestGetIndices(unittest.TestCase):
 
         self.assertEqual(indices, expected)
 
+    def test_get_indices_url(self, fake_call_es):
+        """``_get_indices`` only asks ElasticSearch for the names of the indices"""
+        fake_call_es.return_value.content = b'[]'
+
+        es._get_indices()
+        the_args, _ = fake_call_es.call_args
+        url = the_args[0]
+        expected = '{}:{}/_cat/indices?format=json&h=index'.format(es.ES_URL, es.ES_PORT)
+
+        self.assertEqual(url, expected)
+
+    def test_get_indices_cached(self, fake_call_es):
+        """``_get_indices`` only queries ElasticSearch once within the TTL"""
+        resp = MagicMock()
+        resp.content = b'[{"index":"logs-2019.04.28"}]'
+        fake_call_es.return_value = resp
+
+        es._get_indices()
+        es._get_indices()
+        calls = fake_call_es.call_count
+        expected = 1
+
+        self.assertEqual(calls, expected)
+
+    def test_get_indices_expired(self, fake_call_es):
+        """``_get_indices`` queries ElasticSearch again once the TTL expires"""
+        resp = MagicMock()
+        resp.content = b'[{"index":"logs-2019.04.28"}]'
+        fake_call_es.return_value = resp
+
+        es._get_indices()
+        es._get_indices(ttl=0)
+        calls = fake_call_es.call_count
+        expected = 2
+
+        self.assertEqual(calls, expected)
+
 
 class TestCallEs(unittest.TestCase):
     """A suite of test cases for the ``_call_es`` function"""
-    @patch.object(es, 'requests')
-    def test_call_es(self, fake_requests):
+    @patch.object(es, '_session')
+    def test_call_es(self, fake_session):
         """``_call_es`` Returns a Response object"""
         fake_resp = MagicMock()
-        fake_requests.get.return_value = fake_resp
+        fake_session.get.return_value = fake_resp
 
         resp = es._call_es('https://some.es.server:9200')
 
         self.assertTrue(resp is fake_resp)
 
+    @patch.object(es, '_session')
+    def test_call_es_method(self, fake_session):
+        """``_call_es`` uses the shared session for the requested HTTP method"""
+        es._call_es('https://some.es.server:9200/logs-2019.05.16', method='delete')
+
+        self.assertTrue(fake_session.delete.called)
+
+    @patch.object(es, '_session')
+    def test_call_es_json(self, fake_session):
+        """``_call_es`` serializes the JSON payload"""
+        es._call_es('https://some.es.server:9200', method='put', json={'some': 'data'})
+
+        _, the_kwargs = fake_session.put.call_args
+        sent = the_kwargs['data']
+        expected = b'{"some":"data"}'
+
+        self.assertEqual(sent, expected)
+
+    @patch.object(es, '_session')
+    def test_call_es_json_header(self, fake_session):
+        """``_call_es`` sets the Content-Type when sending JSON"""
+        es._call_es('https://some.es.server:9200', method='put', json={'some': 'data'})
+
+        _, the_kwargs = fake_session.put.call_args
+        content_type = the_kwargs['headers']['Content-Type']
+        expected = 'application/json'
+
+        self.assertEqual(content_type, expected)
+
+    def test_session_retries(self):
+        """``_session`` retries requests that hit a transient server error"""
+        adapter = es._session.get_adapter('https://some.es.server:9200')
+        status_forcelist = adapter.max_retries.status_forcelist
+        expected = (502, 503, 504)
+
+        self.assertEqual(status_forcelist, expected)
+
+    def test_session_retries_return_response(self):
+        """``_session`` hands back the last response once the retries run out, instead of raising"""
+        adapter = es._session.get_adapter('https://some.es.server:9200')
+
+        self.assertFalse(adapter.max_retries.raise_on_status)
+
+    def test_session_auth(self):
+        """``_session`` sends the Basic Auth creds on every request"""
+        expected = (es.ES_USERNAME, es.ES_PASSWORD)
+
+        self.assertEqual(es._session.auth, expected)
+
+
+class AlwaysUnavailable(BaseHTTPRequestHandler):
+    """An ElasticSearch server that's always too busy to answer"""
+    def _unavailable(self):
+        self.send_response(503)
+        self.send_header('Content-Length', '4')
+        self.end_headers()
+        self.wfile.write(b'busy')
+
+    do_GET = do_PUT = do_DELETE = _unavailable
+
+    def log_message(self, *args):
+        pass
+
+
+@patch.object(es, 'logger')
+class TestRetriesExhausted(unittest.TestCase):
+    """A suite of test cases for when ElasticSearch keeps returning a 503"""
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), AlwaysUnavailable)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        # Same retry policy as the real session, just without the backoff sleeps
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(max_retries=es._RETRY.new(backoff_factor=0)))
+        base = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        patches = [patch.object(es, '_session', session),
+                   patch.object(es, '_BASE', base),
+                   patch.object(es, '_get_indices', return_value={'logs-2019.05.16'}),
+                   patch.dict(es._indices_cache, {'ts': 0.0, 'value': None})]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_add_field_data(self, fake_logger):
+        """``add_field_data`` logs the failure, instead of raising, once the retries run out"""
+        es.add_field_data()
+
+        self.assertEqual(fake_logger.error.call_count, 2)
+
+    def test_prune_indices(self, fake_logger):
+        """``prune_indices`` logs the failure, instead of raising, once the retries run out"""
+        es.prune_indices(max_log_records=0)
+
+        the_args, _ = fake_logger.error.call_args
+
+        self.assertTrue('Status: 503' in the_args[0])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -6,26 +6,54 @@ from unittest.mock import patch
 from cronner import main
 
 
+@patch.object(main, 'schedule')
+@patch.object(main.time, 'sleep')
 class TestMain(unittest.TestCase):
     """A suite of test cases for the ``main`` function"""
-    @patch.object(main, 'schedule')
-    @patch.object(main.time, 'sleep')
-    def test_main(self, fake_sleep, fake_schedule):
-        """``main`` sleeps for 1 second in between running pending jobs"""
+    def _run(self, fake_sleep):
+        # only way to break the while True loop is raise an exception
         fake_sleep.side_effect = [NotImplementedError('testing')]
-
         try:
             main.main()
         except NotImplementedError:
             pass
-
         the_args, _ = fake_sleep.call_args
-        slept_for = the_args[0]
-        expected = 1
+        return the_args[0]
+
+    def test_main(self, fake_sleep, fake_schedule):
+        """``main`` sleeps until the next job is due"""
+        fake_schedule.idle_seconds.return_value = 42
+
+        slept_for = self._run(fake_sleep)
+        expected = 42
 
         self.assertEqual(slept_for, expected)
         self.assertTrue(fake_schedule.run_pending.called)
 
+    def test_main_max_sleep(self, fake_sleep, fake_schedule):
+        """``main`` never sleeps for more than MAX_SLEEP"""
+        fake_schedule.idle_seconds.return_value = 600
+
+        slept_for = self._run(fake_sleep)
+
+        self.assertEqual(slept_for, main.MAX_SLEEP)
+
+    def test_main_min_sleep(self, fake_sleep, fake_schedule):
+        """``main`` sleeps for at least MIN_SLEEP, even when a job is overdue"""
+        fake_schedule.idle_seconds.return_value = -5
+
+        slept_for = self._run(fake_sleep)
+
+        self.assertEqual(slept_for, main.MIN_SLEEP)
+
+    def test_main_no_jobs(self, fake_sleep, fake_schedule):
+        """``main`` sleeps for MAX_SLEEP when no jobs are scheduled"""
+        fake_schedule.idle_seconds.return_value = None
+
+        slept_for = self._run(fake_sleep)
+
+        self.assertEqual(slept_for, main.MAX_SLEEP)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -23,11 +23,18 @@ class TestGetLogger(unittest.TestCase):
         logger1 = std_logger.get_logger('many_loggers')
         logger2 = std_logger.get_logger('many_loggers')
 
-        handlers = len(logger2.handlers)
+        handlers = len(logger2.logger.handlers)
         expected = 1
 
         self.assertEqual(handlers, expected)
 
+    def test_get_logger_cached(self):
+        """``get_logger`` returns the same object when called with the same name"""
+        logger1 = std_logger.get_logger('cached_logger')
+        logger2 = std_logger.get_logger('cached_logger')
+
+        self.assertTrue(logger1 is logger2)
+
     def test_get_logger_contains(self):
         """``get_logger`` contains the worker name in the log messages"""
         log = std_logger.get_logger(name='wootWorker')
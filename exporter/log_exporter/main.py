@@ -2,17 +2,54 @@
 """Take the logs from a running Docker container and send them to Kafka for processing"""
 import os
 import time
+import hashlib
 import logging
 import threading
+from functools import lru_cache
 
 import ujson
 import docker
 from kafka import KafkaProducer
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from setproctitle import setproctitle
 
-LOOP_INTERVAL = 10
+LOOP_INTERVAL = int(os.environ.get('LOG_EXPORTER_LOOP_INTERVAL', 60)) # seconds; how often to double check every container has an exporter
 CIPHER_KEY_FILE = '/etc/vlab/log_sender.key'
+# Either 'fernet' or 'aesgcm'; the log processors must be set to the same value
+LOG_CIPHER = os.environ.get('LOG_CIPHER', 'fernet')
+# Maps the "style" of log a container makes to the Kafka topic for that style
+TOPICS = {'api': 'web', 'worker': 'worker', 'dns': 'dns', 'ntp': 'ntp'}
+# The Docker events that mean we (might) need to create/remove an exporter
+EVENT_FILTERS = {'type': 'container', 'event': ['start', 'die', 'destroy']}
+# Attaching (without 'logs') only streams output made from now on, like logs(since=<now>)
+ATTACH_PARAMS = {'stdout': 1, 'stderr': 1, 'stream': 1}
+READ_SIZE = 65536 # bytes; how much to read off a container's log socket at a time
+FRAME_HEADER = 8 # bytes; the header on each frame of output from a non-TTY container
+
+
+class AESGCMCipher:
+    """Encrypts log messages with AES-GCM, which is a single AEAD pass (and
+    uses AES-NI) instead of Fernet's AES-CBC + HMAC + base64.
+
+    The random 12 byte nonce is prepended to the ciphertext.
+
+    :param key: The shared secret; it's hashed into a 256 bit AES key
+    :type key: Bytes
+    """
+    def __init__(self, key):
+        self._aead = AESGCM(hashlib.sha256(key).digest())
+
+    def encrypt(self, data):
+        """Encrypt the supplied bytes
+
+        :Returns: Bytes
+
+        :param data: The plain text to encrypt
+        :type data: Bytes
+        """
+        nonce = os.urandom(12)
+        return nonce + self._aead.encrypt(nonce, data, None)
 
 
 class Exporter(threading.Thread):
@@ -27,36 +64,141 @@ class Exporter(threading.Thread):
         self.cipher = self._get_cipher(cipher_file)
 
     def _get_kafka_conn(self, server, retries):
-        conn = KafkaProducer(bootstrap_servers=server, retries=retries)
+        # ``send`` only queues the message; the producer batches them up for
+        # ``linger_ms`` so chatty containers don't make a request per log line
+        conn = KafkaProducer(bootstrap_servers=server,
+                             retries=retries,
+                             linger_ms=50,
+                             batch_size=65536)
         return conn
 
     def _get_cipher(self, cipher_file):
         with open(cipher_file, 'rb') as the_file:
             key = the_file.read().strip()
-        cipher = Fernet(key)
+        if LOG_CIPHER == 'aesgcm':
+            cipher = AESGCMCipher(key)
+        else:
+            cipher = Fernet(key)
         return cipher
 
     def run(self):
         """This method is evoked after calling ``start``"""
         try:
             lines = []
-            for line in self.container.logs(follow=True, stream=True, since=int(time.time())):
-                if line.startswith(b' ') or len(lines) == 0:
-                    lines.append(line)
-                    continue
-                else:
-                    payload = {'name' : self.container.name, 'log' : b''.join(lines)}
-                    message = self.cipher.encrypt(ujson.dumps(payload).encode())
-                    self.conn.send(self.topic, message)
-                    lines = [line]
+            for new_lines in self._read_lines():
+                for line in new_lines:
+                    if line.startswith(b' ') or len(lines) == 0:
+                        lines.append(line)
+                        continue
+                    else:
+                        self._send(lines)
+                        lines = [line]
+            # the log stream ended (i.e. the container stopped); don't drop the last message
+            if lines:
+                self._send(lines)
         except Exception as doh:
             self.log.exception(doh)
         finally:
             self.log.info('Exporter for {} terminating'.format(self.container.name))
             self.conn.close()
 
+    def _read_lines(self):
+        """Read the container's output straight off the attach socket.
+
+        Going through ``container.logs`` costs a couple of generators and a
+        decode per frame; this yields every complete line (newline included)
+        from each large read instead.
+
+        :Returns: Generator (of Lists)
+        """
+        sock = self.container.attach_socket(params=ATTACH_PARAMS)
+        try:
+            if hasattr(sock, 'recv'):
+                # TLS; the raw file descriptor would give us cipher text
+                read = sock.recv
+            else:
+                fd = sock.fileno()
+                read = lambda size: os.read(fd, size)
+            tty = self.container.attrs['Config']['Tty']
+            frames = bytearray()
+            output = bytearray()
+            while True:
+                chunk = read(READ_SIZE)
+                if not chunk:
+                    break
+                if tty:
+                    output += chunk
+                else:
+                    frames += chunk
+                    demux_frames(frames, output)
+                lines = split_lines(output)
+                if lines:
+                    yield lines
+            if output:
+                yield [bytes(output)]
+        finally:
+            sock.close()
+
+    def _send(self, lines):
+        """Encrypt a (multi-line) log message, and hand it off to the Kafka producer
+
+        :Returns: None
+
+        :param lines: The lines that make up a single log message
+        :type lines: List
+        """
+        payload = {'name' : self.container.name, 'log' : b''.join(lines).decode(errors='replace')}
+        message = self.cipher.encrypt(ujson.dumps(payload).encode())
+        self.conn.send(self.topic, message)
+
+
+def demux_frames(frames, output):
+    """Move the log output out of complete stream frames, leaving any partial frame.
+
+    The output of a container without a TTY is sent as frames with an 8 byte
+    header; a byte for stdout/stderr, 3 bytes of padding, and the big-endian
+    length of the frame's payload.
 
-def respawn_workers(client, workers, kafka_server, log):
+    :Returns: None
+
+    :param frames: The raw bytes read from the attach socket
+    :type frames: bytearray
+
+    :param output: The log output that's been pulled out of the frames so far
+    :type output: bytearray
+    """
+    offset = 0
+    available = len(frames)
+    while available - offset >= FRAME_HEADER:
+        size = int.from_bytes(frames[offset + 4:offset + FRAME_HEADER], 'big')
+        end = offset + FRAME_HEADER + size
+        if end > available:
+            break
+        output += frames[offset + FRAME_HEADER:end]
+        offset = end
+    del frames[:offset]
+
+
+def split_lines(output):
+    """Remove every complete line from the log output, leaving any partial line.
+
+    :Returns: List
+
+    :param output: The log output read from a container
+    :type output: bytearray
+    """
+    lines = []
+    start = 0
+    end = output.find(b'\n')
+    while end != -1:
+        lines.append(bytes(output[start:end + 1]))
+        start = end + 1
+        end = output.find(b'\n', start)
+    del output[:start]
+    return lines
+
+
+def respawn_workers(containers, workers, kafka_server, log):
     """Compaire the active exporter threads with active docker containers, and
     re-create any exporter threads as needed.
 
@@ -66,8 +208,8 @@ def respawn_workers(client, workers, kafka_server, log):
 
     :Returns: Dictionary
 
-    :param client: The docker client
-    :type client: docker.client.DockerClient
+    :param containers: The running containers, from ``client.containers.list()``
+    :type containers: List
 
     :param workers: A mapping of container names to active log exporter threads
     :type workers: Dictionary
@@ -78,31 +220,25 @@ def respawn_workers(client, workers, kafka_server, log):
     :param log: An object for logging (yo dawg)
     :type log: logging.Logger
     """
-    alive = {x.name: x for x in client.containers.list()}
+    alive = {x.name: x for x in containers}
     for container_name, worker in workers.items():
         if not worker.is_alive():
             alive_container = alive.get(container_name, None)
             if alive_container:
-                topic = get_topic(container_name)
-                respawned = Exporter(container=alive_container,
-                                     topic=topic,
-                                     server=kafka_server,
-                                     log=log)
-                respawned.start()
-                workers[container_name] = respawned
+                workers = spawn_worker_for(alive_container, workers, kafka_server, log)
                 del worker
             else:
                 log.info('No alive container for {}'.format(container_name))
     return workers
 
 
-def spawn_workers(client, workers, kafka_server, log):
+def spawn_workers(containers, workers, kafka_server, log):
     """Creates a log exporting thread for each active container
 
     :Returns: Dictionary
 
-    :param client: The docker client
-    :type client: docker.client.DockerClient
+    :param containers: The running containers, from ``client.containers.list()``
+    :type containers: List
 
     :param workers: A mapping of container names to active log exporter threads
     :type workers: Dictionary
@@ -113,20 +249,81 @@ def spawn_workers(client, workers, kafka_server, log):
     :param log: An object for logging (yo dawg)
     :type log: logging.Logger
     """
-    for container in client.containers.list():
+    for container in containers:
         active_exporter = workers.get(container.name, None)
         if not active_exporter:
-            log.info('Spawning exporter for: {}'.format(container.name))
-            topic = get_topic(container.name)
-            new_worker = Exporter(container=container,
-                                  topic=topic,
-                                  server=kafka_server,
-                                  log=log)
-            new_worker.start()
-            workers[container.name] = new_worker
+            workers = spawn_worker_for(container, workers, kafka_server, log)
     return workers
 
 
+def spawn_worker_for(container, workers, kafka_server, log):
+    """Create (or replace) the log exporting thread for a single container
+
+    :Returns: Dictionary
+
+    :param container: The container to export logs from
+    :type container: docker.models.containers.Container
+
+    :param workers: A mapping of container names to active log exporter threads
+    :type workers: Dictionary
+
+    :param kafka_server: The <address:port> of the Kafka server to upload logs to
+    :type kafka_server: String
+
+    :param log: An object for logging (yo dawg)
+    :type log: logging.Logger
+    """
+    log.info('Spawning exporter for: {}'.format(container.name))
+    topic = get_topic(container.name)
+    new_worker = Exporter(container=container,
+                          topic=topic,
+                          server=kafka_server,
+                          log=log)
+    new_worker.start()
+    workers[container.name] = new_worker
+    return workers
+
+
+def handle_event(client, event, workers, kafka_server, log):
+    """Create or forget a log exporting thread based on a Docker container event
+
+    :Returns: Dictionary
+
+    :param client: The docker client
+    :type client: docker.client.DockerClient
+
+    :param event: The decoded Docker event; one of ``EVENT_FILTERS``
+    :type event: Dictionary
+
+    :param workers: A mapping of container names to active log exporter threads
+    :type workers: Dictionary
+
+    :param kafka_server: The <address:port> of the Kafka server to upload logs to
+    :type kafka_server: String
+
+    :param log: An object for logging (yo dawg)
+    :type log: logging.Logger
+    """
+    container_name = event['Actor']['Attributes']['name']
+    if event['Action'] == 'start':
+        active_exporter = workers.get(container_name, None)
+        if not (active_exporter and active_exporter.is_alive()):
+            try:
+                container = client.containers.get(event['id'])
+            except docker.errors.NotFound:
+                # It exited and got removed before we got to it; its 'die' and
+                # 'destroy' events are next in the stream
+                log.info('Container {} is already gone'.format(container_name))
+                return workers
+            workers = spawn_worker_for(container, workers, kafka_server, log)
+    else:
+        # The exporter thread terminates on its own once the log stream closes;
+        # forgetting it means a restarted container gets a new exporter.
+        workers.pop(container_name, None)
+    return workers
+
+
+@lru_cache(maxsize=512)
 def get_topic(container_name):
     """Obtain the correct Kafka topic to use when forwarding logs
 
@@ -147,19 +344,7 @@ def get_topic(container_name):
         log_style = log_group.split('-')[1]
     except IndexError:
         log_style = log_group
-
-    topic = ""
-    if log_style == 'api':
-        topic = 'web'
-    elif log_style == 'worker':
-        topic = 'worker'
-    elif log_style == 'dns':
-        topic = 'dns'
-    elif log_style == 'ntp':
-        topic = 'ntp'
-    else:
-        topic = 'other'
-    return topic
+    return TOPICS.get(log_style, 'other')
 
 
 def get_logger(name, loglevel='INFO'):
@@ -190,16 +375,24 @@ def main():
     client = docker.from_env()
     kafka_server = os.environ.get('KAFKA_SERVER', '127.0.0.1:9092')
     log.info('vLab log Exporter starting')
+    log.info('Loop interval: {} seconds'.format(LOOP_INTERVAL))
+    log.info('Log cipher: {}'.format(LOG_CIPHER))
     log.info('Docker info:\n{}'.format(client.version()))
     workers = {}
     while True:
-        loop_start = time.time()
-        workers = spawn_workers(client, workers, kafka_server, log)
-        workers = respawn_workers(client, workers, kafka_server, log)
-        spawn_time = max(0, time.time() - loop_start)
-        delta = LOOP_INTERVAL - spawn_time
-        sleep_for = max(0, delta)
-        time.sleep(sleep_for)
+        since = int(time.time())
+        # Catch anything the event stream might have missed
+        # One trip to the Docker API per loop, instead of one per function
+        containers = client.containers.list()
+        workers = spawn_workers(containers, workers, kafka_server, log)
+        workers = respawn_workers(containers, workers, kafka_server, log)
+        # The stream ends at ``until``, which lets us loop back to double checking
+        events = client.events(since=since,
+                               until=since + LOOP_INTERVAL,
+                               filters=EVENT_FILTERS,
+                               decode=True)
+        for event in events:
+            workers = handle_event(client, event, workers, kafka_server, log)
 
 
 if __name__ == '__main__':
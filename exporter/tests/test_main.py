@@ -1,10 +1,13 @@
 # -*- coding: UTF-8 -*-
 """A suite of unit tests for the log_exporter/main.py logic"""
+import os
 import builtins
+import importlib
 import unittest
 from unittest.mock import patch, MagicMock
 import logging
 
+import docker
 
 from log_exporter import main
 
@@ -14,7 +17,17 @@ class TestStaticVars(unittest.TestCase):
     def test_loop_interval(self):
         """LOOP_INTERVAL value has not changed"""
         found = main.LOOP_INTERVAL
-        expected = 10 # seconds
+        expected = 60 # seconds
+
+        self.assertEqual(found, expected)
+
+    def test_loop_interval_env(self):
+        """LOOP_INTERVAL can be set via the LOG_EXPORTER_LOOP_INTERVAL environment variable"""
+        with patch.dict(os.environ, {'LOG_EXPORTER_LOOP_INTERVAL': '300'}):
+            importlib.reload(main)
+        found = main.LOOP_INTERVAL
+        importlib.reload(main)
+        expected = 300
 
         self.assertEqual(found, expected)
 
@@ -47,56 +60,158 @@ class TestGetLogger(unittest.TestCase):
 
         self.assertEqual(handlers, expected)
 
+@patch.object(main, 'respawn_workers')
+@patch.object(main, 'spawn_workers')
+@patch.object(main, 'get_logger')
+@patch.object(main.docker, 'from_env')
 class TestMain(unittest.TestCase):
     """A suite of test cases for the ``main`` function"""
-    @patch.object(main, 'get_logger')
-    @patch.object(main.docker, 'from_env')
-    @patch.object(main.time, 'sleep')
-    def test_main(self, fake_sleep, fake_from_env, fake_get_logger):
-        """``main`` sleeps for less than LOOP_INTERVAL"""
+    def test_main(self, fake_from_env, fake_get_logger, fake_spawn_workers, fake_respawn_workers):
+        """``main`` creates exporters for running containers before watching events"""
         # only way to break the while True loop is raise an exception
-        fake_sleep.side_effect = RuntimeError('breaking loop')
+        fake_from_env.return_value.events.side_effect = RuntimeError('breaking loop')
+        with self.assertRaises(RuntimeError):
+            main.main()
+
+        self.assertTrue(fake_spawn_workers.called)
+        self.assertTrue(fake_respawn_workers.called)
+
+    def test_main_lists_once(self, fake_from_env, fake_get_logger, fake_spawn_workers, fake_respawn_workers):
+        """``main`` lists the running containers once per loop, and shares that list"""
+        fake_from_env.return_value.events.side_effect = RuntimeError('breaking loop')
         with self.assertRaises(RuntimeError):
             main.main()
 
-        call_args, _ = fake_sleep.call_args
-        slept_for = call_args[0]
+        containers = fake_from_env.return_value.containers.list.return_value
+        spawn_args, _ = fake_spawn_workers.call_args
+        respawn_args, _ = fake_respawn_workers.call_args
 
-        self.assertTrue(main.LOOP_INTERVAL > slept_for)
+        self.assertEqual(fake_from_env.return_value.containers.list.call_count, 1)
+        self.assertTrue(spawn_args[0] is containers)
+        self.assertTrue(respawn_args[0] is containers)
 
-    @patch.object(main.time, 'time')
-    @patch.object(main, 'get_logger')
-    @patch.object(main.docker, 'from_env')
-    @patch.object(main.time, 'sleep')
-    def test_main_slow_spawn(self, fake_sleep, fake_from_env, fake_get_logger, fake_time):
-        """``main`` doesn't sleep if it took more than LOOP_INTERVAL to spawn/respawn workers"""
-        fake_time.side_effect = [100, 200]
-        fake_sleep.side_effect = RuntimeError('breaking loop')
+    def test_main_events_until(self, fake_from_env, fake_get_logger, fake_spawn_workers, fake_respawn_workers):
+        """``main`` only watches the event stream for LOOP_INTERVAL seconds at a time"""
+        fake_from_env.return_value.events.side_effect = RuntimeError('breaking loop')
         with self.assertRaises(RuntimeError):
             main.main()
 
-        call_args, _ = fake_sleep.call_args
-        slept_for = call_args[0]
-        expected = 0
+        _, the_kwargs = fake_from_env.return_value.events.call_args
+        watched_for = the_kwargs['until'] - the_kwargs['since']
 
-        self.assertEqual(slept_for, expected)
+        self.assertEqual(watched_for, main.LOOP_INTERVAL)
 
-    @patch.object(main.time, 'time')
-    @patch.object(main, 'get_logger')
-    @patch.object(main.docker, 'from_env')
-    @patch.object(main.time, 'sleep')
-    def test_main_wonky_clock(self, fake_sleep, fake_from_env, fake_get_logger, fake_time):
-        """``main`` doesn't sleep for more than LOOP_INTERVAL, even if someone adjusts the system clock"""
-        fake_time.side_effect = [300, 200]
-        fake_sleep.side_effect = RuntimeError('breaking loop')
+    def test_main_events_filter(self, fake_from_env, fake_get_logger, fake_spawn_workers, fake_respawn_workers):
+        """``main`` only watches for container events it cares about"""
+        fake_from_env.return_value.events.side_effect = RuntimeError('breaking loop')
         with self.assertRaises(RuntimeError):
             main.main()
 
-        call_args, _ = fake_sleep.call_args
-        slept_for = call_args[0]
-        expected = 10
+        _, the_kwargs = fake_from_env.return_value.events.call_args
+        filters = the_kwargs['filters']
+
+        self.assertEqual(filters, main.EVENT_FILTERS)
+
+    @patch.object(main, 'handle_event')
+    def test_main_handles_events(self, fake_handle_event, fake_from_env, fake_get_logger,
+                                 fake_spawn_workers, fake_respawn_workers):
+        """``main`` handles every event from the stream"""
+        event = {'Action': 'start', 'id': 'abc', 'Actor': {'Attributes': {'name': 'vlab_dns_1'}}}
+        fake_from_env.return_value.events.side_effect = [[event, event], RuntimeError('breaking loop')]
+        with self.assertRaises(RuntimeError):
+            main.main()
+
+        handled = fake_handle_event.call_count
+        expected = 2
+
+        self.assertEqual(handled, expected)
+
+    @patch.object(main, 'spawn_worker_for')
+    def test_main_container_removed(self, fake_spawn_worker_for, fake_from_env, fake_get_logger,
+                                    fake_spawn_workers, fake_respawn_workers):
+        """``main`` keeps going when a container is removed right after it starts"""
+        fake_from_env.return_value.containers.get.side_effect = docker.errors.NotFound('testing')
+        events = [{'Action': action, 'id': 'abc', 'Actor': {'Attributes': {'name': 'vlab_dns_1'}}}
+                  for action in ('start', 'die', 'destroy')]
+        fake_from_env.return_value.events.side_effect = [events, RuntimeError('breaking loop')]
+        with self.assertRaises(RuntimeError) as caught:
+            main.main()
+
+        self.assertEqual(str(caught.exception), 'breaking loop')
+        self.assertFalse(fake_spawn_worker_for.called)
+
+
+@patch.object(main, 'spawn_worker_for')
+class TestHandleEvent(unittest.TestCase):
+    """A suite of test cases for the ``handle_event`` function"""
+    @staticmethod
+    def _make_event(action):
+        return {'Action': action, 'id': 'abc123', 'Actor': {'Attributes': {'name': 'vlab_dns_1'}}}
+
+    def test_start(self, fake_spawn_worker_for):
+        """``handle_event`` creates an exporter when a container starts"""
+        fake_client = MagicMock()
+        log = MagicMock()
+
+        main.handle_event(fake_client, self._make_event('start'), {}, '127.0.0.1:9092', log)
+
+        self.assertTrue(fake_spawn_worker_for.called)
+
+    def test_start_active(self, fake_spawn_worker_for):
+        """``handle_event`` doesn't create a duplicate exporter for a container"""
+        fake_client = MagicMock()
+        log = MagicMock()
+        fake_exporter = MagicMock()
+        fake_exporter.is_alive.return_value = True
+        workers = {'vlab_dns_1': fake_exporter}
+
+        main.handle_event(fake_client, self._make_event('start'), workers, '127.0.0.1:9092', log)
+
+        self.assertFalse(fake_spawn_worker_for.called)
+
+    def test_start_dead(self, fake_spawn_worker_for):
+        """``handle_event`` replaces a dead exporter when the container starts again"""
+        fake_client = MagicMock()
+        log = MagicMock()
+        fake_exporter = MagicMock()
+        fake_exporter.is_alive.return_value = False
+        workers = {'vlab_dns_1': fake_exporter}
+
+        main.handle_event(fake_client, self._make_event('start'), workers, '127.0.0.1:9092', log)
+
+        self.assertTrue(fake_spawn_worker_for.called)
+
+    def test_start_already_removed(self, fake_spawn_worker_for):
+        """``handle_event`` ignores the start of a container that's already been removed"""
+        fake_client = MagicMock()
+        fake_client.containers.get.side_effect = docker.errors.NotFound('testing')
+        log = MagicMock()
+        workers = {'vlab_ntp_1': MagicMock()}
+
+        output = main.handle_event(fake_client, self._make_event('start'), workers, '127.0.0.1:9092', log)
+
+        self.assertTrue(output is workers)
+        self.assertEqual(list(output.keys()), ['vlab_ntp_1'])
+        self.assertFalse(fake_spawn_worker_for.called)
+
+    def test_die(self, fake_spawn_worker_for):
+        """``handle_event`` forgets the exporter of a container that stopped"""
+        fake_client = MagicMock()
+        log = MagicMock()
+        workers = {'vlab_dns_1': MagicMock()}
+
+        workers = main.handle_event(fake_client, self._make_event('die'), workers, '127.0.0.1:9092', log)
 
-        self.assertEqual(slept_for, expected)
+        self.assertEqual(workers, {})
+
+    def test_destroy_unknown(self, fake_spawn_worker_for):
+        """``handle_event`` is fine with a container it never had an exporter for going away"""
+        fake_client = MagicMock()
+        log = MagicMock()
+
+        workers = main.handle_event(fake_client, self._make_event('destroy'), {}, '127.0.0.1:9092', log)
+
+        self.assertEqual(workers, {})
 
 
 class TestGetTopic(unittest.TestCase):
@@ -136,6 +251,13 @@ class TestGetTopic(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    def test_get_other_style(self):
+        """``get_topic`` defaults to 'other' for unknown log styles of a service"""
+        output = main.get_topic('vlab_insightiq-celery_2')
+        expected = 'other'
+
+        self.assertEqual(output, expected)
+
 
 class TestSpawnWorkers(unittest.TestCase):
     """A suite of test cases for the ``spawn_workers`` function"""
@@ -145,8 +267,7 @@ class TestSpawnWorkers(unittest.TestCase):
         fake_container1.name = 'vlab_onefs-api_1'
         fake_container2 = MagicMock()
         fake_container2.name = 'vlab_dns_1'
-        cls.fake_client = MagicMock()
-        cls.fake_client.containers.list.return_value = [fake_container1, fake_container2]
+        cls.containers = [fake_container1, fake_container2]
 
     @patch.object(main, 'Exporter')
     def test_spawn_workers(self, fake_Exporter):
@@ -155,7 +276,7 @@ class TestSpawnWorkers(unittest.TestCase):
         log = MagicMock()
         workers = {}
 
-        output = main.spawn_workers(self.fake_client, workers, kafka_server, log).keys()
+        output = main.spawn_workers(self.containers, workers, kafka_server, log).keys()
         expected = ['vlab_onefs-api_1', 'vlab_dns_1']
         # set() avoids false postivies due to order
         self.assertEqual(set(output), set(expected))
@@ -167,11 +288,25 @@ class TestSpawnWorkers(unittest.TestCase):
         log = MagicMock()
         workers = {'vlab_onefs-api_1' : MagicMock(), 'vlab_dns_1': MagicMock()}
 
-        main.spawn_workers(self.fake_client, workers, kafka_server, log)
+        main.spawn_workers(self.containers, workers, kafka_server, log)
 
         self.assertFalse(fake_Exporter.called)
 
 
+class TestSpawnWorkerFor(unittest.TestCase):
+    """A suite of test cases for the ``spawn_worker_for`` function"""
+    @patch.object(main, 'Exporter')
+    def test_spawn_worker_for(self, fake_Exporter):
+        """``spawn_worker_for`` starts an exporter thread for the container"""
+        container = MagicMock()
+        container.name = 'vlab_dns_1'
+        log = MagicMock()
+
+        workers = main.spawn_worker_for(container, {}, '127.0.0.0:9092', log)
+
+        self.assertTrue(workers['vlab_dns_1'].start.called)
+
+
 class TestRespawnWorkers(unittest.TestCase):
     """A suite of test cases for the ``respawn_workers`` function"""
     @classmethod
@@ -180,8 +315,7 @@ class TestRespawnWorkers(unittest.TestCase):
         fake_container1.name = 'vlab_onefs-api_1'
         fake_container2 = MagicMock()
         fake_container2.name = 'vlab_dns_1'
-        cls.fake_client = MagicMock()
-        cls.fake_client.containers.list.return_value = [fake_container1, fake_container2]
+        cls.containers = [fake_container1, fake_container2]
 
     @patch.object(main, 'Exporter')
     def test_respawn_workers(self, fake_Exporter):
@@ -194,7 +328,7 @@ class TestRespawnWorkers(unittest.TestCase):
         kafka_server = '127.0.0.0:9092'
         log = MagicMock()
 
-        main.respawn_workers(self.fake_client, workers, kafka_server, log)
+        main.respawn_workers(self.containers, workers, kafka_server, log)
 
         respawn_count = fake_Exporter.call_count
         expected = 1
@@ -212,11 +346,88 @@ class TestRespawnWorkers(unittest.TestCase):
         kafka_server = '127.0.0.0:9092'
         log = MagicMock()
 
-        main.respawn_workers(self.fake_client, workers, kafka_server, log)
+        main.respawn_workers(self.containers, workers, kafka_server, log)
 
         self.assertTrue(log.info.called)
 
 
+class TestAESGCMCipher(unittest.TestCase):
+    """A suite of test cases for the ``AESGCMCipher`` object"""
+    def test_encrypt(self):
+        """``AESGCMCipher`` output can be decrypted with the hashed key"""
+        key = b'some shared key'
+        cipher = main.AESGCMCipher(key)
+
+        token = cipher.encrypt(b'some log message')
+        aead = main.AESGCM(main.hashlib.sha256(key).digest())
+        plain_text = aead.decrypt(token[:12], token[12:], None)
+
+        self.assertEqual(plain_text, b'some log message')
+
+    def test_unique_nonce(self):
+        """``AESGCMCipher`` uses a new nonce for every message"""
+        cipher = main.AESGCMCipher(b'some shared key')
+
+        token1 = cipher.encrypt(b'some log message')
+        token2 = cipher.encrypt(b'some log message')
+
+        self.assertNotEqual(token1[:12], token2[:12])
+
+
+def make_container(chunks, tty=True):
+    """Make a fake container, whose attach socket returns ``chunks`` and then closes"""
+    container = MagicMock()
+    container.attrs = {'Config': {'Tty': tty}}
+    container.attach_socket.return_value.recv.side_effect = list(chunks) + [b'']
+    return container
+
+
+def make_frame(data, stream=1):
+    """Wrap the data like the Docker API does for a container without a TTY"""
+    return bytes([stream, 0, 0, 0]) + len(data).to_bytes(4, 'big') + data
+
+
+class TestStreamHelpers(unittest.TestCase):
+    """A suite of test cases for the ``demux_frames`` and ``split_lines`` functions"""
+    def test_demux_frames(self):
+        """``demux_frames`` moves the payload of every complete frame into the output"""
+        frames = bytearray(make_frame(b'foo') + make_frame(b'bar', stream=2))
+        output = bytearray()
+
+        main.demux_frames(frames, output)
+
+        self.assertEqual(output, bytearray(b'foobar'))
+        self.assertEqual(frames, bytearray())
+
+    def test_demux_frames_partial(self):
+        """``demux_frames`` leaves a partial frame to be finished by the next read"""
+        frame = make_frame(b'foo')
+        frames = bytearray(frame + frame[:9])
+        output = bytearray()
+
+        main.demux_frames(frames, output)
+
+        self.assertEqual(output, bytearray(b'foo'))
+        self.assertEqual(frames, bytearray(frame[:9]))
+
+    def test_split_lines(self):
+        """``split_lines`` returns every complete line, and leaves the partial one"""
+        output = bytearray(b'foo\nbar\nba')
+
+        lines = main.split_lines(output)
+
+        self.assertEqual(lines, [b'foo\n', b'bar\n'])
+        self.assertEqual(output, bytearray(b'ba'))
+
+    def test_split_lines_carriage_return(self):
+        """``split_lines`` only splits on a newline"""
+        output = bytearray(b'foo\rbar\n')
+
+        lines = main.split_lines(output)
+
+        self.assertEqual(lines, [b'foo\rbar\n'])
+
+
 class TestExporter(unittest.TestCase):
     """A suite of test cases for the ``Exporter`` object"""
     @patch.object(builtins, "open")
@@ -234,13 +445,29 @@ class TestExporter(unittest.TestCase):
         self.assertTrue(fake_KafkaProducer.called)
         self.assertTrue(fake_Fernet.called)
 
+    @patch.object(main, 'LOG_CIPHER', 'aesgcm')
+    @patch.object(builtins, "open")
+    @patch.object(main, 'KafkaProducer')
+    @patch.object(main, 'Fernet')
+    def test_exporter_aesgcm(self, fake_Fernet, fake_KafkaProducer, fake_open):
+        """``Exporter`` uses AES-GCM when LOG_CIPHER is 'aesgcm'"""
+        fake_open.return_value.__enter__.return_value.read.return_value = b'some key'
+        container = 'someContainer'
+        topic = 'other'
+        server = 'myKafka.org:9092'
+        log = MagicMock()
+
+        exporter = main.Exporter(container, topic, server, log)
+
+        self.assertTrue(isinstance(exporter.cipher, main.AESGCMCipher))
+        self.assertFalse(fake_Fernet.called)
+
     @patch.object(builtins, "open")
     @patch.object(main, 'KafkaProducer')
     @patch.object(main, 'Fernet')
     def test_exporter_run(self, fake_Fernet, fake_KafkaProducer, fake_open):
         """``Exporter`` closes the connection to Kafka upon termination"""
-        container = MagicMock()
-        container.logs.return_value = [b'some log message\n']
+        container = make_container([b'some log message\n'])
         topic = 'other'
         server = 'myKafka.org:9092'
         log = MagicMock()
@@ -255,8 +482,29 @@ class TestExporter(unittest.TestCase):
     @patch.object(main, 'Fernet')
     def test_exporter_grouping(self, fake_Fernet, fake_KafkaProducer, fake_open):
         """``Exporter`` Assumes a new line that begins with a space is part of the last message"""
-        container = MagicMock()
-        container.logs.return_value = [b'some log message\n', b' some more info\n', b'new stuff']
+        container = make_container([b'some log message\n', b' some more info\n', b'new stuff'])
+        container.name = None
+        topic = 'other'
+        server = 'myKafka.org:9092'
+        log = MagicMock()
+
+        exporter = main.Exporter(container, topic, server, log)
+        exporter.cipher.encrypt = lambda x: x
+        exporter.run()
+
+        sent_msgs = [x[0][1] for x in exporter.conn.send.call_args_list]
+        expected = [b'{"name":null,"log":"some log message\\n some more info\\n"}',
+                    b'{"name":null,"log":"new stuff"}']
+
+        self.assertEqual(sent_msgs, expected)
+
+    @patch.object(builtins, "open")
+    @patch.object(main, 'KafkaProducer')
+    @patch.object(main, 'Fernet')
+    def test_exporter_split_reads(self, fake_Fernet, fake_KafkaProducer, fake_open):
+        """``Exporter`` handles lines that are split across reads of the socket"""
+        container = make_container([b'some log ', b'message\n', b'new stuff\n'])
+        container.name = None
         topic = 'other'
         server = 'myKafka.org:9092'
         log = MagicMock()
@@ -265,11 +513,87 @@ class TestExporter(unittest.TestCase):
         exporter.cipher.encrypt = lambda x: x
         exporter.run()
 
-        the_args = exporter.conn.send.call_args
-        sent_msg = the_args[0][1]
-        expected = b'{"name":null,"log":"some log message\\n some more info\\n"}'
+        sent_msgs = [x[0][1] for x in exporter.conn.send.call_args_list]
+        expected = [b'{"name":null,"log":"some log message\\n"}',
+                    b'{"name":null,"log":"new stuff\\n"}']
+
+        self.assertEqual(sent_msgs, expected)
+
+    @patch.object(builtins, "open")
+    @patch.object(main, 'KafkaProducer')
+    @patch.object(main, 'Fernet')
+    def test_exporter_no_tty(self, fake_Fernet, fake_KafkaProducer, fake_open):
+        """``Exporter`` strips the stream headers from the output of a container without a TTY"""
+        stream = make_frame(b'some log message\n') + make_frame(b' some more info\n', stream=2)
+        container = make_container([stream[:5], stream[5:20], stream[20:]], tty=False)
+        container.name = None
+        topic = 'other'
+        server = 'myKafka.org:9092'
+        log = MagicMock()
+
+        exporter = main.Exporter(container, topic, server, log)
+        exporter.cipher.encrypt = lambda x: x
+        exporter.run()
+
+        sent_msgs = [x[0][1] for x in exporter.conn.send.call_args_list]
+        expected = [b'{"name":null,"log":"some log message\\n some more info\\n"}']
+
+        self.assertEqual(sent_msgs, expected)
+
+    @patch.object(main.os, 'read')
+    @patch.object(builtins, "open")
+    @patch.object(main, 'KafkaProducer')
+    @patch.object(main, 'Fernet')
+    def test_exporter_unix_socket(self, fake_Fernet, fake_KafkaProducer, fake_open, fake_read):
+        """``Exporter`` reads the file descriptor directly when the socket isn't TLS"""
+        fake_read.side_effect = [b'some log message\n', b'']
+        container = MagicMock()
+        container.attrs = {'Config': {'Tty': True}}
+        container.name = 'vlab_dns_1'
+        container.attach_socket.return_value = MagicMock(spec=['fileno', 'close'])
+        topic = 'other'
+        server = 'myKafka.org:9092'
+        log = MagicMock()
+
+        exporter = main.Exporter(container, topic, server, log)
+        exporter.run()
+
+        self.assertEqual(exporter.conn.send.call_count, 1)
+        self.assertTrue(container.attach_socket.return_value.close.called)
+
+    @patch.object(builtins, "open")
+    @patch.object(main, 'KafkaProducer')
+    @patch.object(main, 'Fernet')
+    def test_exporter_last_message(self, fake_Fernet, fake_KafkaProducer, fake_open):
+        """``Exporter`` sends the last log message when the log stream ends"""
+        container = make_container([b'some log message\n'])
+        container.name = 'vlab_dns_1'
+        topic = 'other'
+        server = 'myKafka.org:9092'
+        log = MagicMock()
+
+        exporter = main.Exporter(container, topic, server, log)
+        exporter.run()
+
+        sent = exporter.conn.send.call_count
+        expected = 1
+
+        self.assertEqual(sent, expected)
+
+    @patch.object(builtins, "open")
+    @patch.object(main, 'KafkaProducer')
+    @patch.object(main, 'Fernet')
+    def test_exporter_linger(self, fake_Fernet, fake_KafkaProducer, fake_open):
+        """``Exporter`` lets the Kafka producer batch up messages"""
+        container = 'someContainer'
+        topic = 'other'
+        server = 'myKafka.org:9092'
+        log = MagicMock()
+
+        main.Exporter(container, topic, server, log)
+        _, the_kwargs = fake_KafkaProducer.call_args
 
-        self.assertEqual(sent_msg, expected)
+        self.assertTrue(the_kwargs['linger_ms'] > 0)
 
     @patch.object(builtins, "open")
     @patch.object(main, 'KafkaProducer')
@@ -277,7 +601,7 @@ class TestExporter(unittest.TestCase):
     def test_exporter_error(self, fake_Fernet, fake_KafkaProducer, fake_open):
         """``Exporter`` logs all exceptions before terminating"""
         container = MagicMock()
-        container.logs.return_value = ['some log message'] # should be Bytes; causes Traceback
+        container.attach_socket.side_effect = RuntimeError('testing')
         topic = 'other'
         server = 'myKafka.org:9092'
         log = MagicMock()
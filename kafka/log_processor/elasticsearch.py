@@ -3,6 +3,16 @@
 import time
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+POOL_CONNECTIONS = 4 # how many hosts to keep connection pools for
+POOL_MAXSIZE = 64 # how many connections to keep open to a single host
+# Only failures to connect are retried; POST isn't idempotent, so a bulk write
+# that the server received is never re-sent (which would duplicate documents)
+RETRY = Retry(total=3, backoff_factor=0.1)
+BULK_ACTION = b'{"index":{}}\n' # the "action" line that precedes every document in a bulk request
+BULK_PARAMS = {'filter_path': 'errors,items.*.error'} # only send back the failures
 
 
 class ElasticSearch:
@@ -27,17 +37,30 @@ class ElasticSearch:
     :type verify: Boolean
     """
     def __init__(self, server, user, password, doc_type, port=9200, verify=False):
-        self.url = 'https://{}:{}/{}/{}'
+        # Only the daily index changes between writes, so build the rest of the URL once
+        self.url_prefix = 'https://{}:{}/'.format(server, port)
+        self.url_suffix = '/{}/_bulk'.format(doc_type)
         self.server = server
         self.port = port
         self.creds = (user, password)
         self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                                                   pool_maxsize=POOL_MAXSIZE,
+                                                   max_retries=RETRY))
+        self.session.headers.update({'Content-Type': 'application/x-ndjson'})
         self.doc_type = doc_type
         self.verify = verify
+        self._index = ''
+        self._index_expires = 0.0
 
     @property
     def index(self):
-        return time.strftime('logs-%Y.%m.%d')
+        """The name of today's index; only re-formatted once the day rolls over"""
+        now = time.time()
+        if now >= self._index_expires:
+            self._index = time.strftime('logs-%Y.%m.%d', time.localtime(now))
+            self._index_expires = _next_midnight(now)
+        return self._index
 
     def write(self, document):
         """Add a new document to ElasticSearch.
@@ -54,10 +77,52 @@ class ElasticSearch:
         :param document: The new record/document to add to ElasticSearch
         :type document: JSON
         """
-        url = self.url.format(self.server, self.port, self.index, self.doc_type)
-        resp = self.session.post(url, auth=self.creds, data=document, headers={'Content-Type': 'application/json'}, verify=self.verify)
+        self.write_many([document])
+
+    def write_many(self, documents):
+        """Add several documents to ElasticSearch in one request, via the bulk API.
+
+        Every document has the same requirements as with ``write``.
+
+        :Returns: None
+
+        :Raises: requests.exceptions.HTTPError
+
+        :param documents: The new records/documents to add to ElasticSearch
+        :type documents: List
+        """
+        # Joining the pieces in one go copies each document once; concatenating
+        # the action + document + newline first would copy each document twice
+        pieces = []
+        for doc in documents:
+            pieces.append(BULK_ACTION)
+            pieces.append(_as_bytes(doc))
+            pieces.append(b'\n')
+        body = b''.join(pieces)
+        url = self.url_prefix + self.index + self.url_suffix
+        resp = self.session.post(url, params=BULK_PARAMS, auth=self.creds, data=body, verify=self.verify)
         resp.raise_for_status()
+        # The bulk API responds with a 200 even if some (or all) documents were rejected
+        result = resp.json()
+        if result.get('errors'):
+            first_error = result['items'][0]['index']['error']
+            msg = 'Failed to write {} of {} documents: {}'.format(len(result['items']), len(documents), first_error)
+            raise requests.exceptions.HTTPError(msg, response=resp)
 
     def close(self):
         """TODO"""
         self.session.close()
+
+
+def _as_bytes(document):
+    """The bulk request body is bytes, but some workers format documents as strings"""
+    if isinstance(document, str):
+        return document.encode()
+    return document
+
+
+def _next_midnight(now):
+    """The EPOCH timestamp of the next (local) midnight"""
+    today = time.localtime(now)
+    # mktime normalizes a day-of-month that's past the end of the month
+    return time.mktime((today.tm_year, today.tm_mon, today.tm_mday + 1, 0, 0, 0, 0, 0, -1))
@@ -20,6 +20,7 @@ class InfluxDB:
         self._db = database
         self.session = Session()
         self._staged = []
+        self._lines = []
         self._last_write = 0
         self._measurement = measurement
         self.headers = {'Content-Type': 'application/octet-stream'}
@@ -43,10 +44,28 @@ class InfluxDB:
         if timestamp is None:
             timestamp = write_time
         self._staged.append({'tags' : tags, 'fields' : fields, 'timestamp' : timestamp})
+        self._check_flush(write_time)
+
+    def write_line(self, line):
+        """Add a data point that's already in InfluxDB Line Protocol format.
+
+        Like ``write``, the data point is staged until the next ``flush``, but
+        it skips building (and later formatting) the dictionaries of fields and tags.
+
+        :Returns: None
+
+        :param line: A single data point, without a trailing newline
+        :type line: String
+        """
+        self._lines.append(line)
+        self._check_flush(time.time())
+
+    def _check_flush(self, write_time):
+        """Flush the staged data points if there's enough of them, or they've waited long enough"""
         last_write_delta = write_time - self._last_write
         # InfluxDB docs say to write in batches of 5,000 for optimal perf
         # but I don't want to lose more than 10sec of history
-        if len(self._staged) > 5000 or last_write_delta >= 10:
+        if len(self._staged) + len(self._lines) > 5000 or last_write_delta >= 10:
             self.flush(write_time=write_time)
 
     def flush(self, write_time=0):
@@ -57,7 +76,13 @@ class InfluxDB:
         :param write_time: Optionally supply the EPOCH timestamp of when the write is sent
         :type write_time: Integer
         """
-        payload = _format_data(self._staged, self._measurement)
+        if not (self._staged or self._lines):
+            return
+        lines = self._lines
+        if self._staged:
+            lines = lines + [_format_data(self._staged, self._measurement)]
+        # requests would send a str as latin-1, which can't encode every username
+        payload = '\n'.join(lines).encode()
         resp = self.session.post(self.url, headers=self.headers, auth=self._creds, params=self.params, data=payload, verify=False)
         if not resp.ok:
             try:
@@ -67,6 +92,22 @@ class InfluxDB:
             raise InfluxError(error, resp.status_code)
         self._last_write = write_time
         self._staged = []
+        self._lines = []
+
+    def flush_stale(self, max_age=1):
+        """Send the pending data points if nothing has been written in ``max_age`` seconds
+
+        Intended for when the caller is idle, so data points are not left staged
+        until the next ``write`` happens to show up.
+
+        :Returns: None
+
+        :param max_age: How many seconds data points can sit before being sent
+        :type max_age: Integer/Float
+        """
+        now = time.time()
+        if now - self._last_write >= max_age:
+            self.flush(write_time=now)
 
 
 def _format_data(influx_data, measurement):
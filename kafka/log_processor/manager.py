@@ -9,42 +9,206 @@ down. The idea by doing this is:
   A) to better handle workflows that bursts supply records for processing
   B) Be less prone to flapping up/down scaling of workers
 """
+import math
 import time
 import queue
 from os import environ
-from multiprocessing import Queue, cpu_count
+try:
+    from os import sched_getaffinity
+except ImportError:
+    # not every OS supports CPU affinity
+    sched_getaffinity = None
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Queue, Value, cpu_count
 
 from kafka import KafkaConsumer
 from setproctitle import setproctitle
+try:
+    from faster_fifo import Queue as FFQueue
+except ImportError:
+    FFQueue = None
 
 from log_processor.std_logger import get_logger
 
 PRODUCE_TIMEOUT = 30000 # milliseconds; how long to wait for a new work item from Kafka
-PRODUCE_INTERVAL = 30 # seconds; minimum on how long to wait in between scaling workers
-PRODUCE_BEFORE_CHECKING = 5000 # records; how many records to send to workers before checking on PRODUCE_INTERVAL
-SENTINEL = 'TERMINATE YOU USELESS PROCESS'
-SCALE_UP_BY = 2
+# Bigger, less frequent fetches from Kafka; a bursty topic otherwise makes lots of small ones
+FETCH_MIN_BYTES = int(environ.get('FETCH_MIN_BYTES', 65536)) # bytes; how much data the broker should wait for before answering a fetch
+FETCH_MAX_WAIT_MS = int(environ.get('FETCH_MAX_WAIT_MS', 500)) # milliseconds; how long the broker may wait for FETCH_MIN_BYTES
+MAX_PARTITION_FETCH_BYTES = int(environ.get('MAX_PARTITION_FETCH_BYTES', 10485760)) # bytes; the most data to fetch per partition
+POLL_MAX_RECORDS = int(environ.get('POLL_MAX_RECORDS', 500)) # records; the most records to hand to the workers at once
+PRODUCE_INTERVAL = int(environ.get('PRODUCE_INTERVAL', 30)) # seconds; minimum on how long to wait in between scaling workers
+PRODUCE_BEFORE_CHECKING = int(environ.get('PRODUCE_BEFORE_CHECKING', 5000)) # records; how many records to send to workers before checking on PRODUCE_INTERVAL
+# Tells a worker to terminate. It's a small int because it's pickled through the
+# work_queue, and every record gets compared to it. CPython only has one 0
+# object, even after unpickling, so workers check it by identity
+SENTINEL = 0
+# What a worker puts in the idle_queue when it retires to give back memory
+# (see MAX_RECORDS_PER_WORKER in worker.py); it gets replaced
+RECYCLED = 'recycled'
+CGROUP_V2_CPU_MAX = '/sys/fs/cgroup/cpu.max' # "<quota> <period>", or "max <period>" when unlimited
+CGROUP_V1_CPU_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us' # -1 when unlimited
+CGROUP_V1_CPU_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+SCALE_UP_BY = int(environ.get('SCALE_UP_BY', 2))
 SCALE_DOWN_BY = -1
-MAX_WORKERS = 2 * cpu_count()
 
 
-def make_queues():
+def _effective_cpus():
+    """The number of CPUs this container can actually use.
+
+    ``cpu_count`` reports every CPU on the host, even when Docker/Kubernetes
+    limits the container to a CPU quota or a subset of CPUs.
+
+    :Returns: Integer
+    """
+    if sched_getaffinity is None:
+        cpus = cpu_count()
+    else:
+        cpus = len(sched_getaffinity(0))
+    quota = _cgroup_cpu_quota()
+    if quota:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def _cgroup_cpu_quota():
+    """Read the cgroup (v2, then v1) CPU quota, in number of CPUs
+
+    :Returns: Float, or None if there's no quota
+    """
+    try:
+        with open(CGROUP_V2_CPU_MAX) as the_file:
+            quota, period = the_file.read().split()
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(CGROUP_V1_CPU_QUOTA) as the_file:
+            quota = int(the_file.read())
+        with open(CGROUP_V1_CPU_PERIOD) as the_file:
+            period = int(the_file.read())
+        if quota <= 0 or period <= 0:
+            return None
+        return quota / period
+    except (OSError, ValueError):
+        return None
+
+
+EFFECTIVE_CPUS = _effective_cpus()
+MAX_WORKERS = int(environ.get('MAX_WORKERS', max(2, 2 * EFFECTIVE_CPUS)))
+BACKLOG_BATCH = 100 # records; how many records to put into the work_queue before updating the backlog counter
+# Set to 'false' to use a plain multiprocessing.Queue even when faster-fifo is installed
+USE_FASTER_FIFO = environ.get('USE_FASTER_FIFO', 'true').lower() in ('1', 'true', 'yes')
+WORK_QUEUE_BYTES = 1000000000 # bytes; the size of the faster-fifo work_queue buffer
+IDLE_QUEUE_BYTES = 1000000 # bytes; the size of the faster-fifo idle_queue buffer
+# Either 'process' or 'thread'; threads avoid pickling every record, but share the GIL
+WORKER_MODE = environ.get('WORKER_MODE', 'process')
+
+
+def make_queues(threaded=False):
     """Exists simply to make unit testing easier
 
     The ``work_queue`` is a standard queue, where each event pulled out of Kafka
-    gets pushed into the queue.
+    gets pushed into the queue. When `faster-fifo <https://github.com/alex-petrenko/faster-fifo>`_
+    is installed (and ``USE_FASTER_FIFO`` isn't disabled), the ``work_queue``
+    is a ``faster_fifo.Queue`` so records can be moved in batches instead of one
+    pickle + pipe write at a time. The ``idle_queue`` is too, so the manager
+    can read every message the workers posted in one go.
 
     The ``idle_queue`` is a channel to enable workers to communicate directly back
     to the manager. Items in the ``idle_queue`` are tuples of ('process name', 'error').
     If no error occurred (like when we signal a worker to scale-down), the error-string
     will be of zero length (i.e. '').
+
+    :param threaded: Set to True when the workers are threads instead of processes
+    :type threaded: Boolean
     """
-    work_queue = Queue()
-    idle_queue = Queue()
+    if threaded:
+        return queue.Queue(), queue.Queue()
+    if USE_FASTER_FIFO and FFQueue is not None:
+        work_queue = FFQueue(max_size_bytes=WORK_QUEUE_BYTES)
+        idle_queue = FFQueue(max_size_bytes=IDLE_QUEUE_BYTES)
+    else:
+        work_queue = Queue()
+        idle_queue = Queue()
     return work_queue, idle_queue
 
 
-def check_workload(workers, work_queue, idle_queue, log):
+def put_work(work_queue, records):
+    """Send a batch of records to the workers
+
+    A ``multiprocessing.Queue`` pickles, locks, and writes to a pipe for every
+    ``put``, so the records are sent as lists of up to ``BACKLOG_BATCH`` records
+    (workers unpack them; see ``Worker.next_item``). Capping the list size keeps
+    a single worker from hogging a whole poll's worth of records.
+
+    :Returns: None
+
+    :param work_queue: The channel to dispatch work items/records to workers
+    :type work_queue: multiprocessing.Queue or faster_fifo.Queue
+
+    :param records: The records to send
+    :type records: List
+    """
+    if hasattr(work_queue, 'put_many'):
+        work_queue.put_many(records)
+    else:
+        for start in range(0, len(records), BACKLOG_BATCH):
+            work_queue.put(records[start:start + BACKLOG_BATCH])
+
+
+def thread_workers(worker_cls, pool):
+    """Make workers that run in a thread from ``pool`` instead of in their own process
+
+    The returned callable takes the same arguments as ``worker_cls``, and the
+    workers it makes are otherwise identical, so the rest of the manager doesn't
+    care which kind of worker it's dealing with.
+
+    :Returns: Function
+
+    :param worker_cls: The specific Worker subclass for processing log data
+    :type worker_cls: log_processor.worker.Worker
+
+    :param pool: The threads to run the workers in
+    :type pool: concurrent.futures.ThreadPoolExecutor
+    """
+    def make_worker(*args):
+        worker = worker_cls(*args)
+        worker.start = lambda: pool.submit(worker.run)
+        return worker
+    return make_worker
+
+
+def make_backlog():
+    """Exists simply to make unit testing easier
+
+    The ``backlog`` counts the records put into the ``work_queue`` that no
+    worker has picked up yet. The producer and the workers update it in batches,
+    so it's an estimate, but unlike ``work_queue.qsize()`` reading it is just
+    a read of shared memory.
+    """
+    return Value('i', 0)
+
+
+def report_produced(backlog, produced):
+    """Add the number of records put into the ``work_queue`` to the ``backlog``
+
+    :Returns: Integer (always zero, to reset the caller's counter)
+
+    :param backlog: The number of records waiting to be processed
+    :type backlog: multiprocessing.Value
+
+    :param produced: The number of records added since the last update
+    :type produced: Integer
+    """
+    if produced:
+        with backlog.get_lock():
+            backlog.value += produced
+    return 0
+
+
+def check_workload(workers, backlog, idle_queue, log):
     """Determine how much to scale up or down the number of worker processes.
 
     :Returns: Tuple (List, Int)
@@ -52,8 +216,8 @@ def check_workload(workers, work_queue, idle_queue, log):
     :param workers: A list of active worker processes
     :type workers: List
 
-    :param work_queue: The channel to dispatch work items/records to workers
-    :type work_queue: multiprocessing.Queue
+    :param backlog: The number of records waiting to be processed
+    :type backlog: multiprocessing.Value
 
     :param idle_queue: The channel used by workers to communicate with the manager
     :type idle_queue: multiprocessing.Queue
@@ -62,12 +226,11 @@ def check_workload(workers, work_queue, idle_queue, log):
     :type log: logging.Logger
     """
     log.debug('Checking worker health')
-    needed_workers = 0
     workers, scale_modifier = check_worker_health(workers, idle_queue, log)
     needed_workers = 0
-    work_in_queue = work_queue.qsize()
-    log.debug('Pending items for processing: {}'.format(work_in_queue))
-    log.debug('Active workers: {}'.format(len(workers)))
+    work_in_queue = backlog.value
+    log.debug('Pending items for processing: %s', work_in_queue)
+    log.debug('Active workers: %s', len(workers))
     if work_in_queue > 100:
         # Between adding PRODUCE_BEFORE_CHECKING to the work_queue, and performing
         # this check, over 100 work items remain to be processed. There's a
@@ -77,7 +240,7 @@ def check_workload(workers, work_queue, idle_queue, log):
     elif work_in_queue < 10:
         needed_workers = SCALE_DOWN_BY
     needed_workers = needed_workers + scale_modifier
-    log.debug('Scaling workers by: {}'.format(needed_workers))
+    log.debug('Scaling workers by: %s', needed_workers)
     return workers, needed_workers
 
 
@@ -101,19 +264,21 @@ def check_worker_health(workers, idle_queue, log):
     """
     total_workers = len(workers)
     error_workers = 0
+    recycled_workers = 0
     scalier = 0
     terminated = set() # so we can clean up our list of active workers
-    while not idle_queue.empty():
-        try:
-            worker, error = idle_queue.get(block=False)
-            if error:
-                error_workers += 1
-            terminated.add(worker)
-        except queue.Empty:
-            break
-    log.debug('Number of workers that encountered an error: {}'.format(error_workers))
-    log.debug('Number of gracefully terminated workers: {}'.format(len(terminated) - error_workers))
-    if error_workers == total_workers:
+    for worker, error in drain_idle_queue(idle_queue, max(1, total_workers)):
+        if error == RECYCLED:
+            recycled_workers += 1
+        elif error:
+            error_workers += 1
+        terminated.add(worker)
+    if terminated:
+        # This runs every time Kafka hands over records, so only log when there's news
+        log.debug('Number of workers that encountered an error: %s', error_workers)
+        log.debug('Number of recycled workers: %s', recycled_workers)
+        log.debug('Number of gracefully terminated workers: %s', len(terminated) - error_workers - recycled_workers)
+    if error_workers and error_workers == total_workers:
         raise RuntimeError('All workers are dead; aborting')
     elif error_workers != 0:
         new_workers = workers
@@ -130,11 +295,74 @@ def check_worker_health(workers, idle_queue, log):
     for worker in workers:
         if worker.name not in terminated:
             new_workers.append(worker)
+    # Recycled workers are replaced one for one
+    scalier += recycled_workers
 
     return new_workers, int(scalier)
 
 
-def adjust_worker_count(workers, worker_cls, work_group,work_queue, idle_queue, need):
+def replace_workers(workers, worker_cls, work_group, work_queue, idle_queue, backlog, log):
+    """Forget the workers that have terminated, and right away replace the ones
+    that were recycled (or died).
+
+    Waiting for ``check_workload`` isn't good enough; if the last worker is
+    recycled on a quiet topic, nothing would process the work_queue until
+    another PRODUCE_BEFORE_CHECKING records showed up.
+
+    :Returns: List
+
+    :param workers: A list of active worker processes
+    :type workers: List
+
+    :param worker_cls: The specific Worker subclass for processing log data
+    :type worker_cls: log_processor.worker.Worker
+
+    :param work_queue: The channel to dispatch work items/records to workers
+    :type work_queue: multiprocessing.Queue
+
+    :param idle_queue: The channel used by workers to communicate with the manager
+    :type idle_queue: multiprocessing.Queue
+
+    :param backlog: The number of records waiting to be processed
+    :type backlog: multiprocessing.Value
+
+    :param log: For writing log messages
+    :type log: logging.Logger
+    """
+    workers, replace = check_worker_health(workers, idle_queue, log)
+    if replace > 0:
+        workers = adjust_worker_count(workers, worker_cls, work_group, work_queue, idle_queue, backlog, replace)
+    return workers
+
+
+def drain_idle_queue(idle_queue, batch_size):
+    """Read every message the workers have posted to the idle_queue since the last check
+
+    A ``faster_fifo.Queue`` hands back up to ``batch_size`` messages per read,
+    so even a mass die-off of workers is usually read in one go. Otherwise,
+    messages are read one at a time. Either way, reading stops at the first
+    ``queue.Empty``, so there's no need to also poll ``idle_queue.empty()``.
+
+    :Returns: List
+
+    :param idle_queue: The channel used by workers to communicate with the manager
+    :type idle_queue: multiprocessing.Queue
+
+    :param batch_size: The most messages to read at once from a faster_fifo.Queue
+    :type batch_size: Integer
+    """
+    messages = []
+    while True:
+        try:
+            if hasattr(idle_queue, 'get_many'):
+                messages.extend(idle_queue.get_many(block=False, max_messages_to_get=batch_size))
+            else:
+                messages.append(idle_queue.get(block=False))
+        except queue.Empty:
+            return messages
+
+
+def adjust_worker_count(workers, worker_cls, work_group, work_queue, idle_queue, backlog, need):
     """Scale up/down the number of workers
 
     :Returns: List
@@ -151,9 +379,15 @@ def adjust_worker_count(workers, worker_cls, work_group,work_queue, idle_queue,
     :param idle_queue: The channel used by workers to communicate with the manager
     :type idle_queue: multiprocessing.Queue
 
+    :param backlog: The number of records waiting to be processed
+    :type backlog: multiprocessing.Value
+
     :param need: The adjustment to make to the number of worker processes
     :type need: Integer
     """
+    if not workers:
+        # i.e. the only worker was recycled; having less than 1 worker is stupid
+        need = max(need, 1)
     if need < 0 and len(workers) > 1:
         # having less than 1 worker is stupid
         work_queue.put(SENTINEL)
@@ -161,16 +395,16 @@ def adjust_worker_count(workers, worker_cls, work_group,work_queue, idle_queue,
         potential_make = max(0, MAX_WORKERS - len(workers))
         to_make = min(need, potential_make)
         for _ in range(to_make):
-            worker = worker_cls(work_group, work_queue, idle_queue)
+            worker = worker_cls(work_group, work_queue, idle_queue, backlog)
             worker.start()
             workers.append(worker)
     return workers
 
 
-def produce_work(workers, worker_cls, work_group, topic, work_queue, idle_queue, kafka, log):
+def produce_work(workers, worker_cls, work_group, topic, work_queue, idle_queue, backlog, kafka, log):
     """Read records out of Kafka, and send them to the worker processes.
 
-    :Returns: None
+    :Returns: List
 
     :param workers: A list of active worker processes
     :type workers: List
@@ -187,6 +421,9 @@ def produce_work(workers, worker_cls, work_group, topic, work_queue, idle_queue,
     :param idle_queue: The channel used by workers to communicate with the manager
     :type idle_queue: multiprocessing.Queue
 
+    :param backlog: The number of records waiting to be processed
+    :type backlog: multiprocessing.Value
+
     :param kafka: The connection to Kafka for consuming records
     :type kafka: kafka.KafkaConsumer
 
@@ -194,24 +431,54 @@ def produce_work(workers, worker_cls, work_group, topic, work_queue, idle_queue,
     :type log: logging.Logger
     """
     produced = 0
+    unreported = 0
     produce_start = time.time()
-    for event in kafka:
-        work_queue.put(event.value)
-        produced += 1
-        # incrementing a counter is more than x2 faster than checking a time delta.
-        # PRODUCE_BEFORE_CHECKING should be large enough produce enough work
-        # to keep a single worker busy while we check if we need more works.
-        # A single user connecting to a webpage in their lab will produce
-        # over 600 records, so keep that in mind when adjusting PRODUCE_BEFORE_CHECKING
-        if produced >= PRODUCE_BEFORE_CHECKING:
-            produced = 0
-            log.debug('produced {} items, checking time'.format(PRODUCE_BEFORE_CHECKING))
-            loop_delta = time.time() - produce_start
-            if loop_delta > PRODUCE_INTERVAL:
-                log.debug('Checking work workload')
-                workers, need = check_workload(workers, work_queue, idle_queue, log)
-                workers = adjust_worker_count(workers, worker_cls, work_group, work_queue, idle_queue, need)
-                produce_start = time.time()
+    # Kafka can be quiet for a long time, so this also runs before waiting on it
+    workers = replace_workers(workers, worker_cls, work_group, work_queue, idle_queue, backlog, log)
+    try:
+        for records in poll_records(kafka):
+            # A single write to a faster-fifo work_queue
+            put_work(work_queue, records)
+            workers = replace_workers(workers, worker_cls, work_group, work_queue, idle_queue, backlog, log)
+            produced += len(records)
+            unreported += len(records)
+            if unreported >= BACKLOG_BATCH:
+                unreported = report_produced(backlog, unreported)
+            # incrementing a counter is more than x2 faster than checking a time delta.
+            # PRODUCE_BEFORE_CHECKING should be large enough produce enough work
+            # to keep a single worker busy while we check if we need more works.
+            # A single user connecting to a webpage in their lab will produce
+            # over 600 records, so keep that in mind when adjusting PRODUCE_BEFORE_CHECKING
+            if produced >= PRODUCE_BEFORE_CHECKING:
+                produced = 0
+                log.debug('produced %s items, checking time', PRODUCE_BEFORE_CHECKING)
+                loop_delta = time.time() - produce_start
+                if loop_delta > PRODUCE_INTERVAL:
+                    log.debug('Checking work workload')
+                    unreported = report_produced(backlog, unreported)
+                    workers, need = check_workload(workers, backlog, idle_queue, log)
+                    workers = adjust_worker_count(workers, worker_cls, work_group, work_queue, idle_queue, backlog, need)
+                    produce_start = time.time()
+    finally:
+        # otherwise the backlog would drift every time Kafka goes quiet
+        report_produced(backlog, unreported)
+    return workers
+
+
+def poll_records(kafka):
+    """Pull batches of record values out of Kafka, until no new records show up for PRODUCE_TIMEOUT
+
+    :Returns: Generator (of Lists)
+
+    :param kafka: The connection to Kafka for consuming records
+    :type kafka: kafka.KafkaConsumer
+    """
+    while True:
+        fetched = kafka.poll(timeout_ms=PRODUCE_TIMEOUT, max_records=POLL_MAX_RECORDS)
+        if not fetched:
+            break
+        for partition_records in fetched.values():
+            yield [record.value for record in partition_records]
 
 
 def process_logs(worker_cls, work_group, topic, server, name):
@@ -242,16 +509,32 @@ def process_logs(worker_cls, work_group, topic, server, name):
     log.info('Max produce timeout: {} milliseconds'.format(PRODUCE_TIMEOUT))
     log.info('Max produce interval: {} seconds'.format(PRODUCE_INTERVAL))
     log.info('Max records before check: {}'.format(PRODUCE_BEFORE_CHECKING))
+    log.info('Scale up workers by: {}'.format(SCALE_UP_BY))
+    log.info('Usable CPUs: {}'.format(EFFECTIVE_CPUS))
     log.info('Max number of workers allowed: {}'.format(MAX_WORKERS))
     log.info('Kafka server: {}'.format(server))
     log.info('Kafka topic: {}'.format(topic))
-    kafka = KafkaConsumer(topic, bootstrap_servers=server, consumer_timeout_ms=PRODUCE_TIMEOUT)
+    log.info('Worker mode: {}'.format(WORKER_MODE))
+    threaded = WORKER_MODE == 'thread'
+    if threaded:
+        pool = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix=name)
+        worker_cls = thread_workers(worker_cls, pool)
+        log.info('Worker thread pool size: {}'.format(MAX_WORKERS))
+    log.info('Kafka fetch min bytes: {}'.format(FETCH_MIN_BYTES))
+    log.info('Kafka fetch max wait: {} milliseconds'.format(FETCH_MAX_WAIT_MS))
+    log.info('Kafka max partition fetch bytes: {}'.format(MAX_PARTITION_FETCH_BYTES))
+    kafka = KafkaConsumer(topic,
+                          bootstrap_servers=server,
+                          fetch_min_bytes=FETCH_MIN_BYTES,
+                          fetch_max_wait_ms=FETCH_MAX_WAIT_MS,
+                          max_partition_fetch_bytes=MAX_PARTITION_FETCH_BYTES)
     workers = []
-    work_queue, idle_queue = make_queues()
-    adjust_worker_count(workers, worker_cls, work_group, work_queue, idle_queue, need=1)
+    work_queue, idle_queue = make_queues(threaded)
+    backlog = make_backlog()
+    adjust_worker_count(workers, worker_cls, work_group, work_queue, idle_queue, backlog, need=1)
     while True:
         try:
-            produce_work(workers, worker_cls, work_group, topic, work_queue, idle_queue, kafka, log)
+            workers = produce_work(workers, worker_cls, work_group, topic, work_queue, idle_queue, backlog, kafka, log)
         except Exception as doh:
             log.execption(doh)
             log.error('Sleeping to prevent flapping and to make data gaps (so a human will notice a problem)')
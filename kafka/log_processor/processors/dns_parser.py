@@ -0,0 +1,40 @@
+# -*- coding: UTF-8 -*-
+"""The per-record parsing of DNS logs
+
+This module is kept free of classes and third-party imports so that it can be
+compiled with `mypyc <https://mypyc.readthedocs.io>`_ (see ``setup.py``). When
+the compiled extension is installed, Python imports it instead of this file.
+"""
+import re
+from typing import Dict, Union
+
+MONTHS = {'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04', 'May': '05', 'Jun': '06',
+          'Jul': '07', 'Aug': '08', 'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'}
+# Example: 03-Apr-2019 20:31:41.392 client @0x7f67b02031b0 172.21.0.16#47486 (willhn.vlab.emc.com): query: ...
+LINE = re.compile(r'(?P<day>[^-]*)-(?P<month>[^-]*)-(?P<year>[^ ]*) (?P<time>[^ .]*)[^ ]*'
+                  r'(?: client [^ ]* (?P<client_ip>[^ #]*))?')
+FLAGS = re.compile(r'query:|ddns_update:')
+
+
+def parse(log_message: str) -> Dict[str, Union[str, bool]]:
+    """Pull everything worth having out of the log message in one pass
+
+    :Returns: Dictionary
+
+    :Raises: ValueError if the log message doesn't start with a timestamp
+
+    :param log_message: The entire log message from the DNS service
+    :type log_message: String
+    """
+    match = LINE.match(log_message)
+    if not match:
+        raise ValueError('Unexpected DNS log format: {}'.format(log_message))
+    day, month, year, the_time, client_ip = match.groups()
+    # Only the rest of the message can contain the query/update markers
+    found = FLAGS.findall(log_message, match.end())
+    # Slicing up the string is a lot cheaper than strptime + strftime
+    return {'timestamp' : '{}/{}/{} {}'.format(year, MONTHS[month], day, the_time),
+            'query' : 'query:' in found,
+            'update' : 'ddns_update:' in found,
+            'client_ip' : client_ip or '',
+           }
@@ -1,18 +1,30 @@
 # -*- coding: UTF-8 -*-
 """Processes the DNS logs and upload them to ElasticSearch"""
-import time
 from os import environ
+from typing import Dict, Union
 
-import ujson
+import orjson
 
 from log_processor.worker import LogWorker, InvalidToken
 from log_processor.manager import process_logs
+from log_processor.processors.dns_parser import parse
 
 
 class DnsLogWorker(LogWorker):
     """Convert the raw DNS log into a JSON document then upload it to ElasticSearch"""
     @staticmethod
-    def get_timestamp(log_message):
+    def _parse(log_message: str) -> Dict[str, Union[str, bool]]:
+        """Pull everything worth having out of the log message in one pass; see ``dns_parser.parse``
+
+        :Returns: Dictionary
+
+        :param log_message: The entire log message from the DNS service
+        :type log_message: String
+        """
+        return parse(log_message)
+
+    @staticmethod
+    def get_timestamp(log_message: str) -> str:
         """Extract the timestamp and format it for ElasticSearch
 
         :Returns: String
@@ -20,17 +32,11 @@ class DnsLogWorker(LogWorker):
         :param log_message: The entire log message from the DNS service
         :type log_message: String
         """
-        the_date = log_message.split(' ')[0]
-        time_with_milisec = log_message.split(' ')[1]
-        the_time = time_with_milisec.split('.')[0]
-        timestamp = '{} {}'.format(the_date, the_time)
-        pattern = '%d-%b-%Y %H:%M:%S'
-        time_struct = time.strptime(timestamp, pattern)
-        es_timestamp = time.strftime('%Y/%m/%d %H:%M:%S', time_struct)
-        return es_timestamp
+        # Example: 03-Apr-2019 21:50:42.811 resolver priming query complete
+        return DnsLogWorker._parse(log_message)['timestamp']
 
     @staticmethod
-    def is_update(log_message):
+    def is_update(log_message: str) -> bool:
         """Determine if the log message is related to a Dynamic DNS update
 
         :Returns: String
@@ -38,13 +44,10 @@ class DnsLogWorker(LogWorker):
         :param log_message: The entire log message from the DNS server
         :type log_message: String
         """
-        if 'ddns_update:' in log_message:
-            return True
-        else:
-            return False
+        return 'ddns_update:' in log_message
 
     @staticmethod
-    def is_query(log_message):
+    def is_query(log_message: str) -> bool:
         """Determine if the log message is a DNS query (i.e. a lookup of a A,AAAA,NS,SRV reocrd)
 
         :Returns: String
@@ -52,13 +55,10 @@ class DnsLogWorker(LogWorker):
         :param log_message: The entire log message from the DNS server
         :type log_message: String
         """
-        if "query:" in log_message:
-            return True
-        else:
-            return False
+        return 'query:' in log_message
 
     @staticmethod
-    def get_client_ip(log_message):
+    def get_client_ip(log_message: str) -> str:
         """Extract the IP of the client talking to the DNS server
 
         :Returns: String
@@ -66,25 +66,19 @@ class DnsLogWorker(LogWorker):
         :param log_message: The entire log message from the DNS server
         :type log_message: String
         """
-        chunks = log_message.split(' ')
-        if chunks[2] != 'client':
-            ip =  ''
-        else:
-            ip_and_port = chunks[4]
-            ip = ip_and_port.split('#')[0]
-        return ip
-
-    def format_info(self, info):
-        """Extract the handy bits of data into a JSON document"""
+        return DnsLogWorker._parse(log_message)['client_ip']
+
+    def format_info(self, info: Dict[str, str]) -> bytes:
+        """Extract the handy bits of data into a JSON document
+
+        :Returns: Bytes (orjson encodes straight to UTF-8, which is what requests sends anyway)
+        """
         document = {
             'service' : info['name'],
             'log' : info['log'],
-            'timestamp' : self.get_timestamp(info['log']),
-            'query' : self.is_query(info['log']),
-            'update' : self.is_update(info['log']),
-            'client_ip' : self.get_client_ip(info['log']),
+            **self._parse(info['log'])
         }
-        return ujson.dumps(document)
+        return orjson.dumps(document)
 
 
 if __name__ == '__main__':
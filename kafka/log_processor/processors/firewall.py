@@ -1,19 +1,57 @@
 # -*- coding: UTF-8 -*-
 """Defines how to process logging events uploaded from user's gateways"""
 from os import environ
+from collections import namedtuple
 
-import ujson
-from cryptography.fernet import Fernet, InvalidToken
+import orjson
 
-from log_processor.worker import Worker
+from log_processor.worker import Worker, BAD_RECORD, log_cipher, read_secret
 from log_processor.influxdb import InfluxDB
 from log_processor.manager import process_logs
 
+IDLE_FLUSH_AGE = 1 # seconds; max time a data point sits staged while the worker is idle
+# InfluxDB Line Protocol for a single firewall event; it's exactly what
+# InfluxDB.write would make, minus building (and walking) dicts of tags and fields.
+# Writing strings to a field in Influx requires a double-quote, and each event
+# represents a single packet.
+LINE = '{measurement},username="{user}" user="{user}",source="{source}",target="{target}",packets=1 {timestamp}'
+
+
+class FirewallConfig(namedtuple('FirewallConfig', 'server user passwd_file cipher_key_file')):
+    """The settings a ``FirewallWorker`` needs to upload to InfluxDB
+
+    :param server: The IP/FQDN of the InfluxDB server
+    :type server: String
+
+    :param user: The username to authenicate with
+    :type user: String
+
+    :param passwd_file: The location of the file with the user's password
+    :type passwd_file: String
+
+    :param cipher_key_file: The location of the file with the key to decrypt log data
+    :type cipher_key_file: String
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_env(cls):
+        """Read the settings from the environment variables the Docker image sets
+
+        :Returns: FirewallConfig
+
+        :Raises: KeyError if one of the environment variables isn't set
+        """
+        return cls(server=environ['INFLUXDB_SERVER'],
+                   user=environ['INFLUXDB_USER'],
+                   passwd_file=environ['INFLUXDB_PASSWD_FILE'],
+                   cipher_key_file=environ['CIPHER_KEY_FILE'])
+
 
 class FirewallWorker(Worker):
     """Handles processing log data, then uploading it to InfluxDB
 
-    Relies on the following environment variables:
+    Unless a ``config`` is supplied, relies on the following environment variables:
 
         - INFLUXDB_SERVER: The IP/FQDN of the InfluxDB server
         - INFLUXDB_USER: The username to authenicate with
@@ -34,26 +72,32 @@ class FirewallWorker(Worker):
 
     :param idle_queue: Used to signal the manager that this worker is not doing anything.
     :type idle_queue: multiprocessing.Queue
+
+    :param backlog: The number of records waiting to be processed
+    :type backlog: multiprocessing.Value
+
+    :param config: Where to upload to. Default is ``FirewallConfig.from_env()``
+    :type config: FirewallConfig
     """
-    def __init__(self, work_group, work_queue, idle_queue):
-        super().__init__(work_group, work_queue, idle_queue)
-        self.influx_server=environ['INFLUXDB_SERVER']
-        self.influx_user = environ['INFLUXDB_USER']
-        with open(environ['INFLUXDB_PASSWD_FILE'], 'rb') as pw_file:
-            self.influx_password = pw_file.read().strip()
-        with open(environ['CIPHER_KEY_FILE'], 'rb') as cipher_file:
-            self.cipher_key = cipher_file.read().strip()
+    def __init__(self, work_group, work_queue, idle_queue, backlog=None, config=None):
+        super().__init__(work_group, work_queue, idle_queue, backlog)
+        if config is None:
+            config = FirewallConfig.from_env()
+        self.influx_server = config.server
+        self.influx_user = config.user
+        self.influx_password = read_secret(config.passwd_file)
+        self.cipher_key = read_secret(config.cipher_key_file)
         self.cipher = None
         self.get_cipher()
         self.influx = None
         self.influx_get_conn()
 
     def get_cipher(self):
-        self.cipher = Fernet(self.cipher_key)
+        self.cipher = log_cipher(self.cipher_key)
 
     def extract(self, data):
         """Obtain the JSON object from the encrypted data"""
-        return ujson.loads(self.cipher.decrypt(data))
+        return orjson.loads(self.cipher.decrypt(data))
 
     def influx_get_conn(self):
         """Create an network connection to the InfluxDB server"""
@@ -66,24 +110,24 @@ class FirewallWorker(Worker):
         """Convert the data into a usable JSON object, then upload it to InfluxDB"""
         try:
             payload = self.extract(data)
-        except (ValueError, InvalidToken) as doh:
-            self.log.error('Error: {}, Data: {}'.format(doh, data))
-        else:
-            fields = {}
-            tags = {}
-            # writing strings to a field in Influx requires a double-quote
-            tags['username'] = '"{}"'.format(payload['user'])
             # Dumbass Influx doesn't let you group by fields or aggregate tags...
             # I want to count the unique occurrences of a user over a period of time
             # to show current connected user counts, *and* be able to group by
             # those usernames over time to show specific user usage. Wish I
             # used TimescaleDB instead of InfluxDB
-            fields['user'] = '"{}"'.format(payload.pop('user'))
-            fields['source'] = '"{}"'.format(payload.pop('source'))
-            fields['target'] = '"{}"'.format(payload.pop('target'))
-            fields['packets'] = 1 # each event represents a single packet
-            timestamp = payload.pop('time')
-            self.influx.write(fields=fields, tags=tags, timestamp=timestamp)
+            line = LINE.format(measurement=self.work_group,
+                               user=payload['user'],
+                               source=payload['source'],
+                               target=payload['target'],
+                               timestamp=payload['time'])
+        except BAD_RECORD as doh:
+            self.log.error('Error: {}, Data: {}'.format(doh, data))
+        else:
+            self.influx.write_line(line)
+
+    def on_idle(self):
+        """While waiting for work, send data points that have been staged a while"""
+        self.influx.flush_stale(max_age=IDLE_FLUSH_AGE)
 
     def flush_on_term(self):
         """Before termining, send all pending data points to InfluxDB"""
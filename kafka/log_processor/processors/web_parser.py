@@ -0,0 +1,115 @@
+# -*- coding: UTF-8 -*-
+"""The per-record parsing of the Apache-style API logs
+
+Like ``dns_parser``, this module is kept free of classes and third-party
+imports so that it can be compiled with `mypyc <https://mypyc.readthedocs.io>`_
+(see ``setup.py``). When the compiled extension is installed, Python imports it
+instead of this file.
+"""
+import ipaddress
+from functools import lru_cache
+from typing import Dict, Optional
+
+DIGITS = '0123456789'
+MONTHS = {'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04', 'May': '05', 'Jun': '06',
+          'Jul': '07', 'Aug': '08', 'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'}
+TIMESTAMP_CACHE = 4096 # timestamps; how many formatted timestamps to remember
+
+
+@lru_cache(maxsize=TIMESTAMP_CACHE)
+def format_timestamp(timestamp: str) -> str:
+    """Covernt an Apache-style timestamp to one ElasticSearch likes
+
+    Results are cached, since a burst of requests all share the same handful of timestamps.
+
+    :Returns: String
+
+    :Raises: ValueError if the timestamp isn't formatted like ``[09/Apr/2019:16:34:39``
+
+    :param timestamp: The timestamp field from the web log
+    :type timestamp: String
+    """
+    # [09/Apr/2019:16:34:39
+    # It's fixed-width, so slicing it up is a lot cheaper than time.strptime
+    month = MONTHS.get(timestamp[4:7])
+    if month is None or len(timestamp) != 21 or timestamp[3] + timestamp[7] + timestamp[12] != '//:':
+        raise ValueError('Invalid Apache timestamp: {}'.format(timestamp))
+    # Formatting the timestmap like this, instead of an EPOCH, means that
+    # ElasticSearch will infer the correct type as "date"
+    # which Grafana depends on
+    return '{}/{}/{} {}'.format(timestamp[8:12], month, timestamp[1:3], timestamp[13:21])
+
+
+def is_ip(token: str) -> bool:
+    """Check if the token is an IP address, without building an ``ipaddress`` object
+
+    IPv4 addresses (i.e. nearly every log) are checked by hand; anything that
+    could be IPv6 is still handed to ``ipaddress``.
+
+    :Returns: Boolean
+
+    :param token: The first whitespace-delimited chunk of the log message
+    :type token: String
+    """
+    octets = token.split('.')
+    if len(octets) == 4:
+        for octet in octets:
+            if not octet or len(octet) > 3 or octet.strip(DIGITS) or int(octet) > 255:
+                return False
+            if len(octet) > 1 and octet[0] == '0':
+                # ipaddress rejects leading zeros, since they're ambiguous (octal?)
+                return False
+        return True
+    if ':' not in token:
+        return False
+    try:
+        ipaddress.ip_address(token)
+    except ValueError:
+        return False
+    return True
+
+
+def parse(log_message: str, name: str) -> Dict[str, Optional[str]]:
+    """Extract the handy bits of data from the web log
+
+    Non-Apache logs (like tracebacks) still produce a document, just with only
+    the 'source' and 'log' set.
+
+    :Returns: Dictionary
+
+    :param log_message: The literal log message
+    :type log_message: String
+
+    :param name: The name of the service that created the log message
+    :type name: String
+    """
+    # The logs should adhere to standard Apache web log format
+    # 10.200.217.90 - unset [08/Apr/2019:22:21:57 -0000] "GET /api/1/inf/onefs/task/2b311e03-455c-4409-b8c7-425961533a44? HTTP/1.1" 200 248 "None" "vLab CLI 2019.03.28 rid=85c1c19d38e0485da38d4d0a9da2f43f"
+    # The point of the "source" tag is to handle
+    document = {'source' : name,
+                'timestamp' : None,
+                'user' : None,
+                'client_ip' : None,
+                'method' : None,
+                'url' : None,
+                'status_code' : None,
+                'user_agent' : None,
+                'transaction_id': None,
+                'log' : log_message} # type: Dict[str, Optional[str]]
+    # Only the first 9 fields are used, so don't bother tokenizing the rest
+    raw = log_message.split(None, 9)
+    # if not, it must be a traceback, or some other log
+    if raw and is_ip(raw[0]):
+        document['timestamp'] = format_timestamp(raw[3])
+        document['user'] = raw[2]
+        document['client_ip'] = raw[0]
+        document['method'] = raw[5].replace('"', '')
+        document['url'] = raw[6]
+        document['status_code'] = raw[8]
+        by_quotes = log_message.split('"')
+        # the vLab CLI overloads the User Agent with a transaction id
+        agent = by_quotes[5].split('=')
+        document['user_agent'] = agent[0].replace('rid', '')
+        if len(agent) > 1:
+            document['transaction_id'] = agent[1]
+    return document
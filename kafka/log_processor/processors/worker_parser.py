@@ -0,0 +1,145 @@
+# -*- coding: UTF-8 -*-
+"""The per-record parsing of the vLab worker logs
+
+Like ``dns_parser``, this module is kept free of classes and third-party
+imports so that it can be compiled with `mypyc <https://mypyc.readthedocs.io>`_
+(see ``setup.py``). When the compiled extension is installed, Python imports it
+instead of this file.
+"""
+import re
+from functools import lru_cache
+from typing import Dict, Optional, Pattern, Tuple, Union
+
+# Example: f7e1bb1ccfc14954900f4b379d89301a
+REQUEST_ID = re.compile('[0-9a-f]{32}')
+# Example: e43ed12f-621e-41f7-8117-0f4c4c400602
+TASK_ID = re.compile('[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+# Finds both kinds of IDs in a single scan of the log message. Both IDs start
+# with 8 hex characters, so that's matched once instead of per alternative,
+# which halves the time the scan takes.
+IDS = re.compile('[0-9a-f]{8}(?:(?P<task_id>-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})'
+                 '|(?P<request_id>[0-9a-f]{24}))')
+TIMESTAMP_CACHE = 4096 # timestamps; how many formatted timestamps to remember
+
+
+def only_match(regex: Pattern[str], log_message: str) -> str:
+    """Find the one match of ``regex`` in the log message.
+
+    Same answer as checking ``len(regex.findall(log_message)) == 1``, but it
+    stops scanning as soon as a 2nd match shows up instead of building a list
+    of every match.
+
+    :Returns: String
+
+    :param regex: The compiled pattern to look for
+    :type regex: re.Pattern
+
+    :param log_message: The full log message, including all meta-data
+    :type log_message: String
+    """
+    found = regex.search(log_message)
+    if found is None or regex.search(log_message, found.end()):
+        return ''
+    return found.group()
+
+
+def extract_ids(log_message: str) -> Tuple[str, str]:
+    """Pull both the request ID and task ID from the log message in one pass.
+
+    Like ``only_match``, an ID is only returned when the message contains
+    exactly one of them.
+
+    :Returns: Tuple (request_id, task_id)
+
+    :param log_message: The full log message, including all meta-data
+    :type log_message: String
+    """
+    request_ids = []
+    task_ids = []
+    for match in IDS.finditer(log_message):
+        if match.lastgroup == 'task_id':
+            task_ids.append(match.group())
+        else:
+            request_ids.append(match.group())
+    request_id = request_ids[0] if len(request_ids) == 1 else ''
+    task_id = task_ids[0] if len(task_ids) == 1 else ''
+    return request_id, task_id
+
+
+def get_message(log_message: str) -> str:
+    """Obtain just the log message, no the log meta data
+
+    :Returns: String
+
+    :param log_message: The full log message, including all meta-data
+    :type log_message: String
+    """
+    # Example
+    # [2019-04-11 15:51:10,530: WARNING/ForkPoolWorker-11] 2019-04-11 15:51:10,529 [7c7a53fa69a44201acf015f5964255b1] [e43ed12f-621e-41f7-8117-0f4c4c400602]: Config OneFS 8.0.0
+    # we just want the "Config OneFS 8.0.0" part
+    # rpartition only looks for the last ']' instead of splitting on all of them
+    greedy_msg = log_message.rpartition(']')[2]
+    return greedy_msg.replace(': ', '')
+
+
+def get_timestamp(log_message: str) -> str:
+    """Obtain the timestamp in a format that ElasticSearch likes
+
+    :Returns: String
+
+    :param log_message: The full log message, including all meta-data
+    :type log_message: String
+    """
+    # Example
+    # [2019-04-11 15:51:10,530: WARNING/ForkPoolWorker-11] 2019-04-11 15:51:10,529 [7c7a53fa69a44201acf015f5964255b1] [e43ed12f-621e-41f7-8117-0f4c4c400602]: Config OneFS 8.0.0
+    # We want to convert 2019-04-11 15:51:10 to 2019/04/11 15:51:10
+    if log_message[:1] == '[' and log_message[20:21] == ',':
+        # The usual fixed-width layout, so just slice out the parts
+        return slash_date(log_message[1:20])
+    chunked = log_message.split(' ', 2)
+    the_date = chunked[0].replace('[', '').replace('-', '/')
+    the_time = chunked[1].split(',')[0]
+    return '{} {}'.format(the_date, the_time)
+
+
+@lru_cache(maxsize=TIMESTAMP_CACHE)
+def slash_date(timestamp: str) -> str:
+    """Convert ``2019-04-11 15:51:10`` to ``2019/04/11 15:51:10``
+
+    Results are cached, since a burst of log messages all share the same handful of timestamps.
+
+    :Returns: String
+
+    :param timestamp: The date and time, down to the second
+    :type timestamp: String
+    """
+    return timestamp[:4] + '/' + timestamp[5:7] + '/' + timestamp[8:]
+
+
+def parse(log_message: str, name: str) -> Optional[Dict[str, Union[str, bool]]]:
+    """Convert the worker log message into the document to upload
+
+    :Returns: Dictionary, or None if the log message should be ignored
+
+    :param log_message: The full log message, including all meta-data
+    :type log_message: String
+
+    :param name: The name of the service that created the log message
+    :type name: String
+    """
+    request_id, task_id = extract_ids(log_message)
+    if not task_id:
+        # The Celery logs have this "double-logging" issue where every
+        # event is logged twice. Disabling the generic Celery logs
+        # (that lack task_ids and other meta-data) causes all worker
+        # logging to be disabled...
+        return None
+    message = get_message(log_message)
+    lowered = message.lower()
+    return {'service' : name,
+            'task_id' : task_id,
+            'request_id' : request_id,
+            'started' : lowered == 'task starting\n',
+            'completed' : lowered == 'task complete\n',
+            'message' : message,
+            'timestamp' : get_timestamp(log_message)}
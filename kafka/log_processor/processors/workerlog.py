@@ -1,13 +1,12 @@
 # -*- coding: UTF-8 -*-
 """Defines how to process the worker logs and upload them to ElasticSearch"""
-import re
-import time
 from os import environ
 
-import ujson
+import orjson
 
 from log_processor.worker import LogWorker, InvalidToken
 from log_processor.manager import process_logs
+from log_processor.processors import worker_parser
 
 
 class WorkerLogWorker(LogWorker):
@@ -30,12 +29,7 @@ class WorkerLogWorker(LogWorker):
         :param log_message: The full log message, including all meta-data
         :type log_message: String
         """
-        # Example: f7e1bb1ccfc14954900f4b379d89301a
-        the_id = re.findall('[0-9a-f]{32}', log_message)
-        if len(the_id) == 1:
-            return the_id[0]
-        else:
-            return ''
+        return worker_parser.only_match(worker_parser.REQUEST_ID, log_message)
 
     @staticmethod
     def get_task_id(log_message):
@@ -50,12 +44,7 @@ class WorkerLogWorker(LogWorker):
         :param log_message: The full log message, including all meta-data
         :type log_message: String
         """
-        # Example: e43ed12f-621e-41f7-8117-0f4c4c400602
-        the_id = re.findall('[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}' , log_message)
-        if len(the_id) == 1:
-            return the_id[0]
-        else:
-            return ''
+        return worker_parser.only_match(worker_parser.TASK_ID, log_message)
 
     @staticmethod
     def get_message(log_message):
@@ -66,12 +55,7 @@ class WorkerLogWorker(LogWorker):
         :param log_message: The full log message, including all meta-data
         :type log_message: String
         """
-        # Example
-        # [2019-04-11 15:51:10,530: WARNING/ForkPoolWorker-11] 2019-04-11 15:51:10,529 [7c7a53fa69a44201acf015f5964255b1] [e43ed12f-621e-41f7-8117-0f4c4c400602]: Config OneFS 8.0.0
-        # we just want the "Config OneFS 8.0.0" part
-        greedy_msg = log_message.split(']')[-1]
-        message = greedy_msg.replace(': ', '')
-        return message
+        return worker_parser.get_message(log_message)
 
     @staticmethod
     def get_timestamp(log_message):
@@ -82,14 +66,7 @@ class WorkerLogWorker(LogWorker):
         :param log_message: The full log message, including all meta-data
         :type log_message: String
         """
-        # Example
-        # [2019-04-11 15:51:10,530: WARNING/ForkPoolWorker-11] 2019-04-11 15:51:10,529 [7c7a53fa69a44201acf015f5964255b1] [e43ed12f-621e-41f7-8117-0f4c4c400602]: Config OneFS 8.0.0
-        # We want to convert 2019-04-11 15:51:10 to 2019/04/11 15:51:10
-        chunked = log_message.split(' ')
-        the_date = chunked[0].replace('[', '').replace('-', '/')
-        the_time = chunked[1].split(',')[0]
-        timestamp = '{} {}'.format(the_date, the_time)
-        return timestamp
+        return worker_parser.get_timestamp(log_message)
 
     @staticmethod
     def task_starting(message):
@@ -123,34 +100,17 @@ class WorkerLogWorker(LogWorker):
         """Convert the worker log message into a JSON object. If the log should
         be ignored, an empty string is returned.
 
-        :Returns: String
+        :Returns: Bytes (orjson encodes straight to UTF-8, which is what requests sends anyway)
 
         :param info: A key-value mapping of the service that create the log message,
                      and the literal message.
         :type info: Dictionary
         """
-        request_id = self.get_request_id(info['log'])
-        task_id = self.get_task_id(info['log'])
-        if not task_id:
-            # The Celery logs have this "double-logging" issue where every
-            # event is logged twice. Disabling the generic Celery logs
-            # (that lack task_ids and other meta-data) causes all worker
-            # logging to be disabled...
-            document = ''
-        else:
-            message = self.get_message(info['log'])
-            timestamp = self.get_timestamp(info['log'])
-            started = self.task_starting(message)
-            completed = self.task_competed(message)
-            formatted = {'service' : info['name'],
-                         'task_id' : task_id,
-                         'request_id' : request_id,
-                         'started' : started,
-                         'completed' : completed,
-                         'message' : message,
-                         'timestamp' : timestamp}
-            document = ujson.dumps(formatted)
-        return document
+        # The parsing lives in worker_parser so it can be compiled; see setup.py
+        formatted = worker_parser.parse(info['log'], info['name'])
+        if formatted is None:
+            return ''
+        return orjson.dumps(formatted)
 
 
 if __name__ == '__main__':
@@ -9,56 +9,357 @@ B) Import and run ``process_logs`` from the ``manager.py` module
 You'll likely want to also create a Dockerfile for the new category, update the
 Makefile to have it auto-build, and update the example docker-compose.yml file.
 """
+import time
 import queue
+import hashlib
+from functools import lru_cache
+from collections import deque, namedtuple
 from os import environ
 from abc import ABC, abstractmethod
 from multiprocessing import Process
 
-import ujson
+import orjson
 from cryptography.fernet import Fernet, InvalidToken
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+try:
+    import rfernet
+except ImportError:
+    rfernet = None
 
 from log_processor.std_logger import get_logger
 from log_processor.elasticsearch import ElasticSearch
 
-SENTINEL = 'TERMINATE YOU USELESS PROCESS'
-WAIT_FOR_WORK_ITEM = 10 # seconds
+# Tells a worker to terminate. It's a small int because it's pickled through the
+# work_queue, and every record gets compared to it. CPython only has one 0
+# object, even after unpickling, so workers check it by identity
+SENTINEL = 0
+WAIT_FOR_WORK_ITEM = 1 # seconds; how long an idle worker waits before calling on_idle again
+BACKLOG_BATCH = 100 # records; how many records to take from the work_queue before updating the backlog counter
+# Workers give back memory (e.g. lost to fragmentation) by retiring, and
+# being replaced, after processing this many records. 0 means never retire
+MAX_RECORDS_PER_WORKER = int(environ.get('MAX_RECORDS_PER_WORKER', 0)) # records
+# What a worker retiring because of MAX_RECORDS_PER_WORKER puts in the idle_queue,
+# so the manager knows to replace it
+RECYCLED = 'recycled'
+BULK_MAX_DOCS = int(environ.get('BULK_MAX_DOCS', 500)) # documents; how many to buffer before writing them to ElasticSearch
+BULK_MAX_BYTES = int(environ.get('BULK_MAX_BYTES', 5 * 1024 * 1024)) # bytes; how much to buffer before writing to ElasticSearch
+BULK_MAX_AGE = float(environ.get('BULK_MAX_AGE', 1)) # seconds; how long a document can sit in the buffer before writing to ElasticSearch
+# Either 'fernet' or 'aesgcm'; must match what the log exporter uses
+LOG_CIPHER = environ.get('LOG_CIPHER', 'fernet')
+# Set to 'false' to use pyca's Fernet even when the (Rust-backed) rfernet is installed
+USE_RFERNET = environ.get('USE_RFERNET', 'true').lower() in ('1', 'true', 'yes')
+CIPHERS = {} # (factory, key) -> cipher; see shared_cipher
+# The errors a single malformed record can cause; the record is logged and skipped
+# instead of taking down the worker (and making it flush its buffers early)
+BAD_RECORD = (ValueError, KeyError, IndexError, InvalidToken)
+
+
+class RFernetCipher:
+    """Decrypts Fernet tokens with the Rust-backed ``rfernet`` library
+
+    Tokens are identical to what ``cryptography.fernet.Fernet`` makes; this
+    just hides that rfernet wants ``str`` tokens and raises its own error.
+
+    :param key: The shared secret; a url-safe base64 encoded 32 byte key
+    :type key: Bytes
+    """
+    __slots__ = ('_fernet',)
+
+    def __init__(self, key):
+        self._fernet = rfernet.Fernet(key.decode())
+
+    def decrypt(self, data):
+        """Decrypt the supplied Fernet token
+
+        :Returns: Bytes
+
+        :Raises: cryptography.fernet.InvalidToken
+
+        :param data: The Fernet token to decrypt
+        :type data: Bytes
+        """
+        try:
+            return self._fernet.decrypt(data.decode('ascii'))
+        except (rfernet.DecryptionError, UnicodeDecodeError) as doh:
+            raise InvalidToken() from doh
+
+
+def make_fernet(key):
+    """Use rfernet if it's installed (and not disabled), otherwise pyca's Fernet
+
+    :Returns: Object with a ``decrypt`` method
+
+    :param key: The shared secret; a url-safe base64 encoded 32 byte key
+    :type key: Bytes
+    """
+    if USE_RFERNET and rfernet is not None:
+        return RFernetCipher(key)
+    return Fernet(key)
+
+
+def shared_cipher(make, key):
+    """Build a cipher once per key, and hand out that same object afterwards
+
+    Workers are constructed in the manager's process before they're started,
+    so every forked worker inherits the one cipher (and threaded workers just
+    share it) instead of each worker building their own.
+
+    :Returns: Object with a ``decrypt`` method
+
+    :param make: Creates the cipher; i.e. ``make_fernet`` or ``AESGCMCipher``
+    :type make: Callable
+
+    :param key: The shared secret
+    :type key: Bytes
+    """
+    cache_key = (make, key)
+    cipher = CIPHERS.get(cache_key)
+    if cipher is None:
+        cipher = CIPHERS[cache_key] = make(key)
+    return cipher
+
+
+class AESGCMCipher:
+    """Decrypts log messages that the log exporter encrypted with AES-GCM
+
+    The first 12 bytes of a message are the nonce. Messages that are not
+    AES-GCM are tried as Fernet tokens, so exporters can be switched over
+    one at a time.
+
+    :param key: The shared secret; it's hashed into a 256 bit AES key
+    :type key: Bytes
+    """
+    # Every record is decrypted, so keep the attribute lookups in decrypt cheap
+    __slots__ = ('_aead', '_fernet')
+
+    def __init__(self, key):
+        self._aead = AESGCM(hashlib.sha256(key).digest())
+        self._fernet = make_fernet(key)
+
+    def decrypt(self, data):
+        """Decrypt the supplied bytes
+
+        :Returns: Bytes
+
+        :Raises: cryptography.fernet.InvalidToken
+
+        :param data: The nonce and cipher text to decrypt
+        :type data: Bytes
+        """
+        try:
+            return self._aead.decrypt(data[:12], data[12:], None)
+        except (InvalidTag, ValueError):
+            # Raises InvalidToken if it's not Fernet either, so callers
+            # don't care which cipher is used
+            return self._fernet.decrypt(data)
+
+
+@lru_cache(maxsize=None)
+def read_secret(path):
+    """Read a password or cipher key from a file, only once per file
+
+    Workers are constructed in the manager's process, so scaling up doesn't
+    re-read the same files for every new worker.
+
+    :Returns: Bytes
+
+    :param path: The location of the file with the secret
+    :type path: String
+    """
+    with open(path, 'rb') as the_file:
+        return the_file.read().strip()
+
+
+def log_cipher(key):
+    """The shared cipher for decrypting log data, based on the ``LOG_CIPHER`` setting
+
+    AES-GCM skips the base64 encoding and decoding that Fernet tokens require,
+    and ``AESGCMCipher`` still decrypts Fernet tokens, so producers can switch
+    over whenever.
+
+    :Returns: Object with a ``decrypt`` method
+
+    :param key: The shared secret
+    :type key: Bytes
+    """
+    if LOG_CIPHER == 'aesgcm':
+        return shared_cipher(AESGCMCipher, key)
+    return shared_cipher(make_fernet, key)
+
+
+class LogWorkerConfig(namedtuple('LogWorkerConfig', 'server user doc_type passwd_file cipher_key_file')):
+    """The settings a ``LogWorker`` needs to upload to ElasticSearch
+
+    :param server: The IP/FQDN of the ElasticSearch server
+    :type server: String
+
+    :param user: The user with write permissions on the ElasticSearch server
+    :type user: String
+
+    :param doc_type: The name/category/type of document to upload
+    :type doc_type: String
+
+    :param passwd_file: The location of the file with the user's password
+    :type passwd_file: String
+
+    :param cipher_key_file: The location of the file with the key to decrypt log data
+    :type cipher_key_file: String
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_env(cls):
+        """Read the settings from the environment variables the Docker images set
+
+        :Returns: LogWorkerConfig
+
+        :Raises: KeyError if one of the environment variables isn't set
+        """
+        return cls(server=environ['ELASTICSEARCH_SERVER'],
+                   user=environ['ELASTICSEARCH_USER'],
+                   doc_type=environ['ELASTICSEARCH_DOC_TYPE'],
+                   passwd_file=environ['ELASTICSEARCH_PASSWD_FILE'],
+                   cipher_key_file=environ['CIPHER_KEY_FILE'])
 
 
 class Worker(Process, ABC):
     """Carries out the processing of log data from an event queue"""
-    def __init__(self, work_group, work_queue, idle_queue):
+    def __init__(self, work_group, work_queue, idle_queue, backlog=None):
         super(Process, self).__init__()
         self.work_group = work_group
         self.work_queue = work_queue
         self.idle_queue = idle_queue
+        self.backlog = backlog
+        self.pending = deque()
+        self.taken = 0 # records pulled off the work_queue, but not yet subtracted from the backlog
+        self.handled = 0 # records processed; see MAX_RECORDS_PER_WORKER
         self.keep_running = True
         self.log = get_logger(self.name)
 
     def run(self):
-        """Defines the looping logic of the worker while it processes events"""
+        """Defines the looping logic of the worker while it processes events
+
+        The actual loop is ``_inner_run``; any error ends it, and is handled here
+        so the per-record loop doesn't need its own exception handling.
+        """
         self.log.info('Starting')
+        try:
+            self._inner_run()
+        except Exception as doh:
+            self.return_pending()
+            self.report_taken(self.taken)
+            try:
+                self.flush_on_term()
+            except Exception as ugh:
+                # Flushing the buffer(s) might have had the error, plus
+                # this is just a 'best effort' to no lose data
+                self.log.exception(ugh)
+            else:
+                self.log.exception(doh)
+            self.keep_running = False
+            self.idle_queue.put((self.name, '{}'.format(doh)))
+
+    def _inner_run(self):
+        """Pull records off the work_queue and process them until told to stop"""
+        idle = False
         while self.keep_running:
             try:
-                data = self.work_queue.get(block=True)
-                if data == SENTINEL:
-                    self.keep_running = False
-                    self.idle_queue.put((self.name, ''))
-                    self.flush_on_term()
-                    break
-                self.process_data(data)
-            except Exception as doh:
-                try:
-                    self.flush_on_term()
-                except Exception as ugh:
-                    # Flushing the buffer(s) might have had the error, plus
-                    # this is just a 'best effort' to no lose data
-                    self.log.exception(ugh)
-                else:
-                    self.log.exception(doh)
-                self.keep_running = False
-                self.idle_queue.put((self.name, '{}'.format(doh)))
+                data = self.next_item(block=idle)
+            except queue.Empty:
+                # About to idle, so let the manager know we're caught up
+                self.taken = self.report_taken(self.taken)
+                self.on_idle()
+                idle = True
+                continue
+            idle = False
+            if data is SENTINEL:
+                self.retire()
+                break
+            self.taken += 1
+            if self.taken >= BACKLOG_BATCH:
+                self.taken = self.report_taken(self.taken)
+            self.process_data(data)
+            self.handled += 1
+            if self.handled == MAX_RECORDS_PER_WORKER:
+                self.retire(RECYCLED)
                 break
 
+    def retire(self, reason=''):
+        """Stop processing, and let the manager know this worker is done
+
+        :Returns: None
+
+        :param reason: Why the worker is retiring. An empty string means it was
+                       told to (i.e. scaling down), and ``RECYCLED`` means it
+                       hit MAX_RECORDS_PER_WORKER and needs to be replaced.
+        :type reason: String
+        """
+        self.keep_running = False
+        self.return_pending()
+        self.taken = self.report_taken(self.taken)
+        self.idle_queue.put((self.name, reason))
+        self.flush_on_term()
+
+    def next_item(self, block):
+        """Pull the next record to process off the work_queue
+
+        When the work_queue is a ``faster_fifo.Queue``, up to ``BACKLOG_BATCH``
+        records are pulled at once and handed out one at a time. Otherwise, the
+        manager sends lists of records (see ``manager.put_work``), which get
+        handed out the same way.
+
+        :Returns: Object
+
+        :Raises: queue.Empty when there's no work, or when ``block`` is True and
+                 no work showed up within ``WAIT_FOR_WORK_ITEM`` seconds
+
+        :param block: Set to True to wait for a record to process
+        :type block: Boolean
+        """
+        if self.pending:
+            return self.pending.popleft()
+        if not hasattr(self.work_queue, 'get_many'):
+            item = self.work_queue.get(block=block, timeout=WAIT_FOR_WORK_ITEM)
+            if not isinstance(item, list):
+                # i.e. the SENTINEL
+                return item
+            self.pending.extend(item)
+            return self.pending.popleft()
+        records = self.work_queue.get_many(block=block,
+                                           timeout=WAIT_FOR_WORK_ITEM,
+                                           max_messages_to_get=BACKLOG_BATCH)
+        self.pending.extend(records)
+        return self.pending.popleft()
+
+    def return_pending(self):
+        """Put any records this worker pulled, but will not process, back into the work_queue"""
+        if not self.pending:
+            return
+        records = list(self.pending)
+        self.pending.clear()
+        if hasattr(self.work_queue, 'put_many'):
+            self.work_queue.put_many(records)
+        else:
+            self.work_queue.put(records)
+
+    def report_taken(self, taken):
+        """Subtract the number of records taken from the work_queue from the shared backlog
+
+        :Returns: Integer (always zero, to reset the caller's counter)
+
+        :param taken: The number of records taken since the last update
+        :type taken: Integer
+        """
+        if taken and self.backlog is not None:
+            with self.backlog.get_lock():
+                self.backlog.value -= taken
+        return 0
+
+    def on_idle(self):
+        """Callback for when the work_queue is empty; called again every ``WAIT_FOR_WORK_ITEM`` seconds while idle"""
+        pass
+
     @abstractmethod
     def process_data(self, data):
         """Defines how a specific worker should process an event off the Kafka topic"""
@@ -71,29 +372,61 @@ class Worker(Process, ABC):
 
 
 class LogWorker(Worker):
-    """Handles processing logs and then uploading data to ElasticSearch"""
-    def __init__(self, work_group, work_queue, idle_queue):
-        super().__init__(work_group, work_queue, idle_queue)
-        server = environ['ELASTICSEARCH_SERVER']
-        user = environ['ELASTICSEARCH_USER']
-        doc_type = environ['ELASTICSEARCH_DOC_TYPE']
-        with open(environ['ELASTICSEARCH_PASSWD_FILE'], 'rb') as pw_file:
-            password = pw_file.read().strip()
-        with open(environ['CIPHER_KEY_FILE'], 'rb') as cipher_file:
-            self.cipher_key = cipher_file.read().strip()
+    """Handles processing logs and then uploading data to ElasticSearch
+
+    :param config: Where to upload to. Default is ``LogWorkerConfig.from_env()``
+    :type config: LogWorkerConfig
+    """
+    def __init__(self, work_group, work_queue, idle_queue, backlog=None, config=None):
+        super().__init__(work_group, work_queue, idle_queue, backlog)
+        if config is None:
+            config = LogWorkerConfig.from_env()
+        self.cipher_key = read_secret(config.cipher_key_file)
         self.get_cipher()
-        self.es = ElasticSearch(server, user, password, doc_type)
+        self.es = ElasticSearch(config.server, config.user, read_secret(config.passwd_file), config.doc_type)
+        self.documents = []
+        self.documents_size = 0
+        self.documents_since = 0 # when the oldest buffered document was added
 
     def process_data(self, data):
-        """Convert the log event into a JSON document, then upload to ElasticSearch"""
+        """Convert the log event into a JSON document, then upload to ElasticSearch
+
+        Documents are buffered, and uploaded in bulk once there's ``BULK_MAX_DOCS``
+        of them, ``BULK_MAX_BYTES`` worth of them, or the oldest one has been
+        buffered for ``BULK_MAX_AGE`` seconds.
+        """
         try:
-            info = self.extract(data)
-        except (ValueError, InvalidToken) as doh:
+            document = self.format_info(self.extract(data))
+        except BAD_RECORD as doh:
             self.log.error('Error: {}, Data: {}'.format(doh, data))
         else:
-            document = self.format_info(info)
             if document:
-                self.es.write(document)
+                if not self.documents:
+                    self.documents_since = time.monotonic()
+                self.documents.append(document)
+                self.documents_size += len(document)
+                if len(self.documents) >= BULK_MAX_DOCS or self.documents_size >= BULK_MAX_BYTES:
+                    self.flush_documents()
+                elif time.monotonic() - self.documents_since >= BULK_MAX_AGE:
+                    self.flush_documents()
+
+    def flush_documents(self):
+        """Upload any buffered documents to ElasticSearch"""
+        if self.documents:
+            # Only forget the documents once they're uploaded; if the write
+            # fails, ``flush_on_term`` gets another shot at them
+            self.es.write_many(self.documents)
+            self.documents = []
+            self.documents_size = 0
+
+    def on_idle(self):
+        """Don't let documents sit in the buffer for long while waiting for more work
+
+        Flushing every time the work_queue runs dry would mean a bulk request
+        per document whenever logs trickle in slower than they're processed.
+        """
+        if self.documents and time.monotonic() - self.documents_since >= BULK_MAX_AGE:
+            self.flush_documents()
 
     @abstractmethod
     def format_info(self, info):
@@ -107,12 +440,15 @@ class LogWorker(Worker):
         pass
 
     def get_cipher(self):
-        self.cipher = Fernet(self.cipher_key)
+        self.cipher = log_cipher(self.cipher_key)
 
     def extract(self, data):
         """Obtain the JSON object from the encrypted data"""
-        return ujson.loads(self.cipher.decrypt(data))
+        return orjson.loads(self.cipher.decrypt(data))
 
     def flush_on_term(self):
-        """Before terminating, close the connection to ElasticSearch"""
-        self.es.close()
+        """Before terminating, upload any buffered documents and close the connection to ElasticSearch"""
+        try:
+            self.flush_documents()
+        finally:
+            self.es.close()
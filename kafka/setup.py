@@ -1,7 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
+import os
+
 from setuptools import setup, find_packages
 
+ext_modules = []
+if os.environ.get('LOG_PROCESSOR_MYPYC', '').lower() in ('1', 'true', 'yes'):
+    # Optional; compiles the per-record log parsing into C extensions.
+    # Requires mypy at build time, and produces a platform-specific wheel.
+    from mypyc.build import mypycify
+    ext_modules = mypycify(['log_processor/processors/dns_parser.py',
+                            'log_processor/processors/web_parser.py',
+                            'log_processor/processors/worker_parser.py'])
 
 setup(name="log-processor",
       author="Nicholas Willhite,",
@@ -19,5 +29,7 @@ setup(name="log-processor",
       ],
       description="A system to process vLab logging data",
       long_description=open('README.rst').read(),
-      install_requires=['ujson', 'cryptography', 'setproctitle', 'kafka-python', 'requests']
+      install_requires=['cryptography', 'setproctitle', 'kafka-python', 'requests', 'orjson'],
+      extras_require={'fast': ['faster-fifo', 'rfernet']},
+      ext_modules=ext_modules,
       )
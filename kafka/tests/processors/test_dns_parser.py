@@ -0,0 +1,35 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the ``dns_parser.py`` module"""
+import unittest
+
+from log_processor.processors import dns_parser
+
+
+class TestParse(unittest.TestCase):
+    """A suite of test cases for the ``parse`` function"""
+    def test_parse_update(self):
+        """``parse`` identifies a DDNS update, and the client that sent it"""
+        log_message = "03-Apr-2019 21:55:46.589 client @0x7f67a40db150 10.241.80.79#38373/key ddns_update: updating zone 'vlab.emc.com/IN': adding an RR at 'batinj.vlab.emc.com' A 10.241.80.79"
+
+        parsed = dns_parser.parse(log_message)
+        expected = {'timestamp': '2019/04/03 21:55:46', 'query': False, 'update': True, 'client_ip': '10.241.80.79'}
+
+        self.assertEqual(parsed, expected)
+
+    def test_parse_month(self):
+        """``parse`` converts every month abbreviation to its number"""
+        log_message = '31-Dec-2019 23:59:59.999 resolver priming query complete'
+
+        parsed = dns_parser.parse(log_message)
+        expected = '2019/12/31 23:59:59'
+
+        self.assertEqual(parsed['timestamp'], expected)
+
+    def test_parse_bad_format(self):
+        """``parse`` raises ValueError if the log message has no timestamp"""
+        with self.assertRaises(ValueError):
+            dns_parser.parse('not a dns log')
+
+
+if __name__ == '__main__':
+    unittest.main()
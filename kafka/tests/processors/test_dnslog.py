@@ -2,62 +2,64 @@
 """A suite of unit tests for the ``dnslog`` module"""
 import unittest
 from unittest.mock import patch, MagicMock
-import builtins
-import os
+
+import orjson
 
 from log_processor import worker
 from log_processor.processors import dnslog
 
 
+# The workers read their settings from here instead of environment variables
+CONFIG = worker.LogWorkerConfig(server='127.0.0.1',
+                                user='bob',
+                                doc_type='someLogType',
+                                passwd_file='./.fake_file.txt',
+                                cipher_key_file='./.fake_file.txt')
+
+
 class TestDnsLog(unittest.TestCase):
     """A suite of test cases for the ``DnsLogWorker`` object"""
     @classmethod
-    def setUp(cls):
-        """Runs before every test case"""
-        os.environ['CIPHER_KEY_FILE'] = './.fake_file.txt'
-        os.environ['ELASTICSEARCH_SERVER'] = '127.0.0.1'
-        os.environ['ELASTICSEARCH_USER'] = 'bob'
-        os.environ['ELASTICSEARCH_DOC_TYPE'] = 'someLogType'
-        os.environ['ELASTICSEARCH_PASSWD_FILE'] = './.fake_file.txt'
+    def setUpClass(cls):
+        """Runs once for the entire test suite, before any test cases"""
+        cls.work_queue = MagicMock()
+        cls.idle_queue = MagicMock()
 
-    @classmethod
-    def tearDown(cls):
-        """Runs after every test case"""
-        os.environ.pop('CIPHER_KEY_FILE', None)
-        os.environ.pop('ELASTICSEARCH_SERVER', None)
-        os.environ.pop('ELASTICSEARCH_USER', None)
-        os.environ.pop('ELASTICSEARCH_DOC_TYPE', None)
-        os.environ.pop('ELASTICSEARCH_PASSWD_FILE', None)
-
-    @patch.object(worker, 'ElasticSearch')
-    @patch.object(worker, 'Fernet')
-    @patch.object(builtins, "open")
-    def test_init(self, fake_open, fake_Fernet, fake_ElasticSearch):
+    def setUp(self):
+        """Runs before every test case"""
+        self.fake_ElasticSearch = self.start_patch(patch.object(worker, 'ElasticSearch'))
+        self.fake_Fernet = self.start_patch(patch.object(worker, 'Fernet'))
+        self.start_patch(patch.object(worker, 'read_secret'))
+        # Every worker reads the same fake key, so don't hand out a cached cipher
+        self.start_patch(patch.dict(worker.CIPHERS, clear=True))
+        self.work_queue.reset_mock()
+        self.idle_queue.reset_mock()
+
+    def start_patch(self, patcher):
+        """Start a patch that's undone after the test case"""
+        fake = patcher.start()
+        self.addCleanup(patcher.stop)
+        return fake
+
+    def test_init(self):
         """``DnsLogWorker`` accepts standard ``Worker`` init params"""
         work_group = 'web'
-        work_queue = MagicMock()
-        idle_queue = MagicMock()
 
-        dns_worker = dnslog.DnsLogWorker(work_group, work_queue, idle_queue)
+        dns_worker = dnslog.DnsLogWorker(work_group, self.work_queue, self.idle_queue, config=CONFIG)
 
         self.assertTrue(isinstance(dns_worker, worker.Worker))
 
-    @patch.object(worker, 'ElasticSearch')
-    @patch.object(worker, 'Fernet')
-    @patch.object(builtins, "open")
-    def test_format_info(self, fake_open, fake_Fernet, fake_ElasticSearch):
+    def test_format_info(self):
         """``DnsLogWorker`` 'format_info' returns a JSON document"""
         work_group = 'web'
-        work_queue = MagicMock()
-        idle_queue = MagicMock()
         info = {'name' : 'system_dns_1',
                 'log' : '03-Apr-2019 20:31:41.392 client @0x7f67b02031b0 172.21.0.16#47486 (willhn.vlab.emc.com): query: willhn.vlab.emc.com IN AAAA + (10.241.80.49)'}
 
-        dns_worker = dnslog.DnsLogWorker(work_group, work_queue, idle_queue)
+        dns_worker = dnslog.DnsLogWorker(work_group, self.work_queue, self.idle_queue, config=CONFIG)
         json_doc = dns_worker.format_info(info)
-        expected = '{"service":"system_dns_1","log":"03-Apr-2019 20:31:41.392 client @0x7f67b02031b0 172.21.0.16#47486 (willhn.vlab.emc.com): query: willhn.vlab.emc.com IN AAAA + (10.241.80.49)","timestamp":"2019\\/04\\/03 20:31:41","query":true,"update":false,"client_ip":"172.21.0.16"}'
+        expected = b'{"service":"system_dns_1","log":"03-Apr-2019 20:31:41.392 client @0x7f67b02031b0 172.21.0.16#47486 (willhn.vlab.emc.com): query: willhn.vlab.emc.com IN AAAA + (10.241.80.49)","timestamp":"2019/04/03 20:31:41","query":true,"update":false,"client_ip":"172.21.0.16"}'
 
-        self.assertEqual(json_doc, expected)
+        self.assertEqual(orjson.loads(json_doc), orjson.loads(expected))
 
     def test_get_timestamp(self):
         """``DnsLogWorker`` 'get_time_stamp' returns an ElasticSearch friendly timestamp"""
@@ -68,6 +70,15 @@ class TestDnsLog(unittest.TestCase):
 
         self.assertEqual(timestamp, expected)
 
+    def test_get_timestamp_december(self):
+        """``DnsLogWorker`` 'get_time_stamp' matches what strptime/strftime would produce"""
+        log_message = '31-Dec-2019 23:59:59.999 client @0x7f67b02031b0 172.21.0.16#47486 (willhn.vlab.emc.com): query: willhn.vlab.emc.com IN AAAA + (10.241.80.49)'
+
+        timestamp = dnslog.DnsLogWorker.get_timestamp(log_message)
+        expected = '2019/12/31 23:59:59'
+
+        self.assertEqual(timestamp, expected)
+
     def test_is_update(self):
         """``DnsLogWorker`` 'is_update' correctly identifies a log message when it's a DDNS update"""
         log_message = "03-Apr-2019 21:55:46.589 client @0x7f67a40db150 10.241.80.79#38373/key ddns_update: updating zone 'vlab.emc.com/IN': adding an RR at 'batinj.vlab.emc.com' A 10.241.80.79"
@@ -100,6 +111,29 @@ class TestDnsLog(unittest.TestCase):
 
         self.assertFalse(is_query)
 
+    def test_parse(self):
+        """``DnsLogWorker`` '_parse' extracts every field from the log message"""
+        log_message = "03-Apr-2019 20:35:20.080 client @0x7f67882c0cd0 172.21.0.16#58693 (willhn.vlab.emc.com): query: willhn.vlab.emc.com IN A + (10.241.80.49)"
+
+        parsed = dnslog.DnsLogWorker._parse(log_message)
+        expected = {'timestamp': '2019/04/03 20:35:20', 'query': True, 'update': False, 'client_ip': '172.21.0.16'}
+
+        self.assertEqual(parsed, expected)
+
+    def test_parse_no_client(self):
+        """``DnsLogWorker`` '_parse' handles log messages that aren't about a client"""
+        log_message = '03-Apr-2019 21:50:42.811 resolver priming query complete'
+
+        parsed = dnslog.DnsLogWorker._parse(log_message)
+        expected = {'timestamp': '2019/04/03 21:50:42', 'query': False, 'update': False, 'client_ip': ''}
+
+        self.assertEqual(parsed, expected)
+
+    def test_parse_bad_format(self):
+        """``DnsLogWorker`` '_parse' raises ValueError if the log message has no timestamp"""
+        with self.assertRaises(ValueError):
+            dnslog.DnsLogWorker._parse('not a dns log')
+
     def test_get_client_ip(self):
         """``DnsLogWorker`` 'get_client_ip' returns the client IP when logged"""
         log_message = "03-Apr-2019 21:52:47.703 client @0x7f67b02686a0 10.241.80.69#45154 (vs.login.msa.akadns6.net): query: vs.login.msa.akadns6.net IN A +E(0)DCV (10.241.80.49)"
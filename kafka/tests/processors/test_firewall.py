@@ -1,19 +1,35 @@
 # -*- coding: UTF-8 -*-
 """A suite of unit tests for the ``firewall.py`` worker module"""
 import unittest
-from unittest.mock import patch, MagicMock, mock_open
+from unittest.mock import patch, Mock
 import os
-import builtins
 
-import ujson
+import orjson
 from cryptography.fernet import Fernet, InvalidToken
 
 from log_processor.processors import firewall
+from log_processor import worker
 from log_processor.worker import Worker
 
 
+# The worker reads its settings from here instead of environment variables
+CONFIG = firewall.FirewallConfig(server='myInfluxServer',
+                                 user='alice',
+                                 passwd_file='./.fake_file.txt',
+                                 cipher_key_file='./.fake_file.txt')
+# Every test just needs *a* valid cipher, so don't generate a new key per test
+SHARED_CIPHER = Fernet(Fernet.generate_key())
+# For making tokens the FirewallWorker cannot decrypt
+OTHER_CIPHER = Fernet(Fernet.generate_key())
+
+
 def fake_get_cipher(self):
-    self.cipher = Fernet(Fernet.generate_key())
+    self.cipher = SHARED_CIPHER
+
+
+def fake_read_secret(path):
+    """Stands in for reading the password/key files"""
+    return b'fakepw'
 
 
 class TestFirewallWorker(unittest.TestCase):
@@ -22,118 +38,109 @@ class TestFirewallWorker(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         """Runs once for the entire test suite, before any test cases"""
-        os.environ['INFLUXDB_SERVER'] = 'myInfluxServer'
-        os.environ['INFLUXDB_USER'] = 'alice'
-        os.environ['INFLUXDB_PASSWD_FILE'] = './.fake_file.txt'
-        os.environ['CIPHER_KEY_FILE'] = './.fake_file.txt'
-
-    @classmethod
-    def tearDownClass(cls):
-        """Run once for the entire test suite, after all test cases"""
-        os.environ.pop('INFLUXDB_SERVER', None)
-        os.environ.pop('INFLUXDB_USER', None)
-        os.environ.pop('INFLUXDB_PASSWD_FILE', None)
-        os.environ.pop('CIPHER_KEY_FILE', None)
-
-    @classmethod
-    def setUp(cls):
+        cls.work_queue = Mock()
+        cls.idle_queue = Mock()
+        # Every test case shares one worker; setUp resets its fakes
+        with patch('log_processor.processors.firewall.InfluxDB'), \
+             patch.object(firewall.FirewallWorker, 'get_cipher', fake_get_cipher), \
+             patch.object(firewall, 'read_secret', fake_read_secret):
+            cls.fw = firewall.FirewallWorker(work_group='firewall', work_queue=cls.work_queue, idle_queue=cls.idle_queue, config=CONFIG)
+        cls.fw.log = Mock()
+        # Encrypting is the slow part of building test data, so only do it once
+        cls.TEST_OBJ = {'user' : 'bob', 'time' : 1234, 'source' : '192.168.1.56', 'target' : '10.7.1.2'}
+        cls.TEST_PAYLOAD = SHARED_CIPHER.encrypt(orjson.dumps(cls.TEST_OBJ))
+        cls.OTHER_PAYLOAD = OTHER_CIPHER.encrypt(orjson.dumps(cls.TEST_OBJ))
+        cls.EXTRACT_PAYLOAD = SHARED_CIPHER.encrypt(orjson.dumps({"works": True}))
+        cls.BAD_JSON_PAYLOAD = SHARED_CIPHER.encrypt(b'Not JSON')
+        cls.MISSING_FIELD_PAYLOAD = SHARED_CIPHER.encrypt(orjson.dumps({'user' : 'bob', 'time' : 1234}))
+
+    def setUp(self):
         """Runs before every test case"""
-        cls.patcher = patch('log_processor.processors.firewall.InfluxDB')
-        cls.fake_InfluxDB = cls.patcher.start()
+        self.work_queue.reset_mock()
+        self.idle_queue.reset_mock()
+        self.fw.influx.reset_mock()
+        self.fw.log.reset_mock()
 
-    @classmethod
-    def tearDown(cls):
-        """Runs after every test case"""
-        cls.patcher.stop()
-        cls.fake_InfluxDB = None
-
-    @patch.object(firewall.FirewallWorker, 'get_cipher', fake_get_cipher)
-    @patch('builtins.open', new_callable=mock_open())
-    def test_init_firewallworker(self, fake_open):
+    def test_init_firewallworker(self):
         """``FirewallWorker`` Is a sublcass of 'log_processor.worker.Worker'"""
-        work_queue = MagicMock()
-        idle_queue = MagicMock()
-        fw = firewall.FirewallWorker(work_group='firewall', work_queue=work_queue, idle_queue=idle_queue)
+        self.assertTrue(isinstance(self.fw, Worker))
 
-        self.assertTrue(isinstance(fw, Worker))
+    def test_config_from_env(self):
+        """``FirewallConfig`` 'from_env' reads the settings from environment variables"""
+        env = {'INFLUXDB_SERVER' : 'myInfluxServer',
+               'INFLUXDB_USER' : 'alice',
+               'INFLUXDB_PASSWD_FILE' : './.fake_file.txt',
+               'CIPHER_KEY_FILE' : './.fake_file.txt'}
+        with patch.dict(os.environ, env):
+            config = firewall.FirewallConfig.from_env()
 
-    @patch.object(firewall.FirewallWorker, 'get_cipher', fake_get_cipher)
-    @patch('builtins.open', new_callable=mock_open())
-    def test_extract(self, fake_open):
-        """``FirewallWorker`` can convert the encrypted JSON data into a usable object"""
-        work_queue = MagicMock()
-        idle_queue = MagicMock()
-        fw = firewall.FirewallWorker(work_group='firewall', work_queue=work_queue, idle_queue=idle_queue)
+        self.assertEqual(config, CONFIG)
 
-        test_obj = {"works": True}
-        test_data = fw.cipher.encrypt(ujson.dumps(test_obj).encode())
-        answer = fw.extract(test_data)
+    @patch.object(worker, 'LOG_CIPHER', 'aesgcm')
+    @patch.dict(worker.CIPHERS, clear=True)
+    def test_get_cipher_aesgcm(self):
+        """``FirewallWorker`` decrypts with AES-GCM when LOG_CIPHER is 'aesgcm'"""
+        fake_fw = Mock()
+        fake_fw.cipher_key = Fernet.generate_key()
 
-        self.assertEqual(test_obj, answer)
+        firewall.FirewallWorker.get_cipher(fake_fw)
 
-    @patch.object(firewall.FirewallWorker, 'get_cipher', fake_get_cipher)
-    @patch('builtins.open', new_callable=mock_open())
-    def test_flush(self, fake_open):
+        self.assertTrue(isinstance(fake_fw.cipher, worker.AESGCMCipher))
+
+    def test_extract(self):
+        """``FirewallWorker`` can convert the encrypted JSON data into a usable object"""
+        answer = self.fw.extract(self.EXTRACT_PAYLOAD)
+
+        self.assertEqual({"works": True}, answer)
+
+    def test_flush(self):
         """``FirewallWorker`` tells the 'InfluxDB' to flush pending writes on termination"""
-        work_queue = MagicMock()
-        idle_queue = MagicMock()
-        fw = firewall.FirewallWorker(work_group='firewall', work_queue=work_queue, idle_queue=idle_queue)
-        fw.flush_on_term()
+        self.fw.flush_on_term()
 
-        called_flush = fw.influx.flush.called
+        called_flush = self.fw.influx.flush.called
 
         self.assertTrue(called_flush)
 
-    @patch.object(firewall.FirewallWorker, 'get_cipher', fake_get_cipher)
-    @patch('builtins.open', new_callable=mock_open())
-    def test_process_data(self, fake_open):
-        """``FirewallWorker`` writes data to InfluxDB while processing data"""
-        work_queue = MagicMock()
-        idle_queue = MagicMock()
-        fw = firewall.FirewallWorker(work_group='firewall', work_queue=work_queue, idle_queue=idle_queue)
+    def test_on_idle(self):
+        """``FirewallWorker`` sends stale data points to InfluxDB while idle"""
+        self.fw.on_idle()
 
-        test_obj = {'user' : 'bob', 'time' : 1234, 'source' : '192.168.1.56', 'target' : '10.7.1.2'}
-        test_data = fw.cipher.encrypt(ujson.dumps(test_obj).encode())
-        fw.process_data(test_data)
+        the_args, the_kwargs = self.fw.influx.flush_stale.call_args
 
-        called_write = fw.influx.write.called
+        self.assertEqual(the_kwargs['max_age'], firewall.IDLE_FLUSH_AGE)
 
-        self.assertTrue(called_write)
+    def process_data(self, payload):
+        """Have the shared worker process the payload, and report if it wrote to InfluxDB"""
+        self.fw.process_data(payload)
+        return self.fw.influx.write_line.called
 
-    @patch.object(firewall.FirewallWorker, 'get_cipher', fake_get_cipher)
-    @patch('builtins.open', new_callable=mock_open())
-    def test_process_data_invalid_token(self, fake_open):
-        """``FirewallWorker`` gracefully handles incorrectly encrypted data"""
-        work_queue = MagicMock()
-        idle_queue = MagicMock()
-        fw = firewall.FirewallWorker(work_group='firewall', work_queue=work_queue, idle_queue=idle_queue)
-        fw.log = MagicMock()
+    def test_process_data(self):
+        """``FirewallWorker`` writes data to InfluxDB while processing data"""
+        self.process_data(self.TEST_PAYLOAD)
 
-        cipher = Fernet(Fernet.generate_key())
-        test_obj = {'user' : 'bob', 'time' : 1234, 'source' : '192.168.1.56', 'target' : '10.7.1.2'}
-        test_data = cipher.encrypt(ujson.dumps(test_obj).encode())
-        fw.process_data(test_data)
+        the_args, _ = self.fw.influx.write_line.call_args
+        expected = 'firewall,username="bob" user="bob",source="192.168.1.56",target="10.7.1.2",packets=1 1234'
 
-        called_write = fw.influx.write.called
+        self.assertEqual(the_args[0], expected)
+
+    def test_process_data_invalid_token(self):
+        """``FirewallWorker`` gracefully handles incorrectly encrypted data"""
+        called_write = self.process_data(self.OTHER_PAYLOAD)
 
         self.assertFalse(called_write)
 
-    @patch.object(firewall.FirewallWorker, 'get_cipher', fake_get_cipher)
-    @patch('builtins.open', new_callable=mock_open())
-    def test_process_data_bad_json(self, fake_open):
+    def test_process_data_bad_json(self):
         """``FirewallWorker`` gracefully handles invalid JSON data"""
-        work_queue = MagicMock()
-        idle_queue = MagicMock()
-        fw = firewall.FirewallWorker(work_group='firewall', work_queue=work_queue, idle_queue=idle_queue)
-        fw.log = MagicMock()
+        called_write = self.process_data(self.BAD_JSON_PAYLOAD)
 
-        cipher = Fernet(Fernet.generate_key())
-        test_data = cipher.encrypt(b'Not JSON')
-        fw.process_data(test_data)
+        self.assertFalse(called_write)
 
-        called_write = fw.influx.write.called
+    def test_process_data_missing_field(self):
+        """``FirewallWorker`` logs and skips events that are missing a field"""
+        called_write = self.process_data(self.MISSING_FIELD_PAYLOAD)
 
         self.assertFalse(called_write)
+        self.assertTrue(self.fw.log.error.called)
 
 
 if __name__ == '__main__':
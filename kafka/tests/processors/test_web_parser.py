@@ -0,0 +1,78 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the ``web_parser.py`` module"""
+import unittest
+
+from log_processor.processors import web_parser
+
+
+class TestParse(unittest.TestCase):
+    """A suite of test cases for the ``parse`` function"""
+    def test_parse(self):
+        """``parse`` extracts the fields of an Apache-style log"""
+        log_message = '10.200.217.90 - unset [08/Apr/2019:22:21:57 -0000] "GET /api/1/inf/onefs/task/2b311e03-455c-4409-b8c7-425961533a44? HTTP/1.1" 200 248 "None" "vLab CLI 2019.03.28 rid=85c1c19d38e0485da38d4d0a9da2f43f"'
+
+        parsed = web_parser.parse(log_message, 'some container')
+        expected = {'source' : 'some container',
+                    'timestamp' : '2019/04/08 22:21:57',
+                    'user' : 'unset',
+                    'client_ip' : '10.200.217.90',
+                    'method' : 'GET',
+                    'url' : '/api/1/inf/onefs/task/2b311e03-455c-4409-b8c7-425961533a44?',
+                    'status_code' : '200',
+                    'user_agent' : 'vLab CLI 2019.03.28 ',
+                    'transaction_id' : '85c1c19d38e0485da38d4d0a9da2f43f',
+                    'log' : log_message}
+
+        self.assertEqual(parsed, expected)
+
+    def test_parse_other_log(self):
+        """``parse`` only sets the 'source' and 'log' for non-Apache logs"""
+        log_message = 'Traceback (most recent call last):\n'
+
+        parsed = web_parser.parse(log_message, 'some container')
+        populated = {k for k, v in parsed.items() if v is not None}
+        expected = {'source', 'log'}
+
+        self.assertEqual(populated, expected)
+
+
+class TestIsIp(unittest.TestCase):
+    """A suite of test cases for the ``is_ip`` function"""
+    def test_is_ip(self):
+        """``is_ip`` returns True for IPv4 addresses"""
+        self.assertTrue(web_parser.is_ip('10.200.217.90'))
+
+    def test_is_ip_v6(self):
+        """``is_ip`` returns True for IPv6 addresses"""
+        self.assertTrue(web_parser.is_ip('fe80::1'))
+
+    def test_is_ip_not_ip(self):
+        """``is_ip`` returns False for things that aren't IP addresses"""
+        for token in ('Traceback', '256.1.1.1', '01.2.3.4', '1.2.3', 'a.b.c.d', '1.2.3.4:80'):
+            self.assertFalse(web_parser.is_ip(token), token)
+
+class TestFormatTimestamp(unittest.TestCase):
+    """A suite of test cases for the ``format_timestamp`` function"""
+    def test_format_timestamp(self):
+        """``format_timestamp`` converts Apache timestamps to what ElasticSearch likes"""
+        formatted = web_parser.format_timestamp('[31/Dec/2019:23:59:59')
+        expected = '2019/12/31 23:59:59'
+
+        self.assertEqual(formatted, expected)
+
+    def test_format_timestamp_cached(self):
+        """``format_timestamp`` only formats a given timestamp once"""
+        web_parser.format_timestamp.cache_clear()
+        web_parser.format_timestamp('[31/Dec/2019:23:59:59')
+        web_parser.format_timestamp('[31/Dec/2019:23:59:59')
+
+        self.assertEqual(web_parser.format_timestamp.cache_info().hits, 1)
+
+    def test_format_timestamp_wrong_length(self):
+        """``format_timestamp`` raises ValueError on a truncated timestamp"""
+        with self.assertRaises(ValueError):
+            web_parser.format_timestamp('[31/Dec/2019:23:59')
+
+
+if __name__ == '__main__':
+    unittest.main()
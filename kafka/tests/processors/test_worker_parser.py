@@ -0,0 +1,114 @@
+# -*- coding: UTF-8 -*-
+"""A suite of unit tests for the ``worker_parser.py`` module"""
+import unittest
+
+from log_processor.processors import worker_parser
+
+LOG_MESSAGE = '[2019-04-11 15:51:10,530: WARNING/ForkPoolWorker-11] 2019-04-11 15:51:10,529 [7c7a53fa69a44201acf015f5964255b1] [e43ed12f-621e-41f7-8117-0f4c4c400602]: Task Starting\n'
+
+
+class TestExtractIds(unittest.TestCase):
+    """A suite of test cases for the ``extract_ids`` function"""
+    def test_extract_ids(self):
+        """``extract_ids`` returns the request ID and task ID from a worker log message"""
+        ids = worker_parser.extract_ids(LOG_MESSAGE)
+        expected = ('7c7a53fa69a44201acf015f5964255b1', 'e43ed12f-621e-41f7-8117-0f4c4c400602')
+
+        self.assertEqual(ids, expected)
+
+    def test_extract_ids_many(self):
+        """``extract_ids`` returns an empty string for an ID that shows up more than once"""
+        log_message = '[7c7a53fa69a44201acf015f5964255b1] [e43ed12f-621e-41f7-8117-0f4c4c400602] [e43ed12f-621e-41f7-8117-0f4c4c400603]'
+
+        ids = worker_parser.extract_ids(log_message)
+        expected = ('7c7a53fa69a44201acf015f5964255b1', '')
+
+        self.assertEqual(ids, expected)
+
+
+    def test_extract_ids_findall(self):
+        """``extract_ids`` finds the same IDs as searching for each kind of ID separately"""
+        log_message = 'a7c7a53fa69a44201acf015f5964255b1ffff abcdef01-e43ed12f-621e-41f7-8117-0f4c4c400602 1234'
+
+        ids = worker_parser.extract_ids(log_message)
+        request_ids = worker_parser.REQUEST_ID.findall(log_message)
+        task_ids = worker_parser.TASK_ID.findall(log_message)
+        expected = (request_ids[0], task_ids[0])
+
+        self.assertEqual(ids, expected)
+
+class TestGetTimestamp(unittest.TestCase):
+    """A suite of test cases for the ``get_timestamp`` function"""
+    def test_get_timestamp(self):
+        """``get_timestamp`` formats the timestamp for ElasticSearch"""
+        timestamp = worker_parser.get_timestamp(LOG_MESSAGE)
+        expected = '2019/04/11 15:51:10'
+
+        self.assertEqual(timestamp, expected)
+
+    def test_get_timestamp_not_fixed_width(self):
+        """``get_timestamp`` handles timestamps that aren't in the usual fixed-width layout"""
+        timestamp = worker_parser.get_timestamp('2019-4-11 15:51:10,530: WARNING/ForkPoolWorker-11]')
+        expected = '2019/4/11 15:51:10'
+
+        self.assertEqual(timestamp, expected)
+
+
+class TestSlashDate(unittest.TestCase):
+    """A suite of test cases for the ``slash_date`` function"""
+    def test_slash_date(self):
+        """``slash_date`` swaps the dashes in the date for slashes"""
+        timestamp = worker_parser.slash_date('2019-04-11 15:51:10')
+        expected = '2019/04/11 15:51:10'
+
+        self.assertEqual(timestamp, expected)
+
+    def test_slash_date_cached(self):
+        """``slash_date`` only formats a given timestamp once"""
+        worker_parser.slash_date.cache_clear()
+        worker_parser.slash_date('2019-04-11 15:51:10')
+        worker_parser.slash_date('2019-04-11 15:51:10')
+
+        self.assertEqual(worker_parser.slash_date.cache_info().hits, 1)
+
+
+class TestGetMessage(unittest.TestCase):
+    """A suite of test cases for the ``get_message`` function"""
+    def test_get_message(self):
+        """``get_message`` strips the meta-data from the log message"""
+        message = worker_parser.get_message(LOG_MESSAGE)
+        expected = 'Task Starting\n'
+
+        self.assertEqual(message, expected)
+
+    def test_get_message_no_meta_data(self):
+        """``get_message`` returns log messages without meta-data as is"""
+        message = worker_parser.get_message('just a message')
+        expected = 'just a message'
+
+        self.assertEqual(message, expected)
+
+class TestParse(unittest.TestCase):
+    """A suite of test cases for the ``parse`` function"""
+    def test_parse(self):
+        """``parse`` builds the document for a worker log message"""
+        parsed = worker_parser.parse(LOG_MESSAGE, 'some worker')
+        expected = {'service' : 'some worker',
+                    'task_id' : 'e43ed12f-621e-41f7-8117-0f4c4c400602',
+                    'request_id' : '7c7a53fa69a44201acf015f5964255b1',
+                    'started' : True,
+                    'completed' : False,
+                    'message' : 'Task Starting\n',
+                    'timestamp' : '2019/04/11 15:51:10'}
+
+        self.assertEqual(parsed, expected)
+
+    def test_parse_no_task_id(self):
+        """``parse`` returns None for log messages without a task ID"""
+        parsed = worker_parser.parse('some generic celery log', 'some worker')
+
+        self.assertTrue(parsed is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
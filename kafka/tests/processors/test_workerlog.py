@@ -1,75 +1,77 @@
 # -*- coding: UTF-8 -*-
 """A suite of unit tests for the ``workerlog`` module"""
 import unittest
-from unittest.mock import patch, MagicMock
-import builtins
-import os
+from unittest.mock import patch, Mock
+
+import orjson
 
 from log_processor import worker
 from log_processor.processors import workerlog
 
 
+# The workers read their settings from here instead of environment variables
+CONFIG = worker.LogWorkerConfig(server='127.0.0.1',
+                                user='bob',
+                                doc_type='someLogType',
+                                passwd_file='./.fake_file.txt',
+                                cipher_key_file='./.fake_file.txt')
+
+
+def fake_read_secret(path):
+    """Stands in for reading the password/key files"""
+    return b'fakepw'
+
+
 class TestWorkerLog(unittest.TestCase):
     """A suite of test cases for the ``WorkerLogWorker`` object"""
     @classmethod
-    def setUp(cls):
-        """Runs before every test case"""
-        os.environ['CIPHER_KEY_FILE'] = './.fake_file.txt'
-        os.environ['ELASTICSEARCH_SERVER'] = '127.0.0.1'
-        os.environ['ELASTICSEARCH_USER'] = 'bob'
-        os.environ['ELASTICSEARCH_DOC_TYPE'] = 'someLogType'
-        os.environ['ELASTICSEARCH_PASSWD_FILE'] = './.fake_file.txt'
+    def setUpClass(cls):
+        """Runs once for the entire test suite, before any test cases"""
+        cls.work_queue = Mock()
+        cls.idle_queue = Mock()
 
-    @classmethod
-    def tearDown(cls):
-        """Runs after every test case"""
-        os.environ.pop('CIPHER_KEY_FILE', None)
-        os.environ.pop('ELASTICSEARCH_SERVER', None)
-        os.environ.pop('ELASTICSEARCH_USER', None)
-        os.environ.pop('ELASTICSEARCH_DOC_TYPE', None)
-        os.environ.pop('ELASTICSEARCH_PASSWD_FILE', None)
-
-    @patch.object(worker, 'ElasticSearch')
-    @patch.object(worker, 'Fernet')
-    @patch.object(builtins, "open")
-    def test_init(self, fake_open, fake_Fernet, fake_ElasticSearch):
+    def setUp(self):
+        """Runs before every test case"""
+        self.fake_ElasticSearch = self.start_patch(patch.object(worker, 'ElasticSearch'))
+        self.fake_Fernet = self.start_patch(patch.object(worker, 'Fernet'))
+        self.start_patch(patch.object(worker, 'read_secret', fake_read_secret))
+        # Every worker reads the same fake key, so don't hand out a cached cipher
+        self.start_patch(patch.dict(worker.CIPHERS, clear=True))
+        self.work_queue.reset_mock()
+        self.idle_queue.reset_mock()
+
+    def start_patch(self, patcher):
+        """Start a patch that's undone after the test case"""
+        fake = patcher.start()
+        self.addCleanup(patcher.stop)
+        return fake
+
+    def test_init(self):
         """``WorkerLogWorker`` accepts standard ``Worker`` init params"""
         work_group = 'web'
-        work_queue = MagicMock()
-        idle_queue = MagicMock()
 
-        web_worker = workerlog.WorkerLogWorker(work_group, work_queue, idle_queue)
+        web_worker = workerlog.WorkerLogWorker(work_group, self.work_queue, self.idle_queue, config=CONFIG)
 
         self.assertTrue(isinstance(web_worker, worker.Worker))
 
-    @patch.object(worker, 'ElasticSearch')
-    @patch.object(worker, 'Fernet')
-    @patch.object(builtins, "open")
-    def test_format_info(self, fake_open, fake_Fernet, fake_ElasticSearch):
+    def test_format_info(self):
         """``WorkerLogWorker`` 'format_info' returns a JSON document for uploading to ElasticSearch"""
         work_group = 'web'
-        work_queue = MagicMock()
-        idle_queue = MagicMock()
         info = {'name' : 'vlab_cee-worker_1',
                 'log' : '[2019-04-11 15:51:10,530: WARNING/ForkPoolWorker-11] 2019-04-11 15:51:10,529 [7c7a53fa69a44201acf015f5964255b1] [e43ed12f-621e-41f7-8117-0f4c4c400602]: Some Message'}
-        web_worker = workerlog.WorkerLogWorker(work_group, work_queue, idle_queue)
+        web_worker = workerlog.WorkerLogWorker(work_group, self.work_queue, self.idle_queue, config=CONFIG)
 
         json_doc = web_worker.format_info(info)
-        expected = '{"service":"vlab_cee-worker_1","task_id":"e43ed12f-621e-41f7-8117-0f4c4c400602","request_id":"7c7a53fa69a44201acf015f5964255b1","started":false,"completed":false,"message":"Some Message","timestamp":"2019\\/04\\/11 15:51:10"}'
+        expected = b'{"service":"vlab_cee-worker_1","task_id":"e43ed12f-621e-41f7-8117-0f4c4c400602","request_id":"7c7a53fa69a44201acf015f5964255b1","started":false,"completed":false,"message":"Some Message","timestamp":"2019/04/11 15:51:10"}'
 
-        self.assertEqual(json_doc, expected)
+        self.assertEqual(orjson.loads(json_doc), orjson.loads(expected))
 
-    @patch.object(worker, 'ElasticSearch')
-    @patch.object(worker, 'Fernet')
-    @patch.object(builtins, "open")
-    def test_format_info_junk(self, fake_open, fake_Fernet, fake_ElasticSearch):
+    def test_format_info_junk(self):
         """``WorkerLogWorker`` 'format_info' returns an empty string if the log message lacks meta data"""
         work_group = 'web'
-        work_queue = MagicMock()
-        idle_queue = MagicMock()
         info = {'name' : 'vlab_cee-worker_1',
                 'log' : '[2019-04-11 15:51:10,530: WARNING/ForkPoolWorker-11] Some Message'}
-        web_worker = workerlog.WorkerLogWorker(work_group, work_queue, idle_queue)
+        web_worker = workerlog.WorkerLogWorker(work_group, self.work_queue, self.idle_queue, config=CONFIG)
 
         json_doc = web_worker.format_info(info)
         expected = ''
@@ -94,6 +96,15 @@ class TestWorkerLog(unittest.TestCase):
 
         self.assertEqual(request_id, expected)
 
+    def test_get_request_id_many(self):
+        """``WorkerLogWorker`` returns an empty string if there's more than one request id in the message"""
+        log_message = '[7c7a53fa69a44201acf015f5964255b1] [f7e1bb1ccfc14954900f4b379d89301a]: Some Message'
+
+        request_id = workerlog.WorkerLogWorker.get_request_id(log_message)
+        expected = ''
+
+        self.assertEqual(request_id, expected)
+
     def test_get_task_id(self):
         """``WorkerLogWorker`` extracts the task ID from a worker log message"""
         log_message = '[2019-04-11 15:51:10,530: WARNING/ForkPoolWorker-11] 2019-04-11 15:51:10,529 [7c7a53fa69a44201acf015f5964255b1] [e43ed12f-621e-41f7-8117-0f4c4c400602]: Some Message'
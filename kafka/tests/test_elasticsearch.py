@@ -1,14 +1,31 @@
 # -*- coding: UTF-8 -*-
 """A suite of unit tests for the ``elasticsearch`` module"""
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, Mock
 import time
 
 from log_processor import elasticsearch
 
+EXPECTED_INDEX = time.strftime('logs-%Y.%m.%d') # today's index; the date won't change mid-run
 
 class TestElasticSearch(unittest.TestCase):
     """A suite of test cases for the ElasticSearch object"""
+    @classmethod
+    def setUpClass(cls):
+        """Runs once for the entire test suite, before any test cases"""
+        cls.fake_resp = Mock()
+        cls.fake_session = Mock()
+        cls.fake_session.post.return_value = cls.fake_resp
+
+    def setUp(self):
+        """Runs before every test case"""
+        self.fake_session.reset_mock()
+        self.fake_resp.reset_mock()
+        self.fake_resp.json.return_value = {'errors': False}
+        patcher = patch.object(elasticsearch.requests, 'Session', return_value=self.fake_session)
+        self.fake_Session = patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_init(self):
         """``ElasticSearch`` does not IO upon __init__ of object"""
         es = elasticsearch.ElasticSearch(server='8.8.8.8',
@@ -26,17 +43,41 @@ class TestElasticSearch(unittest.TestCase):
                                          doc_type='someLogCategory')
 
         index = es.index
-        expected = time.strftime('logs-%Y.%m.%d')
+        expected = EXPECTED_INDEX
 
         self.assertEqual(index, expected)
 
-    @patch.object(elasticsearch.requests, 'Session')
-    def test_write(self, fake_Session):
+    @patch.object(elasticsearch.time, 'strftime')
+    def test_index_cached(self, fake_strftime):
+        """``ElasticSearch`` the 'index' property is only formatted once per day"""
+        fake_strftime.return_value = 'logs-2019.04.03'
+        es = elasticsearch.ElasticSearch(server='8.8.8.8',
+                                         user='alice',
+                                         password='iLoveDogs',
+                                         doc_type='someLogCategory')
+
+        es.index
+        es.index
+
+        self.assertEqual(fake_strftime.call_count, 1)
+
+    @patch.object(elasticsearch.time, 'time')
+    def test_index_rollover(self, fake_time):
+        """``ElasticSearch`` the 'index' property changes once the day rolls over"""
+        today = time.mktime((2019, 4, 3, 23, 59, 59, 0, 0, -1))
+        fake_time.side_effect = [today, today + 2]
+        es = elasticsearch.ElasticSearch(server='8.8.8.8',
+                                         user='alice',
+                                         password='iLoveDogs',
+                                         doc_type='someLogCategory')
+
+        indices = [es.index, es.index]
+        expected = ['logs-2019.04.03', 'logs-2019.04.04']
+
+        self.assertEqual(indices, expected)
+
+    def test_write(self):
         """``ElasticSearch`` 'write' checks that the HTTP response was OK automatically"""
-        fake_resp = MagicMock()
-        fake_session = MagicMock()
-        fake_session.post.return_value = fake_resp
-        fake_Session.return_value = fake_session
         es = elasticsearch.ElasticSearch(server='8.8.8.8',
                                          user='alice',
                                          password='iLoveDogs',
@@ -44,15 +85,23 @@ class TestElasticSearch(unittest.TestCase):
 
         es.write(document='{"some":"JSON"}')
 
-        self.assertTrue(fake_resp.raise_for_status.called)
+        self.assertTrue(self.fake_resp.raise_for_status.called)
+
+    def test_write_reuses_session(self):
+        """``ElasticSearch`` every 'write' goes through the one session (and its open connections)"""
+        es = elasticsearch.ElasticSearch(server='8.8.8.8',
+                                         user='alice',
+                                         password='iLoveDogs',
+                                         doc_type='someLogCategory')
+
+        es.write(document='{"some":"JSON"}')
+        es.write(document='{"more":"JSON"}')
 
-    @patch.object(elasticsearch.requests, 'Session')
-    def test_write_url(self, fake_Session):
+        self.assertEqual(self.fake_Session.call_count, 1)
+        self.assertEqual(self.fake_session.post.call_count, 2)
+
+    def test_write_url(self):
         """``ElasticSearch`` 'write' constructs the correct URL"""
-        fake_resp = MagicMock()
-        fake_session = MagicMock()
-        fake_session.post.return_value = fake_resp
-        fake_Session.return_value = fake_session
         es = elasticsearch.ElasticSearch(server='8.8.8.8',
                                          user='alice',
                                          password='iLoveDogs',
@@ -60,20 +109,54 @@ class TestElasticSearch(unittest.TestCase):
 
         es.write(document='{"some":"JSON"}')
 
-        the_args, _ = fake_session.post.call_args
+        the_args, _ = self.fake_session.post.call_args
         url = the_args[0]
-        expected = 'https://8.8.8.8:9200/{}/someLogCategory'.format(time.strftime('logs-%Y.%m.%d'))
+        expected = 'https://8.8.8.8:9200/{}/someLogCategory/_bulk'.format(EXPECTED_INDEX)
 
         self.assertEqual(url, expected)
 
+    def test_write_many(self):
+        """``ElasticSearch`` 'write_many' sends every document in one bulk request"""
+        es = elasticsearch.ElasticSearch(server='8.8.8.8',
+                                         user='alice',
+                                         password='iLoveDogs',
+                                         doc_type='someLogCategory')
+
+        es.write_many(['{"some":"JSON"}', b'{"more":"JSON"}'])
+
+        _, the_kwargs = self.fake_session.post.call_args
+        body = the_kwargs['data']
+        expected = b'{"index":{}}\n{"some":"JSON"}\n{"index":{}}\n{"more":"JSON"}\n'
+
+        self.assertEqual(self.fake_session.post.call_count, 1)
+        self.assertEqual(body, expected)
+
+    def test_write_many_errors(self):
+        """``ElasticSearch`` 'write_many' raises HTTPError if any document was rejected"""
+        self.fake_resp.json.return_value = {'errors': True, 'items': [{'index': {'error': {'type': 'mapper_parsing_exception'}}}]}
+        es = elasticsearch.ElasticSearch(server='8.8.8.8',
+                                         user='alice',
+                                         password='iLoveDogs',
+                                         doc_type='someLogCategory')
+
+        with self.assertRaises(elasticsearch.requests.exceptions.HTTPError):
+            es.write_many(['{"some":"JSON"}'])
+
+    def test_session_pool(self):
+        """``ElasticSearch`` mounts a connection pool sized for many in-flight writes"""
+        es = elasticsearch.ElasticSearch(server='8.8.8.8',
+                                         user='alice',
+                                         password='iLoveDogs',
+                                         doc_type='someLogCategory')
+
+        the_args, _ = self.fake_session.mount.call_args
+        adapter = the_args[1]
+
+        self.assertEqual(adapter._pool_maxsize, elasticsearch.POOL_MAXSIZE)
+        self.assertTrue(adapter.max_retries is elasticsearch.RETRY)
 
-    @patch.object(elasticsearch.requests, 'Session')
-    def test_close(self, fake_Session):
+    def test_close(self):
         """``ElasticSearch`` 'close' terminates the TCP socket with the ElasticSearch server"""
-        fake_resp = MagicMock()
-        fake_session = MagicMock()
-        fake_session.post.return_value = fake_resp
-        fake_Session.return_value = fake_session
         es = elasticsearch.ElasticSearch(server='8.8.8.8',
                                          user='alice',
                                          password='iLoveDogs',
@@ -81,7 +164,7 @@ class TestElasticSearch(unittest.TestCase):
 
         es.close()
 
-        self.assertTrue(fake_session.close.called)
+        self.assertTrue(self.fake_session.close.called)
 
 
 if __name__ == '__main__':
@@ -112,6 +112,7 @@ class TestInfluxDB(unittest.TestCase):
                                    password='iLoveKats!',
                                    measurement='someThing')
         influx.session.post.return_value = fake_resp
+        influx._staged = [{'tags': None, 'fields': {'cpu': '23'}, 'timestamp': 1234}]
 
         with self.assertRaises(influxdb.InfluxError):
             influx.flush()
@@ -126,10 +127,99 @@ class TestInfluxDB(unittest.TestCase):
                                    password='iLoveKats!',
                                    measurement='someThing')
         influx.session.post.return_value = fake_resp
+        influx._staged = [{'tags': None, 'fields': {'cpu': '23'}, 'timestamp': 1234}]
 
         with self.assertRaises(influxdb.InfluxError):
             influx.flush()
 
+    @patch.object(influxdb.time, 'time')
+    def test_write_line(self, fake_time, fake_Session):
+        """``InfluxDB.write_line`` stages data points that are already in Line Protocol format"""
+        fake_time.return_value = 1234
+        influx = influxdb.InfluxDB(server='no-where.org',
+                                   user='sam',
+                                   password='iLoveKats!',
+                                   measurement='someThing')
+        influx._last_write = 1234
+
+        influx.write_line('someThing cpu=23 1234')
+
+        self.assertEqual(influx._lines, ['someThing cpu=23 1234'])
+        self.assertFalse(influx.session.post.called)
+
+    def test_flush_lines(self, fake_Session):
+        """``InfluxDB.flush`` sends data points from both 'write' and 'write_line' in one request"""
+        influx = influxdb.InfluxDB(server='no-where.org',
+                                   user='sam',
+                                   password='iLoveKats!',
+                                   measurement='someThing')
+        influx._lines = ['someThing cpu=23 1234']
+        influx._staged = [{'tags': None, 'fields': {'cpu': '42'}, 'timestamp': 1235}]
+
+        influx.flush()
+
+        _, the_kwargs = influx.session.post.call_args
+        expected = b'someThing cpu=23 1234\nsomeThing cpu=42 1235'
+
+        self.assertEqual(the_kwargs['data'], expected)
+        self.assertEqual(influx._lines, [])
+
+    def test_flush_utf8(self, fake_Session):
+        """``InfluxDB.flush`` sends the data points encoded as UTF-8"""
+        influx = influxdb.InfluxDB(server='no-where.org',
+                                   user='sam',
+                                   password='iLoveKats!',
+                                   measurement='someThing')
+        influx._lines = ['someThing user="Zoë" 1234']
+
+        influx.flush()
+
+        _, the_kwargs = influx.session.post.call_args
+        expected = 'someThing user="Zoë" 1234'.encode('utf-8')
+
+        self.assertEqual(the_kwargs['data'], expected)
+
+    def test_flush_nothing_staged(self, fake_Session):
+        """``InfluxDB.flush`` does not send a request when there are no data points"""
+        influx = influxdb.InfluxDB(server='no-where.org',
+                                   user='sam',
+                                   password='iLoveKats!',
+                                   measurement='someThing')
+
+        influx.flush()
+
+        self.assertFalse(influx.session.post.called)
+
+    @patch.object(influxdb.time, 'time')
+    def test_flush_stale(self, fake_time, fake_Session):
+        """``InfluxDB.flush_stale`` sends the pending data once it's older than 'max_age'"""
+        fake_time.return_value = 1234
+        influx = influxdb.InfluxDB(server='no-where.org',
+                                   user='sam',
+                                   password='iLoveKats!',
+                                   measurement='someThing')
+        influx._last_write = 1233
+        influx._staged = [{'tags': None, 'fields': {'cpu': '23'}, 'timestamp': 1234}]
+
+        influx.flush_stale(max_age=1)
+
+        self.assertTrue(influx.session.post.called)
+
+    @patch.object(influxdb.time, 'time')
+    def test_flush_stale_recent(self, fake_time, fake_Session):
+        """``InfluxDB.flush_stale`` keeps staging data points that were recently written"""
+        fake_time.return_value = 1234
+        influx = influxdb.InfluxDB(server='no-where.org',
+                                   user='sam',
+                                   password='iLoveKats!',
+                                   measurement='someThing')
+        influx._last_write = 1233.5
+        influx._staged = [{'tags': None, 'fields': {'cpu': '23'}, 'timestamp': 1234}]
+
+        influx.flush_stale(max_age=1)
+
+        self.assertFalse(influx.session.post.called)
+
 
 class TestInfluxError(unittest.TestCase):
     """A suite of test cases for the ``InfluxError`` exception"""
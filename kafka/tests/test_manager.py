@@ -2,13 +2,26 @@
 """A suite of unit tests for the ``manager.py`` module"""
 import unittest
 from unittest.mock import patch, MagicMock
+import os
 import time
+import importlib
 import queue
 import multiprocessing
+import multiprocessing.queues
 
 from log_processor import manager
 
 
+class NullLog:
+    """A logger that throws away every message; for tests that don't check what gets logged"""
+    def __getattr__(self, name):
+        return self.discard
+
+    @staticmethod
+    def discard(*args, **kwargs):
+        pass
+
+
 class TestGeneral(unittest.TestCase):
     """A suite of test cases for the ``make_queues`` function and static values"""
     def test_make_queues_count(self):
@@ -43,12 +56,39 @@ class TestGeneral(unittest.TestCase):
 
         self.assertEqual(expected, manager.PRODUCE_BEFORE_CHECKING)
 
+    def test_env_overrides(self):
+        """The scaling values can be set via environment variables"""
+        env = {'PRODUCE_INTERVAL': '5',
+               'PRODUCE_BEFORE_CHECKING': '10',
+               'SCALE_UP_BY': '3',
+               'MAX_WORKERS': '7'}
+        with patch.dict(os.environ, env):
+            importlib.reload(manager)
+        found = (manager.PRODUCE_INTERVAL, manager.PRODUCE_BEFORE_CHECKING,
+                 manager.SCALE_UP_BY, manager.MAX_WORKERS)
+        importlib.reload(manager)
+        expected = (5, 10, 3, 7)
+
+        self.assertEqual(found, expected)
+
     def test_sentinel(self):
         """``SENTINEL`` value used to scale down workers has not changed"""
-        expected = 'TERMINATE YOU USELESS PROCESS'
+        expected = 0
 
         self.assertEqual(expected, manager.SENTINEL)
 
+    def test_sentinel_matches_worker(self):
+        """``SENTINEL`` is the same value the workers look for"""
+        from log_processor import worker
+
+        self.assertEqual(worker.SENTINEL, manager.SENTINEL)
+
+    def test_recycled_matches_worker(self):
+        """``RECYCLED`` is the same value the workers send when they retire to give back memory"""
+        from log_processor import worker
+
+        self.assertEqual(worker.RECYCLED, manager.RECYCLED)
+
     def test_scale_up_by(self):
         """``SCALE_UP_BY`` has not changed"""
         expected = 2
@@ -62,49 +102,282 @@ class TestGeneral(unittest.TestCase):
         self.assertEqual(expected, manager.SCALE_DOWN_BY)
 
     def test_max_workers(self):
-        """``MAX_WORKERS`` is x2 the number of CPUs"""
-        expected = multiprocessing.cpu_count() * 2
+        """``MAX_WORKERS`` is x2 the number of usable CPUs"""
+        expected = max(2, manager.EFFECTIVE_CPUS * 2)
 
         self.assertEqual(expected, manager.MAX_WORKERS)
 
 
+class TestEffectiveCpus(unittest.TestCase):
+    """A suite of test cases for the ``_effective_cpus`` and ``_cgroup_cpu_quota`` functions"""
+    @patch.object(manager, '_cgroup_cpu_quota')
+    @patch.object(manager, 'sched_getaffinity')
+    def test_effective_cpus_quota(self, fake_sched_getaffinity, fake_cgroup_cpu_quota):
+        """``_effective_cpus`` is limited by the cgroup CPU quota"""
+        fake_sched_getaffinity.return_value = set(range(64))
+        fake_cgroup_cpu_quota.return_value = 1.5
+
+        self.assertEqual(manager._effective_cpus(), 2)
+
+    @patch.object(manager, '_cgroup_cpu_quota')
+    @patch.object(manager, 'sched_getaffinity')
+    def test_effective_cpus_affinity(self, fake_sched_getaffinity, fake_cgroup_cpu_quota):
+        """``_effective_cpus`` only counts the CPUs the process may run on"""
+        fake_sched_getaffinity.return_value = {0, 1, 2}
+        fake_cgroup_cpu_quota.return_value = None
+
+        self.assertEqual(manager._effective_cpus(), 3)
+
+    @patch.object(manager, '_cgroup_cpu_quota')
+    @patch.object(manager, 'sched_getaffinity')
+    def test_effective_cpus_tiny_quota(self, fake_sched_getaffinity, fake_cgroup_cpu_quota):
+        """``_effective_cpus`` is always at least 1"""
+        fake_sched_getaffinity.return_value = {0, 1}
+        fake_cgroup_cpu_quota.return_value = 0.1
+
+        self.assertEqual(manager._effective_cpus(), 1)
+
+    @patch.object(manager, '_cgroup_cpu_quota')
+    @patch.object(manager, 'cpu_count')
+    @patch.object(manager, 'sched_getaffinity', None)
+    def test_effective_cpus_no_affinity(self, fake_cpu_count, fake_cgroup_cpu_quota):
+        """``_effective_cpus`` counts every CPU when the OS doesn't support CPU affinity"""
+        fake_cpu_count.return_value = 4
+        fake_cgroup_cpu_quota.return_value = None
+
+        self.assertEqual(manager._effective_cpus(), 4)
+
+    @patch('builtins.open')
+    def test_cgroup_v2(self, fake_open):
+        """``_cgroup_cpu_quota`` reads the cgroup v2 cpu.max file"""
+        fake_open.return_value.__enter__.return_value.read.return_value = '200000 100000\n'
+
+        self.assertEqual(manager._cgroup_cpu_quota(), 2.0)
+
+    @patch('builtins.open')
+    def test_cgroup_v2_unlimited(self, fake_open):
+        """``_cgroup_cpu_quota`` returns None when cgroup v2 has no CPU quota"""
+        fake_open.return_value.__enter__.return_value.read.return_value = 'max 100000\n'
+
+        self.assertTrue(manager._cgroup_cpu_quota() is None)
+
+    @patch('builtins.open')
+    def test_cgroup_v1(self, fake_open):
+        """``_cgroup_cpu_quota`` falls back to the cgroup v1 files"""
+        fake_file = fake_open.return_value.__enter__.return_value
+        fake_file.read.side_effect = [FileNotFoundError(), '50000\n', '100000\n']
+
+        self.assertEqual(manager._cgroup_cpu_quota(), 0.5)
+
+    @patch('builtins.open')
+    def test_cgroup_v1_unlimited(self, fake_open):
+        """``_cgroup_cpu_quota`` returns None when cgroup v1 has no CPU quota"""
+        fake_file = fake_open.return_value.__enter__.return_value
+        fake_file.read.side_effect = [FileNotFoundError(), '-1\n', '100000\n']
+
+        self.assertTrue(manager._cgroup_cpu_quota() is None)
+
+    @patch('builtins.open')
+    def test_no_cgroup(self, fake_open):
+        """``_cgroup_cpu_quota`` returns None when there are no cgroup files"""
+        fake_open.side_effect = FileNotFoundError()
+
+        self.assertTrue(manager._cgroup_cpu_quota() is None)
+
+
+class TestWorkQueue(unittest.TestCase):
+    """A suite of test cases for picking the type of ``work_queue``"""
+    @patch.object(manager, 'USE_FASTER_FIFO', True)
+    @patch.object(manager, 'FFQueue')
+    def test_make_queues_faster_fifo(self, fake_FFQueue):
+        """``make_queues`` uses faster-fifo for the work_queue when it's installed"""
+        work_queue, idle_queue = manager.make_queues()
+
+        self.assertTrue(work_queue is fake_FFQueue.return_value)
+        self.assertTrue(idle_queue is fake_FFQueue.return_value)
+
+    @patch.object(manager, 'USE_FASTER_FIFO', False)
+    @patch.object(manager, 'FFQueue')
+    def test_make_queues_faster_fifo_disabled(self, fake_FFQueue):
+        """``make_queues`` uses a multiprocessing.Queue when USE_FASTER_FIFO is false"""
+        work_queue, _ = manager.make_queues()
+
+        self.assertFalse(fake_FFQueue.called)
+        self.assertTrue(isinstance(work_queue, multiprocessing.queues.Queue))
+
+    @patch.object(manager, 'FFQueue', None)
+    def test_make_queues_not_installed(self):
+        """``make_queues`` uses a multiprocessing.Queue when faster-fifo isn't installed"""
+        work_queue, _ = manager.make_queues()
+
+        self.assertTrue(isinstance(work_queue, multiprocessing.queues.Queue))
+
+    def test_put_work_many(self):
+        """``put_work`` sends the whole batch at once when the work_queue supports it"""
+        work_queue = MagicMock()
+
+        manager.put_work(work_queue, ['a', 'b'])
+
+        self.assertEqual(work_queue.put_many.call_count, 1)
+        self.assertFalse(work_queue.put.called)
+
+    def test_put_work(self):
+        """``put_work`` puts a list of records into a multiprocessing.Queue"""
+        work_queue = MagicMock(spec=['put'])
+
+        manager.put_work(work_queue, ['a', 'b'])
+
+        the_args, _ = work_queue.put.call_args
+
+        self.assertEqual(work_queue.put.call_count, 1)
+        self.assertEqual(the_args[0], ['a', 'b'])
+
+    @patch.object(manager, 'BACKLOG_BATCH', 2)
+    def test_put_work_chunks(self):
+        """``put_work`` caps how many records are in each list put into a multiprocessing.Queue"""
+        work_queue = MagicMock(spec=['put'])
+
+        manager.put_work(work_queue, ['a', 'b', 'c'])
+
+        sent = [c[0][0] for c in work_queue.put.call_args_list]
+        expected = [['a', 'b'], ['c']]
+
+        self.assertEqual(sent, expected)
+
+
+class TestThreadWorkers(unittest.TestCase):
+    """A suite of test cases for running workers as threads"""
+    def test_make_queues_threaded(self):
+        """``make_queues`` returns in-process queues when the workers are threads"""
+        work_queue, idle_queue = manager.make_queues(threaded=True)
+
+        self.assertTrue(isinstance(work_queue, queue.Queue))
+        self.assertTrue(isinstance(idle_queue, queue.Queue))
+
+    def test_thread_workers_start(self):
+        """``thread_workers`` makes workers that start in the thread pool"""
+        worker_cls = MagicMock()
+        process_start = worker_cls.return_value.start
+        pool = MagicMock()
+
+        make_worker = manager.thread_workers(worker_cls, pool)
+        worker = make_worker('someGroup', 'work_queue', 'idle_queue', 'backlog')
+        worker.start()
+
+        pool.submit.assert_called_with(worker_cls.return_value.run)
+        self.assertFalse(process_start.called)
+
+    def test_thread_workers_args(self):
+        """``thread_workers`` passes along the same args as the Worker class takes"""
+        worker_cls = MagicMock()
+
+        make_worker = manager.thread_workers(worker_cls, MagicMock())
+        make_worker('someGroup', 'work_queue', 'idle_queue', 'backlog')
+
+        the_args, _ = worker_cls.call_args
+        expected = ('someGroup', 'work_queue', 'idle_queue', 'backlog')
+
+        self.assertEqual(the_args, expected)
+
+    def test_thread_worker_runs(self):
+        """``thread_workers`` runs a real Worker until it's told to terminate"""
+        from log_processor import worker as worker_module
+
+        class DerpWorker(worker_module.Worker):
+            processed = []
+            def process_data(self, data):
+                self.processed.append(data)
+            def flush_on_term(self):
+                pass
+
+        work_queue, idle_queue = manager.make_queues(threaded=True)
+        work_queue.put('some Work')
+        work_queue.put(manager.SENTINEL)
+        pool = manager.ThreadPoolExecutor(max_workers=1)
+
+        make_worker = manager.thread_workers(DerpWorker, pool)
+        make_worker('someGroup', work_queue, idle_queue).start()
+        pool.shutdown(wait=True)
+
+        self.assertEqual(DerpWorker.processed, ['some Work'])
+
+
+class TestBacklog(unittest.TestCase):
+    """A suite of test cases for the ``make_backlog`` and ``report_produced`` functions"""
+    @patch.object(manager, 'Value')
+    def test_make_backlog(self, fake_Value):
+        """``make_backlog`` returns a shared integer that starts at zero"""
+        manager.make_backlog()
+
+        the_args, _ = fake_Value.call_args
+        expected = ('i', 0)
+
+        self.assertEqual(the_args, expected)
+
+    def test_report_produced(self):
+        """``report_produced`` adds to the backlog"""
+        backlog = multiprocessing.Value('i', 5)
+
+        manager.report_produced(backlog, 10)
+
+        self.assertEqual(backlog.value, 15)
+
+    def test_report_produced_resets(self):
+        """``report_produced`` returns zero, so the caller can reset its counter"""
+        backlog = MagicMock()
+
+        count = manager.report_produced(backlog, 10)
+
+        self.assertEqual(count, 0)
+
+    def test_report_produced_nothing(self):
+        """``report_produced`` does not take the lock when there's nothing to report"""
+        backlog = MagicMock()
+
+        manager.report_produced(backlog, 0)
+
+        self.assertFalse(backlog.get_lock.called)
+
+
 @patch.object(manager, 'check_worker_health')
 class TestCheckWorkload(unittest.TestCase):
     """A suite of test cases for the ``check_workload`` function"""
     @classmethod
-    def setUp(cls):
-        """Runs before every test case"""
-        cls.log = MagicMock()
-        cls.work_queue = multiprocessing.Queue()
+    def setUpClass(cls):
+        """Runs once for the entire test suite, before any test cases"""
+        cls.backlog = multiprocessing.Value('i', 0)
         cls.idle_queue = multiprocessing.Queue()
 
     @classmethod
-    def tearDown(cls):
-        """Runs after every test case"""
-        cls.log = None
-        cls._drain_queue(cls.work_queue)
+    def tearDownClass(cls):
+        """Runs once for the entire test suite, after all test cases"""
         cls._drain_queue(cls.idle_queue)
-        cls.work_queue = None
+        cls.idle_queue.close()
+        cls.idle_queue.join_thread()
+        cls.backlog = None
         cls.idle_queue = None
 
+    def setUp(self):
+        """Runs before every test case"""
+        self.log = NullLog()
+        self.backlog.value = 0
+        self._drain_queue(self.idle_queue)
+
     @staticmethod
-    def _drain_queue(queue):
+    def _drain_queue(the_queue):
         """If you don't empty the queues before termination, then you get a BrokePipe traceback"""
-        while not queue.empty():
+        while True:
             try:
-                queue.get()
-            except Exeption:
-                pass
-        queue.close()
-        queue.join_thread()
+                the_queue.get_nowait()
+            except queue.Empty:
+                break
 
     def test_check_workload_scale_up(self, fake_check_worker_health):
         """``check_workload`` says to scale up workers by ``SCALE_UP_BY``"""
-        for _ in range(200):
-            self.work_queue.put('test')
+        self.backlog.value = 200
         fake_check_worker_health.return_value = [], 0
 
-        _, needed_workers = manager.check_workload([], self.work_queue, self.idle_queue, self.log)
+        _, needed_workers = manager.check_workload([], self.backlog, self.idle_queue, self.log)
         expected = manager.SCALE_UP_BY
 
         self.assertEqual(needed_workers, expected)
@@ -113,18 +386,38 @@ class TestCheckWorkload(unittest.TestCase):
         """``check_workload`` says to scale down workers by ``SCALE_DOWN_BY``"""
         fake_check_worker_health.return_value = [], 0
 
-        _, needed_workers = manager.check_workload([], self.work_queue, self.idle_queue, self.log)
+        _, needed_workers = manager.check_workload([], self.backlog, self.idle_queue, self.log)
         expected = manager.SCALE_DOWN_BY
 
         self.assertEqual(needed_workers, expected)
 
+    def test_check_workload_lazy_logging(self, fake_check_worker_health):
+        """``check_workload`` leaves formatting debug messages to the logger"""
+        self.log = MagicMock()
+        self.backlog.value = 200
+        fake_check_worker_health.return_value = [], 0
+
+        manager.check_workload([], self.backlog, self.idle_queue, self.log)
+
+        self.log.debug.assert_any_call('Pending items for processing: %s', 200)
+
+    def test_check_workload_reads_backlog(self, fake_check_worker_health):
+        """``check_workload`` uses the backlog counter instead of the work_queue size"""
+        fake_check_worker_health.return_value = [], 0
+        backlog = MagicMock()
+        backlog.value = 101
+
+        _, needed_workers = manager.check_workload([], backlog, self.idle_queue, self.log)
+        expected = manager.SCALE_UP_BY
+
+        self.assertEqual(needed_workers, expected)
+
     def test_check_workload_scalier(self, fake_check_worker_health):
         """``check_workload`` applies a scalier to replace dead workers"""
-        for _ in range(200):
-            self.work_queue.put('test')
+        self.backlog.value = 200
         fake_check_worker_health.return_value = [], 1
 
-        _, needed_workers = manager.check_workload([], self.work_queue, self.idle_queue, self.log)
+        _, needed_workers = manager.check_workload([], self.backlog, self.idle_queue, self.log)
         expected = manager.SCALE_UP_BY + 1
 
         self.assertEqual(needed_workers, expected)
@@ -134,19 +427,14 @@ class TestCheckWorkerHealth(unittest.TestCase):
     """A suite of test cases for the ``check_worker_health`` function"""
     @classmethod
     def setUp(cls):
-        cls.idle_queue = multiprocessing.Queue()
-        cls.log = MagicMock()
+        # Same get/put API as a multiprocessing.Queue, but a put is visible
+        # right away instead of after a feeder thread writes it to a pipe
+        cls.idle_queue = queue.Queue()
+        cls.log = NullLog()
         cls.workers = cls._make_workers()
 
     @classmethod
     def tearDown(cls):
-        while not cls.idle_queue.empty():
-            try:
-                cls.idle_queue.get()
-            except Exception:
-                pass
-        cls.idle_queue.close()
-        cls.idle_queue.join_thread()
         cls.idle_queue = None
         cls.log = None
         cls.workers = None
@@ -171,20 +459,25 @@ class TestCheckWorkerHealth(unittest.TestCase):
         """``check_worker_health`` returns a scalier of 1 when a dead worker is found"""
         message = ('worker-1', 'test error')
         self.idle_queue.put(message)
-        time.sleep(0.1) # avoid race between putting into queue, and checking
 
         _, scalier = manager.check_worker_health(self.workers, self.idle_queue, self.log)
         expected = 1
 
         self.assertEqual(scalier, expected)
 
+    def test_no_workers(self):
+        """``check_worker_health`` doesn't call it a total failure when there are no workers, and no errors"""
+        workers, scalier = manager.check_worker_health([], self.idle_queue, self.log)
+
+        self.assertEqual(workers, [])
+        self.assertEqual(scalier, 0)
+
     def test_all_error(self):
         """``check_worker_health`` raises RuntimeError if all workers are dead"""
         message1 = ('worker-1', 'test error')
         message2 = ('worker-2', 'test error')
         self.idle_queue.put(message1)
         self.idle_queue.put(message2)
-        time.sleep(0.1) # avoid race between putting into queue, and checking
 
         with self.assertRaises(RuntimeError):
             _, scalier = manager.check_worker_health(self.workers, self.idle_queue, self.log)
@@ -193,18 +486,26 @@ class TestCheckWorkerHealth(unittest.TestCase):
         """``check_worker_health`` doesn't increase the scalier when it finds a retired worker"""
         message = ('worker-1', '')
         self.idle_queue.put(message)
-        time.sleep(0.1) # avoid race between putting into queue, and checking
 
         _, scalier = manager.check_worker_health(self.workers, self.idle_queue, self.log)
         expected = 0
 
         self.assertEqual(scalier, expected)
 
+    def test_recycled(self):
+        """``check_worker_health`` increases the scalier by one for each recycled worker"""
+        self.idle_queue.put(('worker-1', manager.RECYCLED))
+        self.idle_queue.put(('worker-2', manager.RECYCLED))
+
+        workers, scalier = manager.check_worker_health(self.workers, self.idle_queue, self.log)
+
+        self.assertEqual(workers, [])
+        self.assertEqual(scalier, 2)
+
     def test_returned_workers(self):
         """``check_worker_health`` returns a list of only alive workers"""
         message = ('worker-1', '')
         self.idle_queue.put(message)
-        time.sleep(0.2) # avoid race between putting into queue, and checking
 
         workers, _ = manager.check_worker_health(self.workers, self.idle_queue, self.log)
         alive_worker = self.workers.pop()
@@ -214,7 +515,7 @@ class TestCheckWorkerHealth(unittest.TestCase):
 
     def test_non_blocking_queue(self):
         """``check_worker_health`` does not indefinitely block on the idle_queue"""
-        fake_queue = MagicMock()
+        fake_queue = MagicMock(spec=['get', 'put', 'empty'])
         fake_queue.empty.return_value = False
         fake_queue.get.side_effect = queue.Empty('testing')
         self.idle_queue = fake_queue
@@ -228,6 +529,30 @@ class TestCheckWorkerHealth(unittest.TestCase):
         self.assertTrue(get_called)
         self.assertFalse(blocking)
 
+    def test_drains_queue(self):
+        """``check_worker_health`` reads until the idle_queue is empty, without polling ``empty``"""
+        fake_queue = MagicMock(spec=['get', 'put', 'empty'])
+        fake_queue.get.side_effect = [('worker-1', ''), queue.Empty('testing')]
+
+        workers, _ = manager.check_worker_health(self.workers, fake_queue, self.log)
+
+        self.assertEqual([w.name for w in workers], ['worker-2'])
+        self.assertFalse(fake_queue.empty.called)
+
+    def test_get_many(self):
+        """``check_worker_health`` reads a batch of messages when the idle_queue supports it"""
+        fake_queue = MagicMock()
+        fake_queue.get_many.side_effect = [[('worker-1', ''), ('worker-2', 'test error')], queue.Empty('testing')]
+
+        workers, scalier = manager.check_worker_health(self.workers, fake_queue, self.log)
+        _, kwargs = fake_queue.get_many.call_args
+
+        self.assertEqual(workers, [])
+        self.assertEqual(scalier, 1)
+        self.assertFalse(kwargs['block'])
+        self.assertEqual(kwargs['max_messages_to_get'], 2)
+        self.assertFalse(fake_queue.get.called)
+
 
 class TestAdjustWOrkerCount(unittest.TestCase):
     """A suite of test cases for the ``adjust_worker_count`` function"""
@@ -235,13 +560,14 @@ class TestAdjustWOrkerCount(unittest.TestCase):
         """``adjust_worker_count`` scales down unless there's only 1 worker"""
         fake_work_queue = MagicMock()
         fake_idle_queue = MagicMock()
+        fake_backlog = MagicMock()
         worker_cls = MagicMock()
         work_group = 'testGroup'
         topic = 'testTopic'
         workers = ['someWorker']
         need = -1
 
-        manager.adjust_worker_count(workers, worker_cls, work_group, fake_work_queue, fake_idle_queue, need)
+        manager.adjust_worker_count(workers, worker_cls, work_group, fake_work_queue, fake_idle_queue, fake_backlog, need)
 
         sent_sentinel = fake_work_queue.put.called
 
@@ -251,35 +577,58 @@ class TestAdjustWOrkerCount(unittest.TestCase):
         """``adjust_worker_count`` notifies a worker to retire when there's more than 1 worker"""
         fake_work_queue = MagicMock()
         fake_idle_queue = MagicMock()
+        fake_backlog = MagicMock()
         worker_cls = MagicMock()
         work_group = 'testGroup'
         topic = 'testTopic'
         workers = ['someWorker-1', 'someWorker-2']
         need = -1
 
-        manager.adjust_worker_count(workers, worker_cls, work_group, fake_work_queue, fake_idle_queue, need)
+        manager.adjust_worker_count(workers, worker_cls, work_group, fake_work_queue, fake_idle_queue, fake_backlog, need)
 
         sent_sentinel = fake_work_queue.put.called
 
         self.assertTrue(sent_sentinel)
 
+    def test_replaces_last_worker(self):
+        """``adjust_worker_count`` always makes a worker when there are none, even if told to scale down"""
+        fake_work_queue = MagicMock()
+        worker_cls = MagicMock()
+        workers = []
+        need = -1
+
+        workers = manager.adjust_worker_count(workers, worker_cls, 'testGroup', fake_work_queue, MagicMock(), MagicMock(), need)
+
+        self.assertEqual(len(workers), 1)
+        self.assertFalse(fake_work_queue.put.called)
+
+    @patch.object(manager, 'MAX_WORKERS', 10)
     def test_scales_up(self):
         """``adjust_worker_count`` scales workers up by the value of the 'need' param"""
         fake_work_queue = MagicMock()
         fake_idle_queue = MagicMock()
+        fake_backlog = MagicMock()
         worker_cls = MagicMock()
         work_group = 'testGroup'
         topic = 'testTopic'
         workers = ['someWorker-1']
         need = 2
 
-        workers = manager.adjust_worker_count(workers, worker_cls, work_group, fake_work_queue, fake_idle_queue, need)
+        workers = manager.adjust_worker_count(workers, worker_cls, work_group, fake_work_queue, fake_idle_queue, fake_backlog, need)
         active_workers = len(workers)
         expected = 3
 
         self.assertEqual(active_workers, expected)
 
 
+def make_kafka(events, per_poll=500):
+    """Make a fake KafkaConsumer that returns ``events`` from ``poll``, then goes quiet"""
+    kafka = MagicMock()
+    polls = [{'topic-0': events[x:x + per_poll]} for x in range(0, len(events), per_poll)]
+    kafka.poll.side_effect = polls + [{}]
+    return kafka
+
+
 class TestProduceWork(unittest.TestCase):
     """A suite of test cases for the ``produce_work`` function"""
     @patch.object(manager, 'check_workload')
@@ -292,12 +641,13 @@ class TestProduceWork(unittest.TestCase):
         worker_cls = MagicMock()
         work_group = 'someGroup'
         topic = 'someTopic'
-        kafka = [fake_event, fake_event]
+        kafka = make_kafka([fake_event, fake_event])
         work_queue = MagicMock()
-        idle_queue = MagicMock()
+        idle_queue = queue.Queue()
+        backlog = MagicMock()
         log = MagicMock()
 
-        manager.produce_work(workers, worker_cls, work_group, topic, work_queue, idle_queue, kafka, log)
+        manager.produce_work(workers, worker_cls, work_group, topic, work_queue, idle_queue, backlog, kafka, log)
 
         self.assertFalse(fake_adjust_worker_count.called)
         self.assertFalse(fake_check_workload.called)
@@ -314,12 +664,13 @@ class TestProduceWork(unittest.TestCase):
         worker_cls = MagicMock()
         work_group = 'someGroup'
         topic = 'someTopic'
-        kafka = [fake_event] * manager.PRODUCE_BEFORE_CHECKING
+        kafka = make_kafka([fake_event] * manager.PRODUCE_BEFORE_CHECKING)
         work_queue = MagicMock()
-        idle_queue = MagicMock()
+        idle_queue = queue.Queue()
+        backlog = MagicMock()
         log = MagicMock()
 
-        manager.produce_work(workers, worker_cls, work_group, topic, work_queue, idle_queue, kafka, log)
+        manager.produce_work(workers, worker_cls, work_group, topic, work_queue, idle_queue, backlog, kafka, log)
         time_checked = fake_time.call_count
         expected = 2 # once at the start of the func, then once after PRODUCE_BEFORE_CHECKING is met
 
@@ -341,17 +692,128 @@ class TestProduceWork(unittest.TestCase):
         worker_cls = MagicMock()
         work_group = 'someGroup'
         topic = 'someTopic'
-        kafka = [fake_event] * manager.PRODUCE_BEFORE_CHECKING
+        kafka = make_kafka([fake_event] * manager.PRODUCE_BEFORE_CHECKING)
         work_queue = MagicMock()
-        idle_queue = MagicMock()
+        idle_queue = queue.Queue()
+        backlog = MagicMock()
         log = MagicMock()
 
-        manager.produce_work(workers, worker_cls, work_group, topic, work_queue, idle_queue, kafka, log)
+        manager.produce_work(workers, worker_cls, work_group, topic, work_queue, idle_queue, backlog, kafka, log)
 
         self.assertTrue(fake_adjust_worker_count.called)
         self.assertTrue(fake_check_workload.called)
 
 
+    @patch.object(manager, 'check_workload')
+    @patch.object(manager, 'adjust_worker_count')
+    def test_produce_reports_backlog(self, fake_adjust_worker_count, fake_check_workload):
+        """``produce_work`` adds everything it put into the work_queue to the backlog"""
+        fake_event = MagicMock()
+        fake_event.value = 'eventA'
+        workers = []
+        worker_cls = MagicMock()
+        work_group = 'someGroup'
+        topic = 'someTopic'
+        kafka = make_kafka([fake_event] * (manager.BACKLOG_BATCH + 3), per_poll=manager.BACKLOG_BATCH)
+        work_queue = MagicMock()
+        idle_queue = queue.Queue()
+        backlog = multiprocessing.Value('i', 0)
+        log = MagicMock()
+
+        manager.produce_work(workers, worker_cls, work_group, topic, work_queue, idle_queue, backlog, kafka, log)
+        expected = manager.BACKLOG_BATCH + 3
+
+        self.assertEqual(backlog.value, expected)
+
+
+    @patch.object(manager, 'check_workload')
+    @patch.object(manager, 'adjust_worker_count')
+    def test_produce_batches(self, fake_adjust_worker_count, fake_check_workload):
+        """``produce_work`` sends all the records from a poll of Kafka at once when the work_queue supports it"""
+        fake_event = MagicMock()
+        fake_event.value = 'eventA'
+        workers = []
+        worker_cls = MagicMock()
+        work_group = 'someGroup'
+        topic = 'someTopic'
+        kafka = make_kafka([fake_event] * (manager.BACKLOG_BATCH + 3), per_poll=manager.BACKLOG_BATCH)
+        work_queue = MagicMock()
+        idle_queue = queue.Queue()
+        backlog = MagicMock()
+        log = MagicMock()
+
+        manager.produce_work(workers, worker_cls, work_group, topic, work_queue, idle_queue, backlog, kafka, log)
+        sizes = [len(x[0][0]) for x in work_queue.put_many.call_args_list]
+        expected = [manager.BACKLOG_BATCH, 3]
+
+        self.assertEqual(sizes, expected)
+
+    @patch.object(manager, 'check_workload')
+    def test_replaces_recycled(self, fake_check_workload):
+        """``produce_work`` replaces the only worker when it's recycled, without waiting for PRODUCE_BEFORE_CHECKING"""
+        fake_event = MagicMock()
+        fake_event.value = 'eventA'
+        old_worker = MagicMock()
+        old_worker.name = 'worker-1'
+        worker_cls = MagicMock()
+        kafka = make_kafka([fake_event] * 3)
+        work_queue = MagicMock()
+        idle_queue = queue.Queue()
+        # the worker hits MAX_RECORDS_PER_WORKER with the records just produced
+        work_queue.put_many.side_effect = lambda records: idle_queue.put(('worker-1', manager.RECYCLED))
+
+        workers = manager.produce_work([old_worker], worker_cls, 'someGroup', 'someTopic',
+                                       work_queue, idle_queue, MagicMock(), kafka, NullLog())
+
+        self.assertEqual(workers, [worker_cls.return_value])
+        self.assertTrue(worker_cls.return_value.start.called)
+        self.assertFalse(fake_check_workload.called)
+
+    @patch.object(manager, 'check_workload')
+    def test_replaces_recycled_quiet(self, fake_check_workload):
+        """``produce_work`` replaces a recycled worker even when Kafka has no new records"""
+        old_worker = MagicMock()
+        old_worker.name = 'worker-1'
+        worker_cls = MagicMock()
+        kafka = make_kafka([])
+        idle_queue = queue.Queue()
+        idle_queue.put(('worker-1', manager.RECYCLED))
+
+        workers = manager.produce_work([old_worker], worker_cls, 'someGroup', 'someTopic',
+                                       MagicMock(), idle_queue, MagicMock(), kafka, NullLog())
+
+        self.assertEqual(workers, [worker_cls.return_value])
+        self.assertFalse(fake_check_workload.called)
+
+
+class TestPollRecords(unittest.TestCase):
+    """A suite of test cases for the ``poll_records`` function"""
+    def test_poll_records(self):
+        """``poll_records`` yields the record values from every partition"""
+        event1 = MagicMock()
+        event1.value = b'eventA'
+        event2 = MagicMock()
+        event2.value = b'eventB'
+        kafka = MagicMock()
+        kafka.poll.side_effect = [{'topic-0': [event1], 'topic-1': [event2]}, {}]
+
+        batches = list(manager.poll_records(kafka))
+        expected = [[b'eventA'], [b'eventB']]
+
+        self.assertEqual(batches, expected)
+
+    def test_poll_records_quiet(self):
+        """``poll_records`` stops once Kafka has nothing new for PRODUCE_TIMEOUT"""
+        kafka = MagicMock()
+        kafka.poll.return_value = {}
+
+        batches = list(manager.poll_records(kafka))
+        _, the_kwargs = kafka.poll.call_args
+
+        self.assertEqual(batches, [])
+        self.assertEqual(the_kwargs['timeout_ms'], manager.PRODUCE_TIMEOUT)
+
+
 class TestProcessLogs(unittest.TestCase):
     """A suite of tests for the entry point logic for the manager.py module"""
     @patch.object(manager, 'setproctitle')
@@ -379,6 +841,42 @@ class TestProcessLogs(unittest.TestCase):
 
         self.assertEqual(proc_name, expected)
 
+    @patch.object(manager, 'setproctitle')
+    @patch.object(manager, 'KafkaConsumer')
+    @patch.object(manager, 'adjust_worker_count')
+    @patch.object(manager, 'produce_work')
+    @patch.object(manager.time, 'sleep')
+    @patch.object(manager, 'get_logger')
+    def test_process_logs_fetch_sizes(self, fake_get_logger, fake_sleep, fake_produce_work,
+                                      fake_adjust_worker_count, fake_KafkaConsumer, fake_setproctitle):
+        """``process_logs`` tunes the Kafka consumer for larger fetches"""
+        fake_produce_work.side_effect = RuntimeError('stop running!')
+
+        manager.process_logs(MagicMock(), 'someGroup', 'someTopic', 'myKafkaServer:9092', 'testing')
+
+        _, the_kwargs = fake_KafkaConsumer.call_args
+
+        self.assertEqual(the_kwargs['fetch_min_bytes'], manager.FETCH_MIN_BYTES)
+        self.assertEqual(the_kwargs['fetch_max_wait_ms'], manager.FETCH_MAX_WAIT_MS)
+        self.assertEqual(the_kwargs['max_partition_fetch_bytes'], manager.MAX_PARTITION_FETCH_BYTES)
+
+    @patch.object(manager, 'setproctitle')
+    @patch.object(manager, 'KafkaConsumer')
+    @patch.object(manager, 'adjust_worker_count')
+    @patch.object(manager, 'produce_work')
+    @patch.object(manager.time, 'sleep')
+    @patch.object(manager, 'get_logger')
+    def test_process_logs_keeps_workers(self, fake_get_logger, fake_sleep, fake_produce_work,
+                                        fake_adjust_worker_count, fake_KafkaConsumer, fake_setproctitle):
+        """``process_logs`` hands the workers ``produce_work`` returned to the next call of ``produce_work``"""
+        fake_produce_work.side_effect = [['someWorker'], RuntimeError('stop running!')]
+
+        manager.process_logs(MagicMock(), 'someGroup', 'someTopic', 'myKafkaServer:9092', 'testing')
+
+        the_args, _ = fake_produce_work.call_args
+
+        self.assertEqual(the_args[0], ['someWorker'])
+
     @patch.object(manager, 'setproctitle')
     @patch.object(manager, 'KafkaConsumer')
     @patch.object(manager, 'adjust_worker_count')
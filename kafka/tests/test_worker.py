@@ -1,16 +1,26 @@
 # -*- coding: UTF-8 -*-
 """A suite of unit tests for the ``worker.py`` module"""
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, mock_open
 import time
 import builtins
 import queue
-from multiprocessing import Queue
+from multiprocessing import Queue, Value
 import os
 
+import requests
+
 from log_processor import worker
 
 
+# The workers read their settings from here instead of environment variables
+CONFIG = worker.LogWorkerConfig(server='127.0.0.1',
+                                user='bob',
+                                doc_type='someLogType',
+                                passwd_file='./.fake_file.txt',
+                                cipher_key_file='./.fake_file.txt')
+
+
 class DerpWorker(worker.Worker):
     """Exists solely to test the ``Worker`` abstract base class"""
     def process_data(self, data):
@@ -80,6 +90,111 @@ class TestWorker(unittest.TestCase):
 
         self.assertTrue(called_process_data)
 
+    @patch.object(worker, 'get_logger')
+    @patch.object(DerpWorker, 'process_data')
+    def test_run_reports_backlog(self, fake_process_data, fake_get_logger):
+        """``Worker`` the 'run' method subtracts the records it took from the backlog"""
+        idle_queue = MagicMock()
+        work_queue = Queue()
+        backlog = Value('i', 3)
+        work_queue.put('some Work')
+        work_queue.put('some Work')
+        work_queue.put('some Work')
+        work_queue.put(worker.SENTINEL)
+
+        w = DerpWorker(work_group='testing', work_queue=work_queue, idle_queue=idle_queue, backlog=backlog)
+        w.run()
+        work_queue.close()
+        work_queue.join_thread()
+
+        self.assertEqual(backlog.value, 0)
+
+    def test_next_item_get_many(self):
+        """``Worker`` 'next_item' pulls a batch of records when the work_queue supports it"""
+        work_queue = MagicMock()
+        work_queue.get_many.return_value = ['a', 'b']
+        w = DerpWorker(work_group='testing', work_queue=work_queue, idle_queue=MagicMock())
+
+        items = [w.next_item(block=True), w.next_item(block=True)]
+
+        self.assertEqual(items, ['a', 'b'])
+        self.assertEqual(work_queue.get_many.call_count, 1)
+
+    def test_next_item_get_many_empty(self):
+        """``Worker`` 'next_item' raises queue.Empty when not blocking and there's no work"""
+        work_queue = MagicMock()
+        work_queue.get_many.side_effect = queue.Empty()
+        w = DerpWorker(work_group='testing', work_queue=work_queue, idle_queue=MagicMock())
+
+        with self.assertRaises(queue.Empty):
+            w.next_item(block=False)
+
+    def test_next_item_get_many_waits(self):
+        """``Worker`` 'next_item' raises queue.Empty when blocking and the get_many times out"""
+        work_queue = MagicMock()
+        work_queue.get_many.side_effect = queue.Empty()
+        w = DerpWorker(work_group='testing', work_queue=work_queue, idle_queue=MagicMock())
+
+        with self.assertRaises(queue.Empty):
+            w.next_item(block=True)
+
+    def test_run_idle(self):
+        """``Worker`` 'run' calls 'on_idle' each time it waits on the work_queue without getting work"""
+        work_queue = MagicMock()
+        work_queue.get_many.side_effect = [queue.Empty(), queue.Empty(), [worker.SENTINEL]]
+        w = DerpWorker(work_group='testing', work_queue=work_queue, idle_queue=MagicMock())
+        w.on_idle = MagicMock()
+
+        w.run()
+        blocked = [c[1]['block'] for c in work_queue.get_many.call_args_list]
+
+        self.assertEqual(w.on_idle.call_count, 2)
+        self.assertEqual(blocked, [False, True, True])
+
+    def test_return_pending(self):
+        """``Worker`` 'return_pending' puts unprocessed records back into the work_queue"""
+        work_queue = MagicMock()
+        w = DerpWorker(work_group='testing', work_queue=work_queue, idle_queue=MagicMock())
+        w.pending.extend(['a', 'b'])
+
+        w.return_pending()
+
+        the_args, _ = work_queue.put_many.call_args
+
+        self.assertEqual(the_args[0], ['a', 'b'])
+        self.assertEqual(len(w.pending), 0)
+
+    def test_return_pending_list(self):
+        """``Worker`` 'return_pending' puts unprocessed records back as a list into a multiprocessing.Queue"""
+        work_queue = MagicMock(spec=['get', 'put'])
+        w = DerpWorker(work_group='testing', work_queue=work_queue, idle_queue=MagicMock())
+        w.pending.extend(['a', 'b'])
+
+        w.return_pending()
+
+        the_args, _ = work_queue.put.call_args
+
+        self.assertEqual(the_args[0], ['a', 'b'])
+
+    def test_next_item_list(self):
+        """``Worker`` 'next_item' hands out the records in a list one at a time"""
+        work_queue = MagicMock(spec=['get', 'put'])
+        work_queue.get.return_value = ['a', 'b']
+        w = DerpWorker(work_group='testing', work_queue=work_queue, idle_queue=MagicMock())
+
+        items = [w.next_item(block=True), w.next_item(block=True)]
+
+        self.assertEqual(items, ['a', 'b'])
+        self.assertEqual(work_queue.get.call_count, 1)
+
+    def test_report_taken_no_backlog(self):
+        """``Worker`` 'report_taken' is a no-op when there's no backlog to update"""
+        w = DerpWorker(work_group='testing', work_queue=MagicMock(), idle_queue=MagicMock())
+
+        count = w.report_taken(10)
+
+        self.assertEqual(count, 0)
+
     @patch.object(DerpWorker, 'flush_on_term')
     @patch.object(worker, 'get_logger')
     @patch.object(DerpWorker, 'process_data')
@@ -99,6 +214,24 @@ class TestWorker(unittest.TestCase):
 
         self.assertTrue(called_fake_flush_on_term)
 
+    @patch.object(DerpWorker, 'flush_on_term')
+    @patch.object(worker, 'get_logger')
+    @patch.object(DerpWorker, 'process_data')
+    def test_run_exception_backlog(self, fake_process_data, fake_get_logger, fake_flush_on_term):
+        """``Worker`` the 'run' method still subtracts the records it took from the backlog if 'process_data' raises an Exception"""
+        work_queue = MagicMock(spec=['get', 'put'])
+        work_queue.get.return_value = ['some Work', 'more Work']
+        backlog = Value('i', 2)
+        fake_process_data.side_effect = Exception('testing')
+
+        w = DerpWorker(work_group='testing', work_queue=work_queue, idle_queue=MagicMock(), backlog=backlog)
+        w.run()
+
+        the_args, _ = work_queue.put.call_args
+
+        self.assertEqual(backlog.value, 1)
+        self.assertEqual(the_args[0], ['more Work'])
+
     @patch.object(DerpWorker, 'flush_on_term')
     @patch.object(worker, 'get_logger')
     @patch.object(DerpWorker, 'process_data')
@@ -117,6 +250,31 @@ class TestWorker(unittest.TestCase):
 
         self.assertTrue(called_fake_flush_on_term)
 
+    @patch.object(worker, 'MAX_RECORDS_PER_WORKER', 2)
+    @patch.object(DerpWorker, 'flush_on_term')
+    @patch.object(worker, 'get_logger')
+    @patch.object(DerpWorker, 'process_data')
+    def test_run_recycle(self, fake_process_data, fake_get_logger, fake_flush_on_term):
+        """``Worker`` 'run' retires after processing MAX_RECORDS_PER_WORKER records, and returns the rest"""
+        idle_queue = MagicMock()
+        work_queue = MagicMock(spec=['get', 'put'])
+        work_queue.get.return_value = ['a', 'b', 'c']
+
+        w = DerpWorker(work_group='testing', work_queue=work_queue, idle_queue=idle_queue)
+        w.run()
+
+        returned, _ = work_queue.put.call_args
+        told_manager, _ = idle_queue.put.call_args
+
+        self.assertEqual(fake_process_data.call_count, 2)
+        self.assertEqual(returned[0], ['c'])
+        self.assertEqual(told_manager[0], (w.name, worker.RECYCLED))
+        self.assertTrue(fake_flush_on_term.called)
+
+    def test_max_records_per_worker(self):
+        """``MAX_RECORDS_PER_WORKER`` defaults to never recycling workers"""
+        self.assertEqual(worker.MAX_RECORDS_PER_WORKER, 0)
+
     @patch.object(worker, 'get_logger')
     @patch.object(DerpWorker, 'flush_on_term')
     @patch.object(DerpWorker, 'process_data')
@@ -138,44 +296,224 @@ class TestWorker(unittest.TestCase):
         self.assertEqual(singled_manager, expected)
 
 
-class TestLogWorker(unittest.TestCase):
-    """A suite of test cases for the ``LogWorker`` object"""
-    @classmethod
-    def setUp(cls):
+class FakeDecryptionError(TypeError):
+    """Stands in for ``rfernet.DecryptionError``"""
+
+
+class TestRFernetCipher(unittest.TestCase):
+    """A suite of test cases for the ``RFernetCipher`` object"""
+    @patch.object(worker, 'rfernet')
+    def test_key(self, fake_rfernet):
+        """``RFernetCipher`` hands rfernet the key as a string"""
+        worker.RFernetCipher(b'some key')
+
+        the_args, _ = fake_rfernet.Fernet.call_args
+
+        self.assertEqual(the_args[0], 'some key')
+
+    @patch.object(worker, 'rfernet')
+    def test_decrypt(self, fake_rfernet):
+        """``RFernetCipher`` 'decrypt' hands rfernet the token as a string"""
+        fake_rfernet.Fernet.return_value.decrypt.return_value = b'some data'
+        cipher = worker.RFernetCipher(b'some key')
+
+        data = cipher.decrypt(b'some token')
+        the_args, _ = fake_rfernet.Fernet.return_value.decrypt.call_args
+
+        self.assertEqual(data, b'some data')
+        self.assertEqual(the_args[0], 'some token')
+
+    @patch.object(worker, 'rfernet')
+    def test_decrypt_invalid(self, fake_rfernet):
+        """``RFernetCipher`` 'decrypt' raises InvalidToken, just like pyca's Fernet"""
+        fake_rfernet.DecryptionError = FakeDecryptionError
+        fake_rfernet.Fernet.return_value.decrypt.side_effect = FakeDecryptionError()
+        cipher = worker.RFernetCipher(b'some key')
+
+        with self.assertRaises(worker.InvalidToken):
+            cipher.decrypt(b'some token')
+
+    @patch.object(worker, 'rfernet')
+    def test_decrypt_not_ascii(self, fake_rfernet):
+        """``RFernetCipher`` 'decrypt' raises InvalidToken for data that cannot be a token"""
+        fake_rfernet.DecryptionError = FakeDecryptionError
+        cipher = worker.RFernetCipher(b'some key')
+
+        with self.assertRaises(worker.InvalidToken):
+            cipher.decrypt(b'\xff\xfe')
+
+
+class TestMakeFernet(unittest.TestCase):
+    """A suite of test cases for the ``make_fernet`` function"""
+    @patch.object(worker, 'USE_RFERNET', True)
+    @patch.object(worker, 'rfernet')
+    def test_rfernet(self, fake_rfernet):
+        """``make_fernet`` uses rfernet when it's installed"""
+        cipher = worker.make_fernet(b'some key')
+
+        self.assertTrue(isinstance(cipher, worker.RFernetCipher))
+
+    @patch.object(worker, 'USE_RFERNET', False)
+    @patch.object(worker, 'Fernet')
+    @patch.object(worker, 'rfernet')
+    def test_rfernet_disabled(self, fake_rfernet, fake_Fernet):
+        """``make_fernet`` uses pyca's Fernet when USE_RFERNET is false"""
+        cipher = worker.make_fernet(b'some key')
+
+        self.assertTrue(cipher is fake_Fernet.return_value)
+
+    @patch.object(worker, 'rfernet', None)
+    @patch.object(worker, 'Fernet')
+    def test_rfernet_not_installed(self, fake_Fernet):
+        """``make_fernet`` uses pyca's Fernet when rfernet isn't installed"""
+        cipher = worker.make_fernet(b'some key')
+
+        self.assertTrue(cipher is fake_Fernet.return_value)
+
+
+@patch.dict(worker.CIPHERS, clear=True)
+class TestSharedCipher(unittest.TestCase):
+    """A suite of test cases for the ``shared_cipher`` function"""
+    def test_shared_cipher(self):
+        """``shared_cipher`` only builds one cipher per key"""
+        make = MagicMock()
+
+        first = worker.shared_cipher(make, b'some key')
+        second = worker.shared_cipher(make, b'some key')
+
+        self.assertTrue(first is second)
+        self.assertEqual(make.call_count, 1)
+
+    def test_shared_cipher_keys(self):
+        """``shared_cipher`` builds a different cipher for a different key"""
+        make = MagicMock(side_effect=lambda key: key)
+
+        first = worker.shared_cipher(make, b'some key')
+        second = worker.shared_cipher(make, b'another key')
+
+        self.assertEqual(make.call_count, 2)
+        self.assertFalse(first is second)
+
+
+class TestAESGCMCipher(unittest.TestCase):
+    """A suite of test cases for the ``AESGCMCipher`` object"""
+    def test_decrypt(self):
+        """``AESGCMCipher`` decrypts a message that has the nonce prepended"""
+        key = worker.Fernet.generate_key()
+        aead = worker.AESGCM(worker.hashlib.sha256(key).digest())
+        nonce = os.urandom(12)
+        token = nonce + aead.encrypt(nonce, b'{"worked":true}', None)
+
+        plain_text = worker.AESGCMCipher(key).decrypt(token)
+
+        self.assertEqual(plain_text, b'{"worked":true}')
+
+    def test_decrypt_fernet(self):
+        """``AESGCMCipher`` still decrypts messages from exporters that use Fernet"""
+        key = worker.Fernet.generate_key()
+        token = worker.Fernet(key).encrypt(b'{"worked":true}')
+
+        plain_text = worker.AESGCMCipher(key).decrypt(token)
+
+        self.assertEqual(plain_text, b'{"worked":true}')
+
+    def test_slots(self):
+        """``AESGCMCipher`` instances don't carry a __dict__"""
+        cipher = worker.AESGCMCipher(worker.Fernet.generate_key())
+
+        self.assertFalse(hasattr(cipher, '__dict__'))
+
+    def test_decrypt_invalid(self):
+        """``AESGCMCipher`` raises InvalidToken for data it cannot decrypt"""
+        key = worker.Fernet.generate_key()
+        with self.assertRaises(worker.InvalidToken):
+            worker.AESGCMCipher(key).decrypt(b'not encrypted with our key')
+
+
+class TestReadSecret(unittest.TestCase):
+    """A suite of test cases for the ``read_secret`` function"""
+    def setUp(self):
         """Runs before every test case"""
-        os.environ['CIPHER_KEY_FILE'] = './.fake_file.txt'
-        os.environ['ELASTICSEARCH_SERVER'] = '127.0.0.1'
-        os.environ['ELASTICSEARCH_USER'] = 'bob'
-        os.environ['ELASTICSEARCH_DOC_TYPE'] = 'someLogType'
-        os.environ['ELASTICSEARCH_PASSWD_FILE'] = './.fake_file.txt'
-
-
-    @classmethod
-    def tearDown(cls):
-        """Runs after every test case"""
-        os.environ.pop('CIPHER_KEY_FILE', None)
-        os.environ.pop('ELASTICSEARCH_SERVER', None)
-        os.environ.pop('ELASTICSEARCH_USER', None)
-        os.environ.pop('ELASTICSEARCH_DOC_TYPE', None)
-        os.environ.pop('ELASTICSEARCH_PASSWD_FILE', None)
+        worker.read_secret.cache_clear()
+        self.addCleanup(worker.read_secret.cache_clear)
+
+    @patch.object(builtins, "open", new_callable=mock_open, read_data=b'some secret\n')
+    def test_read_secret(self, fake_open):
+        """``read_secret`` returns the contents of the file, minus surrounding whitespace"""
+        secret = worker.read_secret('/some/file')
+
+        self.assertEqual(secret, b'some secret')
+
+    @patch.object(builtins, "open", new_callable=mock_open, read_data=b'some secret\n')
+    def test_read_secret_once(self, fake_open):
+        """``read_secret`` only reads a file once"""
+        worker.read_secret('/some/file')
+        worker.read_secret('/some/file')
+
+        self.assertEqual(fake_open.call_count, 1)
+
+
+@patch.dict(worker.CIPHERS, clear=True)
+class TestLogCipher(unittest.TestCase):
+    """A suite of test cases for the ``log_cipher`` function"""
+    def test_log_cipher(self):
+        """``log_cipher`` defaults to Fernet"""
+        key = worker.Fernet.generate_key()
 
+        cipher = worker.log_cipher(key)
+
+        self.assertFalse(isinstance(cipher, worker.AESGCMCipher))
+
+    @patch.object(worker, 'LOG_CIPHER', 'aesgcm')
+    def test_log_cipher_aesgcm(self):
+        """``log_cipher`` uses AES-GCM when LOG_CIPHER is 'aesgcm'"""
+        key = worker.Fernet.generate_key()
+
+        cipher = worker.log_cipher(key)
+
+        self.assertTrue(isinstance(cipher, worker.AESGCMCipher))
+
+
+class TestLogWorkerConfig(unittest.TestCase):
+    """A suite of test cases for the ``LogWorkerConfig`` object"""
+    def test_from_env(self):
+        """``LogWorkerConfig`` 'from_env' reads the settings from environment variables"""
+        env = {'ELASTICSEARCH_SERVER' : '127.0.0.1',
+               'ELASTICSEARCH_USER' : 'bob',
+               'ELASTICSEARCH_DOC_TYPE' : 'someLogType',
+               'ELASTICSEARCH_PASSWD_FILE' : './.fake_file.txt',
+               'CIPHER_KEY_FILE' : './.fake_file.txt'}
+        with patch.dict(os.environ, env):
+            config = worker.LogWorkerConfig.from_env()
+
+        self.assertEqual(config, CONFIG)
+
+    def test_from_env_missing(self):
+        """``LogWorkerConfig`` 'from_env' raises KeyError if an environment variable isn't set"""
+        with patch.dict(os.environ, {}, clear=True):
+            with self.assertRaises(KeyError):
+                worker.LogWorkerConfig.from_env()
+
+
+class TestLogWorker(unittest.TestCase):
+    """A suite of test cases for the ``LogWorker`` object"""
     @patch.object(worker, 'ElasticSearch')
     @patch.object(worker, 'Fernet')
-    @patch.object(builtins, "open")
-    def test_init(self, fake_open, fake_Fernet, fake_ElasticSearch):
+    @patch.object(worker, 'read_secret')
+    def test_init(self, fake_read_secret, fake_Fernet, fake_ElasticSearch):
         """``LogWorker`` accepts the standard INIT params as any other worker"""
         work_group = 'someLogProcessor'
         work_queue = MagicMock()
         idle_queue = MagicMock()
 
-        log_worker = DerpLogWorker(work_group, work_queue, idle_queue)
+        log_worker = DerpLogWorker(work_group, work_queue, idle_queue, config=CONFIG)
 
         self.assertTrue(isinstance(log_worker, worker.LogWorker))
 
     @patch.object(worker, 'ElasticSearch')
     @patch.object(worker, 'Fernet')
-    @patch.object(builtins, "open")
-    def test_extract(self, fake_open, fake_Fernet, fake_ElasticSearch):
+    @patch.object(worker, 'read_secret')
+    def test_extract(self, fake_read_secret, fake_Fernet, fake_ElasticSearch):
         """``LogWorker`` the 'extract' method decrypts and parses the JSON into a usable object"""
         fake_cipher = MagicMock()
         fake_cipher.decrypt.return_value = '{"worked":true}'
@@ -184,16 +522,31 @@ class TestLogWorker(unittest.TestCase):
         work_queue = MagicMock()
         idle_queue = MagicMock()
 
-        log_worker = DerpLogWorker(work_group, work_queue, idle_queue)
+        log_worker = DerpLogWorker(work_group, work_queue, idle_queue, config=CONFIG)
         data = log_worker.extract('some encrypted data')
         expected = {"worked" : True}
 
         self.assertEqual(data, expected)
 
+    @patch.object(worker, 'LOG_CIPHER', 'aesgcm')
     @patch.object(worker, 'ElasticSearch')
     @patch.object(worker, 'Fernet')
-    @patch.object(builtins, "open")
-    def test_flush_on_term(self, fake_open, fake_Fernet, fake_ElasticSearch):
+    @patch.object(worker, 'read_secret')
+    def test_aesgcm(self, fake_read_secret, fake_Fernet, fake_ElasticSearch):
+        """``LogWorker`` decrypts with AES-GCM when LOG_CIPHER is 'aesgcm'"""
+        fake_read_secret.return_value = b'some key'
+        work_group = 'someLogProcessor'
+        work_queue = MagicMock()
+        idle_queue = MagicMock()
+
+        log_worker = DerpLogWorker(work_group, work_queue, idle_queue, config=CONFIG)
+
+        self.assertTrue(isinstance(log_worker.cipher, worker.AESGCMCipher))
+
+    @patch.object(worker, 'ElasticSearch')
+    @patch.object(worker, 'Fernet')
+    @patch.object(worker, 'read_secret')
+    def test_flush_on_term(self, fake_read_secret, fake_Fernet, fake_ElasticSearch):
         """``LogWorker`` the 'flush_on_term' method closes the TCP socket with the ElasticSearch server"""
         fake_es = MagicMock()
         fake_ElasticSearch.return_value = fake_es
@@ -201,11 +554,173 @@ class TestLogWorker(unittest.TestCase):
         work_queue = MagicMock()
         idle_queue = MagicMock()
 
-        log_worker = DerpLogWorker(work_group, work_queue, idle_queue)
+        log_worker = DerpLogWorker(work_group, work_queue, idle_queue, config=CONFIG)
         log_worker.flush_on_term()
 
         self.assertTrue(fake_es.close.called)
 
+    @patch.object(worker, 'ElasticSearch')
+    @patch.object(worker, 'Fernet')
+    @patch.object(worker, 'read_secret')
+    def test_process_data_buffers(self, fake_read_secret, fake_Fernet, fake_ElasticSearch):
+        """``LogWorker`` 'process_data' buffers documents instead of uploading them one at a time"""
+        fake_es = MagicMock()
+        fake_ElasticSearch.return_value = fake_es
+        fake_Fernet.return_value.decrypt.return_value = '{"worked":true}'
+        log_worker = DerpLogWorker('someLogProcessor', MagicMock(), MagicMock(), config=CONFIG)
+
+        log_worker.process_data('some encrypted data')
+
+        self.assertFalse(fake_es.write_many.called)
+        self.assertEqual(len(log_worker.documents), 1)
+
+    @patch.object(worker, 'ElasticSearch')
+    @patch.object(worker, 'Fernet')
+    @patch.object(worker, 'read_secret')
+    def test_process_data_bad_record(self, fake_read_secret, fake_Fernet, fake_ElasticSearch):
+        """``LogWorker`` 'process_data' logs and skips records that 'format_info' cannot handle"""
+        fake_Fernet.return_value.decrypt.return_value = '{"worked":true}'
+        log_worker = DerpLogWorker('someLogProcessor', MagicMock(), MagicMock(), config=CONFIG)
+        log_worker.format_info = MagicMock(side_effect=IndexError('list index out of range'))
+        log_worker.log = MagicMock()
+
+        log_worker.process_data('some encrypted data')
+
+        self.assertTrue(log_worker.log.error.called)
+        self.assertEqual(log_worker.documents, [])
+
+    @patch.object(worker, 'BULK_MAX_DOCS', 2)
+    @patch.object(worker, 'get_logger')
+    @patch.object(worker, 'ElasticSearch')
+    @patch.object(worker, 'Fernet')
+    @patch.object(worker, 'read_secret')
+    def test_failed_write_retried_on_term(self, fake_read_secret, fake_Fernet, fake_ElasticSearch, fake_get_logger):
+        """``LogWorker`` keeps the buffered documents when a bulk upload fails, so 'flush_on_term' can try again"""
+        fake_es = MagicMock()
+        fake_es.write_many.side_effect = [requests.exceptions.HTTPError('testing'), None]
+        fake_ElasticSearch.return_value = fake_es
+        fake_Fernet.return_value.decrypt.return_value = '{"worked":true}'
+        work_queue = MagicMock(spec=['get', 'put'])
+        work_queue.get.return_value = ['some encrypted data', 'more encrypted data']
+        log_worker = DerpLogWorker('someLogProcessor', work_queue, MagicMock(), config=CONFIG)
+
+        log_worker.run()
+
+        failed, retried = [c[0][0] for c in fake_es.write_many.call_args_list]
+
+        self.assertEqual(len(retried), 2)
+        self.assertEqual(failed, retried)
+        self.assertEqual(log_worker.documents, [])
+
+    def test_bulk_defaults(self):
+        """``LogWorker`` uploads in batches of up to 500 documents/5MB, or every second, unless overridden via environment variables"""
+        found = (worker.BULK_MAX_DOCS, worker.BULK_MAX_BYTES, worker.BULK_MAX_AGE)
+        expected = (500, 5 * 1024 * 1024, 1)
+
+        self.assertEqual(found, expected)
+
+    @patch.object(worker, 'BULK_MAX_DOCS', 2)
+    @patch.object(worker, 'ElasticSearch')
+    @patch.object(worker, 'Fernet')
+    @patch.object(worker, 'read_secret')
+    def test_process_data_bulk_docs(self, fake_read_secret, fake_Fernet, fake_ElasticSearch):
+        """``LogWorker`` 'process_data' uploads once BULK_MAX_DOCS documents are buffered"""
+        fake_es = MagicMock()
+        fake_ElasticSearch.return_value = fake_es
+        fake_Fernet.return_value.decrypt.return_value = '{"worked":true}'
+        log_worker = DerpLogWorker('someLogProcessor', MagicMock(), MagicMock(), config=CONFIG)
+
+        log_worker.process_data('some encrypted data')
+        log_worker.process_data('some encrypted data')
+
+        the_args, _ = fake_es.write_many.call_args
+        expected = ['{"worked":true}', '{"worked":true}']
+
+        self.assertEqual(the_args[0], expected)
+        self.assertEqual(log_worker.documents, [])
+
+    @patch.object(worker, 'BULK_MAX_BYTES', 10)
+    @patch.object(worker, 'ElasticSearch')
+    @patch.object(worker, 'Fernet')
+    @patch.object(worker, 'read_secret')
+    def test_process_data_bulk_bytes(self, fake_read_secret, fake_Fernet, fake_ElasticSearch):
+        """``LogWorker`` 'process_data' uploads once BULK_MAX_BYTES worth of documents are buffered"""
+        fake_es = MagicMock()
+        fake_ElasticSearch.return_value = fake_es
+        fake_Fernet.return_value.decrypt.return_value = '{"worked":true}'
+        log_worker = DerpLogWorker('someLogProcessor', MagicMock(), MagicMock(), config=CONFIG)
+
+        log_worker.process_data('some encrypted data')
+
+        self.assertTrue(fake_es.write_many.called)
+
+    @patch.object(worker.time, 'monotonic')
+    @patch.object(worker, 'ElasticSearch')
+    @patch.object(worker, 'Fernet')
+    @patch.object(worker, 'read_secret')
+    def test_process_data_bulk_age(self, fake_read_secret, fake_Fernet, fake_ElasticSearch, fake_monotonic):
+        """``LogWorker`` 'process_data' uploads once the oldest buffered document is BULK_MAX_AGE old"""
+        fake_monotonic.side_effect = [100, 100, 101]
+        fake_es = MagicMock()
+        fake_ElasticSearch.return_value = fake_es
+        fake_Fernet.return_value.decrypt.return_value = '{"worked":true}'
+        log_worker = DerpLogWorker('someLogProcessor', MagicMock(), MagicMock(), config=CONFIG)
+
+        log_worker.process_data('some encrypted data')
+        log_worker.process_data('some encrypted data')
+
+        the_args, _ = fake_es.write_many.call_args
+
+        self.assertEqual(len(the_args[0]), 2)
+
+    @patch.object(worker.time, 'monotonic')
+    @patch.object(worker, 'ElasticSearch')
+    @patch.object(worker, 'Fernet')
+    @patch.object(worker, 'read_secret')
+    def test_on_idle(self, fake_read_secret, fake_Fernet, fake_ElasticSearch, fake_monotonic):
+        """``LogWorker`` uploads buffered documents once they're BULK_MAX_AGE old while idle"""
+        fake_monotonic.return_value = 101
+        fake_es = MagicMock()
+        fake_ElasticSearch.return_value = fake_es
+        log_worker = DerpLogWorker('someLogProcessor', MagicMock(), MagicMock(), config=CONFIG)
+        log_worker.documents = ['{"worked":true}']
+        log_worker.documents_since = 100
+
+        log_worker.on_idle()
+
+        self.assertTrue(fake_es.write_many.called)
+
+    @patch.object(worker.time, 'monotonic')
+    @patch.object(worker, 'ElasticSearch')
+    @patch.object(worker, 'Fernet')
+    @patch.object(worker, 'read_secret')
+    def test_on_idle_recent(self, fake_read_secret, fake_Fernet, fake_ElasticSearch, fake_monotonic):
+        """``LogWorker`` keeps buffering recent documents while idle"""
+        fake_monotonic.return_value = 100.5
+        fake_es = MagicMock()
+        fake_ElasticSearch.return_value = fake_es
+        log_worker = DerpLogWorker('someLogProcessor', MagicMock(), MagicMock(), config=CONFIG)
+        log_worker.documents = ['{"worked":true}']
+        log_worker.documents_since = 100
+
+        log_worker.on_idle()
+
+        self.assertFalse(fake_es.write_many.called)
+
+    @patch.object(worker, 'ElasticSearch')
+    @patch.object(worker, 'Fernet')
+    @patch.object(worker, 'read_secret')
+    def test_flush_on_term_documents(self, fake_read_secret, fake_Fernet, fake_ElasticSearch):
+        """``LogWorker`` the 'flush_on_term' method uploads buffered documents"""
+        fake_es = MagicMock()
+        fake_ElasticSearch.return_value = fake_es
+        log_worker = DerpLogWorker('someLogProcessor', MagicMock(), MagicMock(), config=CONFIG)
+        log_worker.documents = ['{"worked":true}']
+
+        log_worker.flush_on_term()
+
+        self.assertTrue(fake_es.write_many.called)
+
 
 
 